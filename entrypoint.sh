@@ -14,11 +14,10 @@ elif [[ "$RUN_AS" == "PREPARER" ]]; then
     python -m test.client.generate_endpoints
 
 else
-    # Start both worker and API services
-    export PARTITION_ID=1
-    export PARTITION_COUNT=2
+    # Start both worker and API services.
+    # The supervisor runs one worker process per core, within the CPU quota of the container.
     cd /app
-    PYTHONPATH=/app python -m src.worker.main & 
+    WORKER_MODE=supervisor PYTHONPATH=/app python -m src.worker.main & 
     PYTHONPATH=/app uvicorn src.api.main:app --host 0.0.0.0 --port 8080 --reload &
     wait
 fi
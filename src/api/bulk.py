@@ -0,0 +1,252 @@
+"""
+This module imports and exports endpoints in bulk for the API.
+1. Read NDJSON or CSV bodies a batch of lines at a time, as they arrive
+2. Validate each batch in a thread, compiling each distinct regex once per batch
+3. Report the errors of every invalid line, so a rejected import is fixed in one go
+4. Stream exports from COPY to the response, a bounded number of chunks ahead
+"""
+import asyncio
+import csv
+import inspect
+import json
+import os
+import re
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from pydantic import HttpUrl, TypeAdapter, ValidationError
+
+from src.utils import logger
+
+# Lines validated at once, in a thread
+BULK_BATCH_LINES = int(os.getenv("BULK_BATCH_LINES", "5000"))
+# Rows an import may have at most
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "200000"))
+# Errors reported at most for a rejected import
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "100"))
+# Chunks read from COPY ahead of the client at most
+EXPORT_QUEUE_CHUNKS = 16
+
+# Media type of each format
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+# endpoint_id is optional: exported with every endpoint, it updates that endpoint when imported back
+IMPORT_FIELDS = ("endpoint_id", "url", "regex", "interval", "max_body_bytes")
+MAX_TEXT_LENGTH = 255
+# Validates and normalises a url the way the url of an endpoint created by the API is
+HTTP_URL = TypeAdapter(HttpUrl)
+
+# A validated row: (line, endpoint_id, url, regex, interval, max_body_bytes)
+ImportRow = Tuple[int, Optional[int], str, Optional[str], int, Optional[int]]
+
+def format_of(content_type: str) -> str:
+    """The import format of a Content-Type header."""
+    media_type = content_type.split(";")[0].strip().lower()
+    for name, format_media_type in FORMATS.items():
+        if media_type == format_media_type:
+            return name
+    raise ValueError(f"Unsupported Content-Type {content_type}, expected one of {list(FORMATS.values())}")
+
+async def read_lines(chunks: AsyncIterator[bytes],
+                     batch_lines: int = BULK_BATCH_LINES) -> AsyncIterator[List[Tuple[int, str]]]:
+    """Split a streamed body into batches of (line number, line), skipping blank lines."""
+    batch = []
+    pending = b""
+    number = 0
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                batch.append((number, line.decode("utf-8", errors="replace").rstrip("\r")))
+        if len(batch) >= batch_lines:
+            yield batch
+            batch = []
+    if pending.strip():
+        batch.append((number + 1, pending.decode("utf-8", errors="replace").rstrip("\r")))
+    if batch:
+        yield batch
+
+def parse_ndjson(lines: List[Tuple[int, str]]) -> List[Tuple[int, Any]]:
+    """Parse one JSON object per line, a ValueError standing for a line that isn't JSON."""
+    records = []
+    for number, line in lines:
+        try:
+            records.append((number, json.loads(line)))
+        except ValueError as e:
+            records.append((number, ValueError(f"invalid JSON: {e}")))
+    return records
+
+def parse_csv(lines: List[Tuple[int, str]], header: List[str]) -> List[Tuple[int, Any]]:
+    """Parse one CSV record per line into a dict keyed by the header."""
+    records = []
+    for (number, _), values in zip(lines, csv.reader(line for _, line in lines)):
+        if len(values) != len(header):
+            records.append((number, ValueError(f"expected {len(header)} fields, got {len(values)}")))
+        else:
+            records.append((number, dict(zip(header, values))))
+    return records
+
+def _optional(value):
+    """CSV has no null, an empty field is one."""
+    return None if value is None or value == "" else value
+
+def _integer(value, name: str) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        return int(value)
+    except ValueError as e:
+        raise ValueError(f"{name} must be an integer") from e
+
+def _url(value) -> str:
+    """The url of a record, normalised like the API does, e.g. http://host becomes http://host/."""
+    if not isinstance(value, str):
+        raise ValueError("url must be a string")
+    try:
+        url = str(HTTP_URL.validate_python(value))
+    except ValidationError as e:
+        raise ValueError(f"url must be an absolute http or https URL: {e.errors()[0]['msg']}") from e
+    if len(url) > MAX_TEXT_LENGTH:
+        raise ValueError(f"url must be at most {MAX_TEXT_LENGTH} characters")
+    return url
+
+def _regex(value, regex_errors: Dict[str, Optional[str]]) -> Optional[str]:
+    regex = _optional(value)
+    if regex is not None:
+        if not isinstance(regex, str) or len(regex) > MAX_TEXT_LENGTH:
+            raise ValueError(f"regex must be a string of at most {MAX_TEXT_LENGTH} characters")
+        if regex_errors.get(regex):
+            raise ValueError(f"invalid regex: {regex_errors[regex]}")
+    return regex
+
+def validate_record(record: Any, regex_errors: Dict[str, Optional[str]]) -> ImportRow:
+    """Validate a parsed record the way the API validates one endpoint, without the line number.
+    regex_errors holds the compile error of each regex of the batch, None if it compiles.
+    """
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("expected an object")
+    unknown = set(record) - set(IMPORT_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields {sorted(unknown)}")
+
+    endpoint_id = _optional(record.get("endpoint_id"))
+    if endpoint_id is not None:
+        endpoint_id = _integer(endpoint_id, "endpoint_id")
+        if endpoint_id <= 0:
+            raise ValueError("endpoint_id must be positive")
+
+    url = _url(record.get("url"))
+
+    interval = _integer(record.get("interval"), "interval")
+    if interval < 5 or interval > 300:
+        raise ValueError("Interval must be between 5 and 300 seconds")
+
+    regex = _regex(record.get("regex"), regex_errors)
+
+    max_body_bytes = _optional(record.get("max_body_bytes"))
+    if max_body_bytes is not None:
+        max_body_bytes = _integer(max_body_bytes, "max_body_bytes")
+        if max_body_bytes <= 0:
+            raise ValueError("max_body_bytes must be positive")
+    return (endpoint_id, url, regex, interval, max_body_bytes)
+
+def validate_batch(records: List[Tuple[int, Any]]) -> Tuple[List[ImportRow], List[Dict[str, Any]]]:
+    """Validate a batch of parsed records, and return the valid rows and the errors by line.
+    Each distinct regex is compiled once, and the compiled pattern is not kept.
+    """
+    regex_errors: Dict[str, Optional[str]] = {}
+    for _, record in records:
+        regex = record.get("regex") if isinstance(record, dict) else None
+        if isinstance(regex, str) and regex and regex not in regex_errors:
+            try:
+                re.compile(regex)
+                regex_errors[regex] = None
+            except re.error as e:
+                regex_errors[regex] = str(e)
+    rows, errors = [], []
+    for number, record in records:
+        try:
+            rows.append((number, *validate_record(record, regex_errors)))
+        except ValueError as e:
+            errors.append({"line": number, "error": str(e)})
+    return rows, errors
+
+async def read_import(chunks: AsyncIterator[bytes], import_format: str,
+                      max_rows: int = BULK_MAX_ROWS) -> Tuple[List[ImportRow], List[Dict[str, Any]]]:
+    """Read, parse and validate a streamed import. It returns the valid rows, and the errors
+    of up to BULK_MAX_ERRORS invalid lines.
+    """
+    rows: List[ImportRow] = []
+    errors: List[Dict[str, Any]] = []
+    header = None
+    async for lines in read_lines(chunks):
+        if import_format == "csv":
+            if header is None:
+                header = next(csv.reader([lines[0][1]]))
+                lines = lines[1:]
+                missing = {"url", "interval"} - set(header)
+                if missing:
+                    return [], [{"line": 1, "error": f"the CSV header misses {sorted(missing)}"}]
+            records = parse_csv(lines, header)
+        else:
+            records = parse_ndjson(lines)
+        valid, invalid = await asyncio.to_thread(validate_batch, records)
+        rows.extend(valid)
+        errors.extend(invalid[:BULK_MAX_ERRORS - len(errors)])
+        if len(rows) + len(errors) > max_rows:
+            errors.append({"line": records[-1][0], "error": f"an import has at most {max_rows} rows"})
+            break
+    return rows, errors
+
+async def stream_export(export: Callable, export_format: str) -> AsyncIterator[bytes]:
+    """Run export(export_format, write) and yield the chunks it writes.
+    export is a method of the (Async)EndpointManager. A psycopg2 export runs in
+    a thread, and waits while the client is EXPORT_QUEUE_CHUNKS chunks behind.
+    """
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue(EXPORT_QUEUE_CHUNKS)
+    stopped = threading.Event()
+    in_thread = not inspect.iscoroutinefunction(export)
+    if not in_thread:
+        async def write(chunk):
+            await chunks.put(bytes(chunk))
+        running = export(export_format, write)
+    else:
+        def write(chunk):
+            if stopped.is_set():
+                # Aborts the COPY once the client is gone
+                raise ConnectionAbortedError("The export was stopped")
+            asyncio.run_coroutine_threadsafe(chunks.put(bytes(chunk)), loop).result()
+        running = asyncio.to_thread(export, export_format, write)
+
+    async def produce():
+        try:
+            await running
+        finally:
+            await chunks.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            yield chunk
+        # Raises if the export failed, so the client sees a broken response, not a short one
+        await producer
+    finally:
+        if not producer.done():
+            stopped.set()
+            # A thread can't be cancelled, its next write raises instead
+            if not in_thread:
+                producer.cancel()
+            # Make room for a producer waiting to put, until it is done
+            while not producer.done():
+                while not chunks.empty():
+                    chunks.get_nowait()
+                await asyncio.sleep(0.01)
+            if not producer.cancelled() and producer.exception() is not None:
+                logger.warning(f"Export stopped: {producer.exception()}")
@@ -1,21 +1,47 @@
-"""FastAPI application for the Site Uptime Watcher API."""
+"""FastAPI application for the Site Uptime Watcher API.
+The endpoint manager and its connection pool are created once at startup,
+shared by every request, and closed at shutdown.
+"""
+import asyncio
+import inspect
 import os
+from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, validator, HttpUrl
 import uvicorn
 
+from src.api import bulk, stats
 from src.endpoint_manager import EndpointManager
-from src.utils import load_config
+from src.async_endpoint_manager import create_endpoint_manager, resolve
+from src.utils import load_config, logger
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    """Open the pool and ensure the tables are ready once, before serving requests.
+    DB_DRIVER=asyncpg selects the AsyncEndpointManager, whose queries don't block the event loop.
+    """
+    load_config()
+    manager = create_endpoint_manager()
+    await resolve(manager.check_readiness())
+    application.state.endpoint_manager = manager
+    logger.info("API connection pool opened")
+    try:
+        yield
+    finally:
+        await resolve(manager.close())
+        logger.info("API connection pool closed")
 
 app = FastAPI(
     title="Site Uptime Watcher API",
     description="API for managing site uptime monitoring endpoints",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -25,6 +51,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let browsers read the cursor of the next page of GET /endpoints
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Mount static files
@@ -35,6 +63,7 @@ class EndpointBase(BaseModel):
     url: HttpUrl
     regex: Optional[str] = None
     interval: int
+    max_body_bytes: Optional[int] = None
 
     @validator('interval')
     # pylint: disable=no-self-argument
@@ -44,6 +73,14 @@ class EndpointBase(BaseModel):
             raise ValueError('Interval must be between 5 and 300 seconds')
         return v
 
+    @validator('max_body_bytes')
+    # pylint: disable=no-self-argument
+    def validate_max_body_bytes(cls, v):
+        """Validate that the byte cap is positive if provided."""
+        if v is not None and v <= 0:
+            raise ValueError('max_body_bytes must be positive')
+        return v
+
 class EndpointCreate(EndpointBase):
     """Model for creating a new endpoint."""
 
@@ -52,6 +89,7 @@ class EndpointUpdate(BaseModel):
     url: Optional[HttpUrl] = None
     regex: Optional[str] = None
     interval: Optional[int] = None
+    max_body_bytes: Optional[int] = None
 
     @validator('interval')
     # pylint: disable=no-self-argument
@@ -61,6 +99,14 @@ class EndpointUpdate(BaseModel):
             raise ValueError('Interval must be between 5 and 300 seconds')
         return v
 
+    @validator('max_body_bytes')
+    # pylint: disable=no-self-argument
+    def validate_max_body_bytes(cls, v):
+        """Validate that the byte cap is positive if provided."""
+        if v is not None and v <= 0:
+            raise ValueError('max_body_bytes must be positive')
+        return v
+
 class EndpointResponse(EndpointBase):
     """Model for endpoint response data including the endpoint ID."""
     endpoint_id: int
@@ -74,38 +120,99 @@ class EndpointResponse(EndpointBase):
                 data['regex'] = data['regex'].regex_pattern
         super().__init__(**data)
 
+    @validator('regex', pre=True)
+    # pylint: disable=no-self-argument
+    def validate_regex(cls, v):
+        """Serialize the compiled pattern of an Endpoint as its string."""
+        return getattr(v, 'pattern', v)
+
     # pylint: disable=too-few-public-methods
     class Config:
         """Configuration for the EndpointResponse model."""
         orm_mode = True
 
 # Dependency to get endpoint manager
-def get_endpoint_manager():
-    """Create and initialize an EndpointManager instance for dependency injection."""
-    load_config()
-    manager = EndpointManager()
-    manager.check_readiness()
-    return manager
+def get_endpoint_manager(request: Request):
+    """Get the endpoint manager shared by every request for dependency injection."""
+    return request.app.state.endpoint_manager
+
+async def call(method, *args, **kwargs):
+    """Call a method of the endpoint manager.
+    Blocking psycopg2 calls run in a thread, so concurrent requests don't wait for each other.
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    return await asyncio.to_thread(method, *args, **kwargs)
 
 @app.get("/")
 async def read_root():
     """Serve the main HTML page for the API."""
     return FileResponse("src/api/static/index.html")
 
+# pylint: disable=too-many-arguments
 @app.get("/endpoints", response_model=List[EndpointResponse])
 async def list_endpoints(
-    skip: int = Query(0, ge=0),
+    response: Response,
+    skip: int = Query(0, ge=0, deprecated=True, description="Skip this many endpoints, use cursor instead"),
+    cursor: int = Query(0, ge=0, description="List endpoints with an endpoint_id greater than this"),
     limit: int = Query(100, ge=1, le=100),
+    url_prefix: Optional[str] = Query(None, max_length=255),
+    min_interval: Optional[int] = Query(None, ge=5, le=300),
+    max_interval: Optional[int] = Query(None, ge=5, le=300),
+    has_regex: Optional[bool] = None,
+    manager: EndpointManager = Depends(get_endpoint_manager)
+):
+    """List endpoints a page at a time, filtered in the DB.
+    The X-Next-Cursor header holds the cursor of the next page, it is absent on the last page.
+    skip still pages by offset, for the clients written before the cursor.
+    """
+    try:
+        rows = await call(manager.list_endpoints, cursor, limit,
+                          url_prefix=url_prefix,
+                          min_interval=min_interval,
+                          max_interval=max_interval,
+                          has_regex=has_regex,
+                          offset=skip)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = str(rows[-1].endpoint_id)
+    return [row._asdict() for row in rows]
+
+@app.post("/endpoints:bulk")
+async def import_endpoints(
+    request: Request,
+    mode: str = Query("merge", pattern="^(merge|replace)$"),
     manager: EndpointManager = Depends(get_endpoint_manager)
 ):
-    """List all endpoints with pagination."""
+    """Import endpoints from an NDJSON or CSV body, one endpoint per line, matched by
+    endpoint_id when given, otherwise by (url, regex). merge inserts new endpoints and updates
+    the others, replace also deletes the endpoints not imported.
+    The import is applied entirely, or not at all if any line is invalid.
+    """
     try:
-        # Fetch all endpoints without partitioning
-        endpoints = manager.fetch_all_endpoints()
-        return endpoints[skip:skip+limit]
+        import_format = bulk.format_of(request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e)) from e
+    rows, errors = await bulk.read_import(request.stream(), import_format)
+    if errors:
+        raise HTTPException(status_code=422, detail={"valid_rows": len(rows), "errors": errors})
+    if not rows:
+        raise HTTPException(status_code=422, detail="No endpoints to import")
+    try:
+        return await call(manager.import_endpoints, rows, replace=mode == "replace")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
+@app.get("/endpoints:export")
+async def export_endpoints(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    manager: EndpointManager = Depends(get_endpoint_manager)
+):
+    """Export every endpoint as NDJSON or CSV, streamed from the DB."""
+    return StreamingResponse(bulk.stream_export(manager.export_endpoints, export_format),
+                             media_type=bulk.FORMATS[export_format])
+
 @app.post("/endpoints", response_model=EndpointResponse, status_code=201)
 async def create_endpoint(
     endpoint: EndpointCreate,
@@ -113,10 +220,12 @@ async def create_endpoint(
 ):
     """Create a new endpoint."""
     try:
-        new_endpoint = manager.create_endpoint(
+        new_endpoint = await call(
+            manager.create_endpoint,
             url=str(endpoint.url),
             regex=endpoint.regex,
-            interval=endpoint.interval
+            interval=endpoint.interval,
+            max_body_bytes=endpoint.max_body_bytes
         )
         return new_endpoint
     except Exception as e:
@@ -129,7 +238,7 @@ async def get_endpoint(
 ):
     """Get a specific endpoint by ID."""
     try:
-        endpoint = manager.get_endpoint(endpoint_id)
+        endpoint = await call(manager.get_endpoint, endpoint_id)
         if endpoint is None:
             raise HTTPException(status_code=404, detail="Endpoint not found")
         return endpoint
@@ -145,7 +254,7 @@ async def update_endpoint(
     """Update an existing endpoint."""
     try:
         # Check if endpoint exists
-        existing = manager.get_endpoint(endpoint_id)
+        existing = await call(manager.get_endpoint, endpoint_id)
         if existing is None:
             raise HTTPException(status_code=404, detail="Endpoint not found")
         
@@ -157,8 +266,10 @@ async def update_endpoint(
             update_data["regex"] = endpoint_update.regex
         if endpoint_update.interval is not None:
             update_data["interval"] = endpoint_update.interval
+        if endpoint_update.max_body_bytes is not None:
+            update_data["max_body_bytes"] = endpoint_update.max_body_bytes
         
-        updated_endpoint = manager.update_endpoint(endpoint_id, update_data)
+        updated_endpoint = await call(manager.update_endpoint, endpoint_id, update_data)
         return updated_endpoint
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
@@ -171,15 +282,83 @@ async def delete_endpoint(
     """Delete an endpoint."""
     try:
         # Check if endpoint exists
-        existing = manager.get_endpoint(endpoint_id)
+        existing = await call(manager.get_endpoint, endpoint_id)
         if existing is None:
             raise HTTPException(status_code=404, detail="Endpoint not found")
         
-        manager.delete_endpoint(endpoint_id)
+        await call(manager.delete_endpoint, endpoint_id)
         return None
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
+# Stats are read from the hourly aggregate of metrics, and cached for a few seconds
+stats_cache = stats.StatsCache()
+
+@app.get("/endpoints/{endpoint_id}/stats")
+async def get_endpoint_stats(
+    endpoint_id: int,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    bucket: str = "1h",
+    manager: EndpointManager = Depends(get_endpoint_manager)
+):
+    """Uptime, latency percentiles and status codes of an endpoint, per bucket and over the range.
+    The range defaults to the last day. Buckets are whole hours or days, e.g. 1h, 6h or 1d.
+    """
+    try:
+        bucket_interval = stats.parse_bucket(bucket)
+        start, end = stats.time_range(start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    if (end - start) / bucket_interval > stats.STATS_MAX_BUCKETS:
+        raise HTTPException(status_code=422, detail=f"A range has at most {stats.STATS_MAX_BUCKETS} buckets")
+
+    async def compute():
+        rows = await call(manager.endpoint_stats, endpoint_id, start, end, bucket_interval)
+        return {
+            "endpoint_id": endpoint_id,
+            "from": start,
+            "to": end,
+            "bucket": bucket,
+            "summary": stats.summarize(stats.merge(rows)),
+            "buckets": [{"time": row["time"], **stats.summarize(row)} for row in rows],
+        }
+    try:
+        return await stats_cache.get(("endpoint", endpoint_id, start, end, bucket_interval), compute)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+@app.get("/stats/summary")
+async def get_fleet_stats(
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    worst: int = Query(10, ge=0, le=100),
+    manager: EndpointManager = Depends(get_endpoint_manager)
+):
+    """Uptime, latency percentiles and status codes of every endpoint together over the range,
+    and the endpoints with the lowest uptime. The range defaults to the last day.
+    """
+    try:
+        start, end = stats.time_range(start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+
+    async def compute():
+        totals, worst_rows = await call(manager.fleet_stats, start, end, worst)
+        return {
+            "from": start,
+            "to": end,
+            "endpoints": totals["endpoints"],
+            "summary": stats.summarize(totals),
+            "worst": [{"endpoint_id": row["endpoint_id"],
+                       "uptime_percent": 100 * row["uptime"],
+                       "checks": row["checks"]} for row in worst_rows],
+        }
+    try:
+        return await stats_cache.get(("fleet", start, end, worst), compute)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
 if __name__ == "__main__":
     port = int(os.getenv("API_PORT", "8080"))
     uvicorn.run("src.api.main:app", host="0.0.0.0", port=port, reload=True)
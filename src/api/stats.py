@@ -0,0 +1,137 @@
+"""
+This module turns the hourly aggregates of metrics into uptime and latency stats for the API.
+1. Sum the counters of the aggregate and derive uptime and status code shares
+2. Interpolate latency percentiles from the cumulative histogram
+3. Cache responses for a few seconds, and compute a response once for concurrent identical requests
+"""
+import asyncio
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from src.endpoint_manager import LATENCY_BUCKETS_MS, LATENCY_COLUMNS, METRICS_AGGREGATE_COUNTERS
+
+# Seconds a stats response is served from the cache
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+# Responses cached at most
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "1024"))
+# Buckets a stats response has at most
+STATS_MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", "1000"))
+# Range of a stats request without from
+STATS_DEFAULT_RANGE = timedelta(days=1)
+
+PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+STATUS_COLUMNS = ("no_response", "status_2xx", "status_3xx", "status_4xx", "status_5xx")
+
+def parse_bucket(bucket: str) -> timedelta:
+    """Parse a bucket such as 1h, 6h or 7d. The aggregate is hourly, so buckets are whole hours."""
+    match = re.fullmatch(r"(\d+)([hd])", bucket)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("bucket must be a whole number of hours or days, e.g. 1h, 6h or 1d")
+    hours = int(match.group(1)) * (24 if match.group(2) == "d" else 1)
+    return timedelta(hours=hours)
+
+def time_range(start: Optional[datetime], end: Optional[datetime],
+               ttl: float = STATS_CACHE_TTL) -> Tuple[datetime, datetime]:
+    """Resolve the range of a request. Without an end, now is rounded up to the cache TTL,
+    so dashboards refreshing together share cached responses.
+    """
+    if end is None:
+        now = time.time()
+        end = datetime.fromtimestamp(math.ceil(now / ttl) * ttl if ttl > 0 else now, timezone.utc)
+    if start is None:
+        start = end - STATS_DEFAULT_RANGE
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if start >= end:
+        raise ValueError("from must be before to")
+    return start, end
+
+def merge(rows) -> Dict[str, Any]:
+    """Merge aggregated rows: counters and histograms add up, maxima take the max."""
+    merged = {column: 0 for column in METRICS_AGGREGATE_COUNTERS}
+    merged["duration_max"] = None
+    for row in rows:
+        for column in METRICS_AGGREGATE_COUNTERS:
+            merged[column] += row[column] or 0
+        if row["duration_max"] is not None:
+            merged["duration_max"] = max(merged["duration_max"] or 0.0, row["duration_max"])
+    return merged
+
+def percentile(row: Dict[str, Any], fraction: float) -> Optional[float]:
+    """Interpolate a duration percentile, in seconds, from the cumulative histogram of a row."""
+    durations = row.get("durations") or 0
+    if not durations:
+        return None
+    rank = fraction * durations
+    lower_bound, lower_count = 0.0, 0
+    for bound, column in zip(LATENCY_BUCKETS_MS, LATENCY_COLUMNS):
+        count = row[column] or 0
+        if count >= rank:
+            share = (rank - lower_count) / (count - lower_count) if count > lower_count else 1.0
+            return min((lower_bound + share * (bound - lower_bound)) / 1000, row.get("duration_max") or math.inf)
+        lower_bound, lower_count = bound, count
+    # Beyond the last bound, only the maximum is known
+    return row.get("duration_max")
+
+def summarize(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Uptime, percentiles and status code breakdown of an aggregated row."""
+    checks = row.get("checks") or 0
+    durations = row.get("durations") or 0
+    summary = {
+        "checks": checks,
+        "uptime_percent": 100 * row["up"] / checks if checks else None,
+        "regex_match_percent": 100 * row["regex_matched"] / checks if checks else None,
+        "mean_duration": row["duration_sum"] / durations if durations else None,
+        "max_duration": row.get("duration_max"),
+    }
+    for name, fraction in PERCENTILES.items():
+        summary[name] = percentile(row, fraction)
+    summary["status"] = {column: row.get(column) or 0 for column in STATUS_COLUMNS}
+    return summary
+
+# pylint: disable=too-few-public-methods
+class StatsCache:
+    """A small TTL cache of responses. Concurrent misses of a key wait for a single computation."""
+
+    def __init__(self, ttl: float = STATS_CACHE_TTL, size: int = STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, asyncio.Future]]" = OrderedDict()
+
+    async def get(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value of a key, or compute and cache it."""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return await asyncio.shield(entry[1])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now + self.ttl, future)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        try:
+            value = await compute()
+        except BaseException as e:
+            # Errors are not cached
+            if self._entries.get(key, (0, None))[1] is future:
+                del self._entries[key]
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                # Retrieved here, so it isn't logged as never retrieved without waiters
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        future.set_result(value)
+        return value
@@ -0,0 +1,376 @@
+"""This module is the asynchronous counterpart of the endpoint_manager module.
+It offers the same interface as EndpointManager on top of an asyncpg pool,
+so queries issued from coroutines don't block the event loop. asyncpg
+prepares every query once per connection and caches the statement.
+1. Ensure DB is ready
+2. Fetch sites from DB
+3. CRUD operations for endpoints
+4. Write metrics with binary COPY
+5. Keep the membership of workers with leases
+6. Log every change of endpoints, so workers apply them without reloading
+"""
+import asyncio
+import inspect
+import io
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncpg
+
+from src.endpoint import Endpoint, EndpointRow
+from src.endpoint_manager import (
+    EndpointManager,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    ENDPOINT_COLUMNS,
+    GET_ENDPOINT_QUERY,
+    CREATE_ENDPOINT_QUERY,
+    DELETE_ENDPOINT_QUERY,
+    update_endpoint_query,
+    update_columns,
+    list_endpoints_query,
+    ENDPOINTS_TABLE_NAME,
+    ENDPOINTS_TABLE_DDL,
+    ENDPOINTS_TABLE_MIGRATIONS,
+    METRICS_TABLE_NAME,
+    METRICS_TABLE_DDL,
+    METRICS_TABLE_MIGRATIONS,
+    METRICS_CHUNK_INTERVAL,
+    METRICS_COMPRESS_AFTER,
+    METRICS_AGGREGATE_DDL,
+    ENDPOINT_STATS_QUERY,
+    FLEET_STATS_QUERY,
+    FLEET_WORST_QUERY,
+    METRICS_REPLAY_TABLE_NAME,
+    METRICS_REPLAY_TABLE_DDL,
+    metrics_replay_insert,
+    ENDPOINTS_IMPORT_TABLE_NAME,
+    ENDPOINTS_IMPORT_COLUMNS,
+    ENDPOINTS_IMPORT_TABLE_DDL,
+    ENDPOINTS_IMPORT_LOCK,
+    ENDPOINTS_EXPORT_FORMATS,
+    import_statements,
+    WORKERS_TABLE_NAME,
+    WORKERS_TABLE_DDL,
+    WORKERS_RETENTION,
+    ENDPOINT_CHANGES_TABLE_NAME,
+    ENDPOINT_CHANGES_CHANNEL,
+    ENDPOINT_CHANGES_RETENTION,
+    ENDPOINT_CHANGES_DDL,
+    ENDPOINT_CHANGES_QUERY,
+    build_endpoint_change,
+    build_endpoints,
+)
+
+# "asyncpg" selects AsyncEndpointManager, anything else the psycopg2 EndpointManager
+DB_DRIVER = os.getenv("DB_DRIVER", "psycopg2")
+
+def use_async_driver() -> bool:
+    """Tell if the asyncpg backend is selected."""
+    return DB_DRIVER == "asyncpg"
+
+def create_endpoint_manager():
+    """Create the endpoint manager of the backend selected by DB_DRIVER."""
+    if use_async_driver():
+        return AsyncEndpointManager()
+    return EndpointManager()
+
+async def resolve(result):
+    """Await the result of an AsyncEndpointManager call, pass through the one of an EndpointManager.
+    It lets callers support both backends with the same code.
+    """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+async def call(method, *args, **kwargs):
+    """Call a method of an (Async)EndpointManager without blocking the event loop.
+    Blocking psycopg2 calls run in a thread, so the checks in flight keep being timed accurately.
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    return await asyncio.to_thread(method, *args, **kwargs)
+
+# It mirrors the public interface of EndpointManager
+# pylint: disable=too-many-public-methods
+class AsyncEndpointManager:
+    """
+    This class deals with the database and endpoint management, asynchronously.
+    """
+    def __init__(self,
+                 min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE):
+        """The pool is created by open(), as it must be created inside the event loop."""
+        self.min_size = min_size
+        self.max_size = max_size
+        self.connection_pool: Optional[asyncpg.Pool] = None
+        self._listener: Optional[asyncpg.Connection] = None
+
+    async def open(self):
+        """Create the connection pool."""
+        if self.connection_pool is None:
+            self.connection_pool = await asyncpg.create_pool(
+                min_size=self.min_size,
+                max_size=self.max_size,
+                database=os.getenv("DB_NAME"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                host=os.getenv("DB_HOST"),
+                port=int(os.getenv("DB_PORT", "5432"))
+            )
+        return self
+
+    async def close(self):
+        """Close the connection pool."""
+        if self._listener is not None:
+            await self._pool().release(self._listener)
+            self._listener = None
+        if self.connection_pool is not None:
+            await self.connection_pool.close()
+            self.connection_pool = None
+
+    def _pool(self) -> asyncpg.Pool:
+        if self.connection_pool is None:
+            raise RuntimeError("Database connection pool not initialized")
+        return self.connection_pool
+
+    async def _table_exists(self, conn, table_name: str) -> bool:
+        return await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = $1);",
+            table_name
+            )
+
+    async def assure_endpoint_table(self):
+        """Check if endpoint table is present"""
+        async with self._pool().acquire() as conn:
+            async with conn.transaction():
+                if not await self._table_exists(conn, ENDPOINTS_TABLE_NAME):
+                    await conn.execute(
+                        f"DROP SEQUENCE IF EXISTS {ENDPOINTS_TABLE_NAME}_endpoint_id_seq CASCADE;"
+                        )
+                    await conn.execute(ENDPOINTS_TABLE_DDL)
+                for migration in ENDPOINTS_TABLE_MIGRATIONS:
+                    await conn.execute(migration)
+                for statement in ENDPOINT_CHANGES_DDL:
+                    await conn.execute(statement)
+                await conn.execute(
+                    f"""DELETE FROM {ENDPOINT_CHANGES_TABLE_NAME}
+                    WHERE changed_at < now() - $1::text::interval;""",
+                    ENDPOINT_CHANGES_RETENTION
+                    )
+
+    async def assure_metrics_table(self):
+        """Check if the metrics hypertable is present."""
+        async with self._pool().acquire() as conn:
+            async with conn.transaction():
+                if not await self._table_exists(conn, METRICS_TABLE_NAME):
+                    await conn.execute("CREATE EXTENSION IF NOT EXISTS timescaledb;")
+                    await conn.execute(METRICS_TABLE_DDL)
+                    await conn.execute(
+                        f"""SELECT create_hypertable('{METRICS_TABLE_NAME}', 'time',
+                        chunk_time_interval => $1::text::interval, if_not_exists => TRUE);""",
+                        METRICS_CHUNK_INTERVAL
+                        )
+                    await conn.execute(
+                        f"""CREATE INDEX IF NOT EXISTS {METRICS_TABLE_NAME}_endpoint_id_time_idx
+                        ON {METRICS_TABLE_NAME} (endpoint_id, time DESC);"""
+                        )
+                    await conn.execute(f"""
+                        ALTER TABLE {METRICS_TABLE_NAME} SET (
+                            timescaledb.compress,
+                            timescaledb.compress_segmentby = 'endpoint_id',
+                            timescaledb.compress_orderby = 'time DESC'
+                            );
+                        """)
+                    await conn.execute(
+                        f"""SELECT add_compression_policy('{METRICS_TABLE_NAME}',
+                        $1::text::interval, if_not_exists => TRUE);""",
+                        METRICS_COMPRESS_AFTER
+                        )
+                for migration in METRICS_TABLE_MIGRATIONS:
+                    await conn.execute(migration)
+                for statement in METRICS_AGGREGATE_DDL:
+                    await conn.execute(statement)
+
+    async def assure_workers_table(self):
+        """Check if the membership table is present"""
+        await self._pool().execute(WORKERS_TABLE_DDL)
+
+    async def renew_lease(self, worker_id: str, lease_seconds: float) -> List[str]:
+        """Register or renew the lease of a worker, and return the ids of the live workers."""
+        async with self._pool().acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    f"""INSERT INTO {WORKERS_TABLE_NAME} (worker_id, lease_expires_at)
+                    VALUES ($1, now() + make_interval(secs => $2))
+                    ON CONFLICT (worker_id) DO UPDATE
+                    SET heartbeat_at = now(), lease_expires_at = EXCLUDED.lease_expires_at;""",
+                    worker_id, float(lease_seconds)
+                    )
+                await conn.execute(
+                    f"""DELETE FROM {WORKERS_TABLE_NAME}
+                    WHERE lease_expires_at < now() - $1::text::interval;""",
+                    WORKERS_RETENTION
+                    )
+                rows = await conn.fetch(
+                    f"""SELECT worker_id FROM {WORKERS_TABLE_NAME}
+                    WHERE lease_expires_at > now() ORDER BY worker_id;"""
+                    )
+        return [row[0] for row in rows]
+
+    async def release_lease(self, worker_id: str) -> None:
+        """Leave the membership, so other workers take over right away."""
+        await self._pool().execute(
+            f"DELETE FROM {WORKERS_TABLE_NAME} WHERE worker_id = $1;",
+            worker_id
+            )
+
+    async def latest_change_version(self) -> int:
+        """Get the version of the last change of endpoints, 0 if none."""
+        return await self._pool().fetchval(
+            f"SELECT COALESCE(MAX(version), 0) FROM {ENDPOINT_CHANGES_TABLE_NAME};"
+            )
+
+    async def fetch_endpoint_changes(self, after_version: int,
+                                     limit: int) -> List[Tuple[int, int, Optional[Endpoint]]]:
+        """Fetch the changes of endpoints after a version, as (version, endpoint_id, endpoint or None)."""
+        rows = await self._pool().fetch(
+            ENDPOINT_CHANGES_QUERY.format(after="$1", limit="$2"), int(after_version), int(limit)
+            )
+        return [build_endpoint_change(row) for row in rows]
+
+    async def listen_endpoint_changes(self, callback: Callable[[int], None]):
+        """Call callback(version) for every change of endpoints notified.
+        It holds one connection of the pool until close().
+        """
+        if self._listener is None:
+            self._listener = await self._pool().acquire()
+        await self._listener.add_listener(
+            ENDPOINT_CHANGES_CHANNEL,
+            lambda _conn, _pid, _channel, payload: callback(int(payload))
+            )
+
+    async def fetch_endpoints(self, partition_count: int, partition_id: int) -> List[Endpoint]:
+        """Fetch URLs to be monitored by one partition."""
+        rows = await self._pool().fetch(
+            f"""SELECT {ENDPOINT_COLUMNS} FROM
+            {ENDPOINTS_TABLE_NAME}
+            WHERE endpoint_id % $1 = $2;""",
+            int(partition_count), int(partition_id)
+            )
+        return build_endpoints(rows)
+
+    async def fetch_all_endpoints(self) -> List[Endpoint]:
+        """Fetch all endpoints from the database."""
+        rows = await self._pool().fetch(
+            f"SELECT {ENDPOINT_COLUMNS} FROM {ENDPOINTS_TABLE_NAME};"
+            )
+        return build_endpoints(rows)
+
+    # pylint: disable=too-many-arguments
+    async def list_endpoints(self, after: int, limit: int,
+                             url_prefix: Optional[str] = None,
+                             min_interval: Optional[int] = None,
+                             max_interval: Optional[int] = None,
+                             has_regex: Optional[bool] = None,
+                             offset: int = 0) -> List[EndpointRow]:
+        """List a page of endpoints after the endpoint_id cursor, as rows without compiled regex."""
+        _, query, params = list_endpoints_query(after, limit, url_prefix, min_interval, max_interval,
+                                                has_regex, offset)
+        rows = await self._pool().fetch(query, *params)
+        return [EndpointRow(*row) for row in rows]
+
+    async def get_endpoint(self, endpoint_id: int) -> Optional[Endpoint]:
+        """Get a specific endpoint by ID."""
+        row = await self._pool().fetchrow(GET_ENDPOINT_QUERY, endpoint_id)
+        if row:
+            return Endpoint(*row)
+        return None
+
+    async def create_endpoint(self, url: str, regex: Optional[str], interval: int,
+                              max_body_bytes: Optional[int] = None) -> Endpoint:
+        """Create a new endpoint."""
+        row = await self._pool().fetchrow(CREATE_ENDPOINT_QUERY, url, regex, interval, max_body_bytes)
+        return Endpoint(*row)
+
+    async def update_endpoint(self, endpoint_id: int, update_data: Dict[str, Any]) -> Endpoint:
+        """Update an existing endpoint."""
+        if not update_data:
+            return await self.get_endpoint(endpoint_id)
+
+        # The same query text for the same set of columns, so its prepared statement is reused
+        columns = update_columns(update_data)
+        values = [update_data[column] for column in columns] + [endpoint_id]
+        row = await self._pool().fetchrow(update_endpoint_query(columns), *values)
+        if not row:
+            raise ValueError(f"Endpoint with ID {endpoint_id} not found")
+        return Endpoint(*row)
+
+    async def delete_endpoint(self, endpoint_id: int) -> None:
+        """Delete an endpoint."""
+        status = await self._pool().execute(DELETE_ENDPOINT_QUERY, endpoint_id)
+        # asyncpg returns the command tag, e.g. "DELETE 1"
+        if status.split()[-1] == "0":
+            raise ValueError(f"Endpoint with ID {endpoint_id} not found")
+
+    async def copy_metrics(self, columns: Sequence[str], payload: bytes):
+        """Write metrics already encoded in the binary COPY format."""
+        async with self._pool().acquire() as conn:
+            await conn.copy_to_table(METRICS_TABLE_NAME, source=io.BytesIO(payload),
+                                     columns=list(columns), format="binary")
+
+    async def replay_metrics(self, columns: Sequence[str], payload: bytes) -> int:
+        """Write replayed metrics encoded in the binary COPY format, skipping those already stored.
+        It returns the number of rows inserted.
+        """
+        async with self._pool().acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(METRICS_REPLAY_TABLE_DDL)
+                await conn.copy_to_table(METRICS_REPLAY_TABLE_NAME, source=io.BytesIO(payload),
+                                         columns=list(columns), format="binary")
+                status = await conn.execute(metrics_replay_insert(columns))
+        return int(status.split()[-1])
+
+    async def endpoint_stats(self, endpoint_id: int, start, end, bucket) -> List[Dict[str, Any]]:
+        """Aggregated metrics of an endpoint between two datetimes, per bucket (a timedelta of whole hours)."""
+        rows = await self._pool().fetch(ENDPOINT_STATS_QUERY, endpoint_id, bucket, start, end)
+        return [dict(row) for row in rows]
+
+    async def fleet_stats(self, start, end, worst: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Aggregated metrics of every endpoint between two datetimes, and the worst endpoints by uptime."""
+        totals = await self._pool().fetchrow(FLEET_STATS_QUERY, start, end)
+        rows = await self._pool().fetch(FLEET_WORST_QUERY, start, end, worst)
+        return dict(totals), [dict(row) for row in rows]
+
+    async def import_endpoints(self, rows: Sequence[Sequence[Any]], replace: bool = False) -> Dict[str, int]:
+        """Merge validated rows (line, endpoint_id, url, regex, interval, max_body_bytes) into
+        endpoints, by endpoint_id when given, otherwise by (url, regex). With replace, endpoints
+        not imported are deleted. It is a single transaction, and it returns the number of rows
+        deleted, updated and inserted.
+        """
+        counts = {"rows": len(rows), "deleted": 0, "updated": 0, "inserted": 0}
+        async with self._pool().acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(ENDPOINTS_IMPORT_TABLE_DDL)
+                await conn.copy_records_to_table(ENDPOINTS_IMPORT_TABLE_NAME, records=rows,
+                                                 columns=list(ENDPOINTS_IMPORT_COLUMNS))
+                await conn.execute(f"ANALYZE {ENDPOINTS_IMPORT_TABLE_NAME};")
+                await conn.execute(ENDPOINTS_IMPORT_LOCK)
+                for counter, statement in import_statements(replace):
+                    status = await conn.execute(statement)
+                    if counter:
+                        counts[counter] = int(status.split()[-1])
+        return counts
+
+    async def export_endpoints(self, export_format: str, write: Callable[[bytes], Awaitable[Any]]):
+        """Stream every endpoint in one of ENDPOINTS_EXPORT_FORMATS with COPY, awaiting write for each chunk."""
+        query, options = ENDPOINTS_EXPORT_FORMATS[export_format]
+        async with self._pool().acquire() as conn:
+            await conn.copy_from_query(query, output=write, **options)
+
+    async def check_readiness(self):
+        """Ensure DB tables are ready."""
+        await self.open()
+        await self.assure_endpoint_table()
+        await self.assure_metrics_table()
+        await self.assure_workers_table()
+        return self
@@ -1,34 +1,95 @@
 """
 This module contains the Endpoint class"""
 import re
+import sys
+import weakref
+from typing import NamedTuple, Optional
+from urllib.parse import urlsplit
+
+# Process-wide intern table of compiled patterns.
+# 20k endpoints sharing ".*welcome" share a single compiled pattern, and the
+# entry goes away with the last endpoint using it.
+_compiled_patterns = weakref.WeakValueDictionary()
+
+def compile_pattern(regex):
+    """Compile a regex, or return the compiled pattern already shared by other endpoints."""
+    compiled = _compiled_patterns.get(regex)
+    if compiled is None:
+        compiled = re.compile(regex)
+        _compiled_patterns[regex] = compiled
+    return compiled
+
+def intern_url(url):
+    """Share one string object between the endpoints and checks of the same URL."""
+    return sys.intern(url)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def origin_of(url):
+    """The lowercase "host:port" a URL is sent to, shared by the endpoints of the same origin."""
+    parts = urlsplit(url)
+    try:
+        port = parts.port or DEFAULT_PORTS.get(parts.scheme.lower(), 0)
+    except ValueError:
+        return sys.intern(parts.netloc.lower())
+    return sys.intern(f"{parts.hostname or ''}:{port}")
 
 # pylint: disable=too-few-public-methods
 class Endpoint:
     """
-    An Endpoint is a URL with 
+    An Endpoint is a URL with
         1. a regex to match against the response body.
         2. an interval to send requests.
+        3. optionally, the number of body bytes read at most to evaluate the regex.
+    Endpoints are slotted since a worker holds tens of thousands of them.
+    The origin of the URL is computed once, for the per-host limits of checks.
+    The regex is kept only as its compiled pattern, and the attribute is
+    absent if the endpoint has no regex.
     """
-    def __init__(self, endpoint_id, url, regex, interval):
+    __slots__ = ("endpoint_id", "url", "origin", "regex", "interval", "max_body_bytes")
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, endpoint_id, url, regex, interval, max_body_bytes=None):
         """Never trust the DB, always validate your input"""
         assert endpoint_id, "id is required"
         assert url, "url is required"
         assert interval, "interval is required"
         assert 5 <= interval <= 300, "interval must be greater than 5 and less than 300"
+        assert max_body_bytes is None or max_body_bytes > 0, "max_body_bytes must be positive"
 
         self.endpoint_id = endpoint_id
-        self.url = url
-        self.regex = regex  # Store the regex pattern as a string
-        self._compiled_regex = re.compile(regex) if regex else None  # Store compiled regex separately
+        self.url = intern_url(url)
+        self.origin = origin_of(self.url)
+        if regex:
+            self.regex = compile_pattern(regex)
         self.interval = interval
+        self.max_body_bytes = max_body_bytes  # None means the process-wide default
 
     @property
     def regex_pattern(self):
-        """Get the regex pattern as a string."""
-        return self.regex
+        """Get the regex pattern as a string, None if there is no regex."""
+        compiled = getattr(self, "regex", None)
+        return compiled.pattern if compiled is not None else None
 
     def matches(self, text):
         """Check if the text matches the regex pattern."""
-        if not self._compiled_regex:
+        compiled = getattr(self, "regex", None)
+        if compiled is None:
             return True
-        return bool(self._compiled_regex.search(text))
+        return bool(compiled.search(text))
+
+    def search(self, text, pos=0):
+        """Search the regex pattern in text from pos, the way re.Pattern.search does."""
+        return self.regex.search(text, pos)
+
+class EndpointRow(NamedTuple):
+    """
+    An endpoint as stored, for listing and exporting.
+    Unlike Endpoint, it is not validated and its regex is not compiled,
+    so serializing a page of endpoints costs no re.compile call.
+    """
+    endpoint_id: int
+    url: str
+    regex: Optional[str]
+    interval: int
+    max_body_bytes: Optional[int]
@@ -2,48 +2,479 @@
 1. Ensure DB is ready
 2. Fetch sites from DB
 3. CRUD operations for endpoints
+4. Create the metrics hypertable
+5. Keep the membership of workers with leases
+6. Log every change of endpoints, so workers apply them without reloading
+7. Prepare the CRUD queries once per connection of a thread-safe pool
+8. Import and export endpoints in bulk with COPY
+9. Aggregate metrics hourly in a continuous aggregate, and read uptime and latency stats from it
 """
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Sequence, Callable
+import io
 import os
 import re
+import threading
+import types
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import psycopg2.pool
 
 from src.utils import logger
-from src.endpoint import Endpoint
+from src.endpoint import Endpoint, EndpointRow
 
 ENDPOINTS_TABLE_NAME = 'endpoints'
+METRICS_TABLE_NAME = 'metrics'
+WORKERS_TABLE_NAME = 'workers'
+ENDPOINT_CHANGES_TABLE_NAME = 'endpoint_changes'
+ENDPOINT_CHANGES_CHANNEL = 'endpoint_changes'
+# Changes older than this are pruned, a worker down for longer reloads everything anyway
+ENDPOINT_CHANGES_RETENTION = os.getenv("ENDPOINT_CHANGES_RETENTION", "1 day")
+# Checks of 20k endpoints every 5-30s produce a few GB per day uncompressed
+METRICS_CHUNK_INTERVAL = os.getenv("METRICS_CHUNK_INTERVAL", "1 day")
+METRICS_COMPRESS_AFTER = os.getenv("METRICS_COMPRESS_AFTER", "7 days")
 
+# Connections of the pool, shared by the threads and coroutines of a process
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+
+# Columns of an endpoint, in the order expected by the Endpoint constructor
+ENDPOINT_COLUMNS = "endpoint_id, url, regex, interval, max_body_bytes"
+# Columns an update may set
+ENDPOINT_UPDATABLE_COLUMNS = ("url", "regex", "interval", "max_body_bytes")
+
+# CRUD queries, prepared once per connection. Parameters are numbered the PostgreSQL way.
+GET_ENDPOINT_QUERY = f"SELECT {ENDPOINT_COLUMNS} FROM {ENDPOINTS_TABLE_NAME} WHERE endpoint_id = $1"
+CREATE_ENDPOINT_QUERY = f"""INSERT INTO {ENDPOINTS_TABLE_NAME} (url, regex, interval, max_body_bytes)
+    VALUES ($1, $2, $3, $4)
+    RETURNING {ENDPOINT_COLUMNS}"""
+DELETE_ENDPOINT_QUERY = f"DELETE FROM {ENDPOINTS_TABLE_NAME} WHERE endpoint_id = $1"
+
+def update_columns(update_data: Dict[str, Any]) -> List[str]:
+    """The columns of an update in a fixed order, so each set of columns has a single query text."""
+    for column in update_data:
+        if column not in ENDPOINT_UPDATABLE_COLUMNS:
+            raise ValueError(f"Unknown endpoint column {column}")
+    return [column for column in ENDPOINT_UPDATABLE_COLUMNS if column in update_data]
+
+def update_endpoint_query(columns: Sequence[str]) -> str:
+    """The update of some columns of an endpoint, the endpoint_id being the last parameter."""
+    set_clauses = [f"{column} = ${index}" for index, column in enumerate(columns, start=1)]
+    return f"""UPDATE {ENDPOINTS_TABLE_NAME}
+    SET {', '.join(set_clauses)}
+    WHERE endpoint_id = ${len(columns) + 1}
+    RETURNING {ENDPOINT_COLUMNS}"""
+
+def escape_like(value: str) -> str:
+    """Escape the wildcards of a LIKE pattern."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# pylint: disable=too-many-arguments
+def list_endpoints_query(after: int, limit: int,
+                         url_prefix: Optional[str] = None,
+                         min_interval: Optional[int] = None,
+                         max_interval: Optional[int] = None,
+                         has_regex: Optional[bool] = None,
+                         offset: int = 0) -> Tuple[str, str, List[Any]]:
+    """A page of endpoints after the endpoint_id cursor, matching the filters given.
+    It returns a statement name unique per combination of filters, the query and its parameters.
+    The primary key walks the pages, so a page costs the same at any depth. The deprecated
+    offset skips rows after the cursor, and costs as many rows as it skips.
+    """
+    conditions = ["endpoint_id > $1"]
+    params: List[Any] = [after]
+    name = "list_endpoints"
+
+    def parameter(value) -> str:
+        params.append(value)
+        return f"${len(params)}"
+
+    if url_prefix:
+        conditions.append(f"url LIKE {parameter(escape_like(url_prefix) + '%')}")
+        name += "_prefix"
+    if min_interval is not None:
+        conditions.append(f"interval >= {parameter(min_interval)}")
+        name += "_min"
+    if max_interval is not None:
+        conditions.append(f"interval <= {parameter(max_interval)}")
+        name += "_max"
+    if has_regex is not None:
+        conditions.append("COALESCE(regex, '') <> ''" if has_regex else "COALESCE(regex, '') = ''")
+        name += "_regex" if has_regex else "_noregex"
+    query = f"""SELECT {ENDPOINT_COLUMNS} FROM {ENDPOINTS_TABLE_NAME}
+    WHERE {' AND '.join(conditions)}
+    ORDER BY endpoint_id
+    LIMIT {parameter(limit)}"""
+    if offset:
+        query += f" OFFSET {parameter(offset)}"
+        name += "_offset"
+    return name, query, params
+
+ENDPOINTS_TABLE_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {ENDPOINTS_TABLE_NAME} (
+        endpoint_id SERIAL PRIMARY KEY,
+        url VARCHAR(255) not null,
+        regex VARCHAR(255),
+        interval INT CHECK (interval >= 5 AND interval <= 300),
+        max_body_bytes INT CHECK (max_body_bytes > 0)
+        );
+    """
+# Columns added after the first release, applied to tables created before them
+ENDPOINTS_TABLE_MIGRATIONS = [
+    f"""ALTER TABLE {ENDPOINTS_TABLE_NAME}
+    ADD COLUMN IF NOT EXISTS max_body_bytes INT CHECK (max_body_bytes > 0);""",
+    # URL prefix filters of the API
+    f"""CREATE INDEX IF NOT EXISTS {ENDPOINTS_TABLE_NAME}_url_prefix_idx
+    ON {ENDPOINTS_TABLE_NAME} (url varchar_pattern_ops);""",
+]
+
+# Every insert, update and delete of an endpoint is logged with an increasing version by a
+# trigger, so changes made by the API, bulk imports or psql alike reach the workers.
+# The version is also sent as a NOTIFY, so listening workers apply it right away.
+ENDPOINT_CHANGES_DDL = [
+    f"""CREATE TABLE IF NOT EXISTS {ENDPOINT_CHANGES_TABLE_NAME} (
+        version BIGSERIAL PRIMARY KEY,
+        endpoint_id INT NOT NULL,
+        operation VARCHAR(6) NOT NULL,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );""",
+    f"""CREATE OR REPLACE FUNCTION log_endpoint_change() RETURNS trigger AS $$
+    DECLARE
+        changed_version BIGINT;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO {ENDPOINT_CHANGES_TABLE_NAME} (endpoint_id, operation)
+            VALUES (OLD.endpoint_id, TG_OP) RETURNING version INTO changed_version;
+        ELSE
+            INSERT INTO {ENDPOINT_CHANGES_TABLE_NAME} (endpoint_id, operation)
+            VALUES (NEW.endpoint_id, TG_OP) RETURNING version INTO changed_version;
+        END IF;
+        PERFORM pg_notify('{ENDPOINT_CHANGES_CHANNEL}', changed_version::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;""",
+    f"DROP TRIGGER IF EXISTS {ENDPOINTS_TABLE_NAME}_change_log ON {ENDPOINTS_TABLE_NAME};",
+    f"""CREATE TRIGGER {ENDPOINTS_TABLE_NAME}_change_log
+    AFTER INSERT OR UPDATE OR DELETE ON {ENDPOINTS_TABLE_NAME}
+    FOR EACH ROW EXECUTE FUNCTION log_endpoint_change();""",
+]
+
+# Changes after a version, with the current row of the endpoint, NULL if it was deleted
+ENDPOINT_CHANGES_QUERY = f"""
+    SELECT c.version, c.endpoint_id, {', '.join(f"e.{column}" for column in ENDPOINT_COLUMNS.split(', ')[1:])}
+    FROM {ENDPOINT_CHANGES_TABLE_NAME} c
+    LEFT JOIN {ENDPOINTS_TABLE_NAME} e ON e.endpoint_id = c.endpoint_id
+    WHERE c.version > {{after}}
+    ORDER BY c.version
+    LIMIT {{limit}};
+    """
+
+def build_endpoint_change(row) -> Tuple[int, int, Optional[Endpoint]]:
+    """Build (version, endpoint_id, endpoint) from a change row, endpoint is None if deleted or invalid."""
+    version, endpoint_id, url = row[0], row[1], row[2]
+    if url is None:
+        return version, endpoint_id, None
+    try:
+        return version, endpoint_id, Endpoint(endpoint_id, *row[2:])
+    except (re.error, AssertionError) as e:
+        # An endpoint made invalid is unscheduled
+        logger.warning(e)
+        return version, endpoint_id, None
+
+def build_endpoints(rows: Sequence[Sequence[Any]]) -> List[Endpoint]:
+    """Build endpoints from DB rows. Invalid regex will be ignored."""
+    endpoints = []
+    for row in rows:
+        try:
+            endpoints.append(Endpoint(*row))
+        except re.error as e:
+            logger.warning(e)
+            continue
+    return endpoints
+
+METRICS_TABLE_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {METRICS_TABLE_NAME} (
+        time TIMESTAMPTZ NOT NULL,
+        endpoint_id INT NOT NULL,
+        status_code SMALLINT,
+        duration DOUBLE PRECISION,
+        regex_match BOOLEAN,
+        bytes_read INT,
+        truncated BOOLEAN,
+        regex_timed_out BOOLEAN,
+        dns_us INT,
+        connect_us INT,
+        tls_us INT,
+        ttfb_us INT,
+        transfer_us INT,
+        late BOOLEAN
+        );
+    """
+# Columns added after the first release, applied to tables created before them
+METRICS_TABLE_MIGRATIONS = [
+    f"ALTER TABLE {METRICS_TABLE_NAME} ADD COLUMN IF NOT EXISTS bytes_read INT;",
+    f"ALTER TABLE {METRICS_TABLE_NAME} ADD COLUMN IF NOT EXISTS truncated BOOLEAN;",
+    f"ALTER TABLE {METRICS_TABLE_NAME} ADD COLUMN IF NOT EXISTS regex_timed_out BOOLEAN;",
+    # Phases of a check in microseconds, NULL when not reached or not known
+    *(f"ALTER TABLE {METRICS_TABLE_NAME} ADD COLUMN IF NOT EXISTS {phase}_us INT;"
+      for phase in ("dns", "connect", "tls", "ttfb", "transfer")),
+    f"ALTER TABLE {METRICS_TABLE_NAME} ADD COLUMN IF NOT EXISTS late BOOLEAN;",
+]
+
+# Metrics are aggregated per endpoint and hour by TimescaleDB, so stats over months read
+# 20k rows per hour instead of every check. Recent hours not materialized yet are
+# aggregated from the raw metrics on the fly.
+METRICS_HOURLY_VIEW_NAME = 'metrics_hourly'
+# Hours refreshed by the policy, wide enough for the metrics replayed from a spool
+METRICS_AGGREGATE_REFRESH_WINDOW = os.getenv("METRICS_AGGREGATE_REFRESH_WINDOW", "1 day")
+# Upper bounds of the latency histogram, in milliseconds. Percentiles are interpolated in between.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+LATENCY_COLUMNS = tuple(f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS)
+# Counters of the aggregate, summed over buckets and endpoints
+METRICS_AGGREGATE_COUNTERS = {
+    "checks": "count(*)",
+    # Up is a 200 response matching the regex of the endpoint, if it has one. Checks of
+    # endpoints without a regex are stored with regex_match NULL.
+    "up": "count(*) FILTER (WHERE status_code = 200 AND regex_match IS NOT FALSE)",
+    "regex_matched": "count(*) FILTER (WHERE regex_match)",
+    # Timeouts and connection errors are stored with status code 0
+    "no_response": "count(*) FILTER (WHERE status_code = 0 OR status_code IS NULL)",
+    "status_2xx": "count(*) FILTER (WHERE status_code BETWEEN 200 AND 299)",
+    "status_3xx": "count(*) FILTER (WHERE status_code BETWEEN 300 AND 399)",
+    "status_4xx": "count(*) FILTER (WHERE status_code BETWEEN 400 AND 499)",
+    "status_5xx": "count(*) FILTER (WHERE status_code >= 500)",
+    "durations": "count(duration)",
+    "duration_sum": "sum(duration)",
+    # Cumulative, le_100ms counts the durations up to 100ms
+    **{column: f"count(*) FILTER (WHERE duration <= {bound / 1000})"
+       for column, bound in zip(LATENCY_COLUMNS, LATENCY_BUCKETS_MS)},
+}
+METRICS_AGGREGATE_DDL = [
+    f"""CREATE MATERIALIZED VIEW IF NOT EXISTS {METRICS_HOURLY_VIEW_NAME}
+    WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+    SELECT time_bucket(INTERVAL '1 hour', time) AS bucket,
+        endpoint_id,
+        {', '.join(f"{expression} AS {column}" for column, expression in METRICS_AGGREGATE_COUNTERS.items())},
+        max(duration) AS duration_max
+    FROM {METRICS_TABLE_NAME}
+    GROUP BY bucket, endpoint_id
+    WITH NO DATA;""",
+    f"""SELECT add_continuous_aggregate_policy('{METRICS_HOURLY_VIEW_NAME}',
+    start_offset => INTERVAL '{METRICS_AGGREGATE_REFRESH_WINDOW}',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes',
+    if_not_exists => TRUE);""",
+]
+
+def _aggregate_sums() -> str:
+    sums = [f"sum({column})::{'double precision' if column == 'duration_sum' else 'bigint'} AS {column}"
+            for column in METRICS_AGGREGATE_COUNTERS]
+    return ", ".join(sums + ["max(duration_max) AS duration_max"])
+
+# Stats of an endpoint per bucket, a whole number of hours
+ENDPOINT_STATS_QUERY = f"""SELECT time_bucket($2::interval, bucket) AS time, {_aggregate_sums()}
+    FROM {METRICS_HOURLY_VIEW_NAME}
+    WHERE endpoint_id = $1 AND bucket >= $3::timestamptz AND bucket < $4::timestamptz
+    GROUP BY 1
+    ORDER BY 1"""
+# Stats of every endpoint together
+FLEET_STATS_QUERY = f"""SELECT count(DISTINCT endpoint_id) AS endpoints, {_aggregate_sums()}
+    FROM {METRICS_HOURLY_VIEW_NAME}
+    WHERE bucket >= $1::timestamptz AND bucket < $2::timestamptz"""
+# The endpoints with the lowest uptime
+FLEET_WORST_QUERY = f"""SELECT endpoint_id, sum(up)::double precision / sum(checks) AS uptime, sum(checks) AS checks
+    FROM {METRICS_HOURLY_VIEW_NAME}
+    WHERE bucket >= $1::timestamptz AND bucket < $2::timestamptz
+    GROUP BY endpoint_id
+    ORDER BY uptime, endpoint_id
+    LIMIT $3"""
+
+# A worker is live while its lease hasn't expired, it renews it with every heartbeat
+WORKERS_TABLE_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {WORKERS_TABLE_NAME} (
+        worker_id VARCHAR(255) PRIMARY KEY,
+        started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lease_expires_at TIMESTAMPTZ NOT NULL
+        );
+    """
+# Workers gone for this long are forgotten
+WORKERS_RETENTION = "1 hour"
+
+# Rows replayed from the spool may have been stored before a crash. They are copied
+# into a temporary table first, and only inserted if their (endpoint_id, time) is new.
+METRICS_REPLAY_TABLE_NAME = 'metrics_replay'
+METRICS_REPLAY_TABLE_DDL = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {METRICS_REPLAY_TABLE_NAME}
+    (LIKE {METRICS_TABLE_NAME}) ON COMMIT DELETE ROWS;
+    """
+
+def metrics_replay_insert(columns) -> str:
+    """Build the INSERT of the replayed rows whose (endpoint_id, time) is not stored yet."""
+    replayed = ", ".join(f"r.{column}" for column in columns)
+    return f"""
+    INSERT INTO {METRICS_TABLE_NAME} ({', '.join(columns)})
+    SELECT DISTINCT ON (r.endpoint_id, r.time) {replayed}
+    FROM {METRICS_REPLAY_TABLE_NAME} r
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {METRICS_TABLE_NAME} m
+        WHERE m.endpoint_id = r.endpoint_id AND m.time = r.time);
+    """
+
+# Imported endpoints are copied to a staging table, then merged into endpoints in the same
+# transaction, so an import is applied entirely or not at all. URLs are not unique: a row is
+# matched by its endpoint_id when it has one, otherwise by its (url, regex).
+ENDPOINTS_IMPORT_TABLE_NAME = 'endpoints_import'
+ENDPOINTS_IMPORT_COLUMNS = ("line", "endpoint_id", "url", "regex", "interval", "max_body_bytes")
+ENDPOINTS_IMPORT_TABLE_DDL = f"""
+    CREATE TEMPORARY TABLE {ENDPOINTS_IMPORT_TABLE_NAME} (
+        line INT,
+        endpoint_id INT,
+        url VARCHAR(255),
+        regex VARCHAR(255),
+        interval INT,
+        max_body_bytes INT
+        ) ON COMMIT DROP;
+    """
+# Staged rows are resolved to the endpoint they update first, NULL for new endpoints.
+# An unknown endpoint_id makes a new endpoint. No regex and an empty one are the same.
+ENDPOINTS_IMPORT_RESOLVE = [
+    f"""UPDATE {ENDPOINTS_IMPORT_TABLE_NAME} i SET endpoint_id = NULL
+    WHERE i.endpoint_id IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM {ENDPOINTS_TABLE_NAME} e WHERE e.endpoint_id = i.endpoint_id);""",
+    f"""UPDATE {ENDPOINTS_IMPORT_TABLE_NAME} i SET endpoint_id = e.endpoint_id
+    FROM (
+        SELECT DISTINCT ON (url, COALESCE(regex, '')) endpoint_id, url, COALESCE(regex, '') AS regex
+        FROM {ENDPOINTS_TABLE_NAME}
+        ORDER BY url, COALESCE(regex, ''), endpoint_id) e
+    WHERE i.endpoint_id IS NULL AND i.url = e.url AND COALESCE(i.regex, '') = e.regex;""",
+]
+# The last line of an endpoint imported several times wins
+_IMPORTED_ENDPOINTS = f"""(
+    SELECT DISTINCT ON (endpoint_id, key_url, key_regex) line, endpoint_id, url, regex, interval, max_body_bytes
+    FROM (
+        SELECT *,
+        CASE WHEN endpoint_id IS NULL THEN url END AS key_url,
+        CASE WHEN endpoint_id IS NULL THEN COALESCE(regex, '') END AS key_regex
+        FROM {ENDPOINTS_IMPORT_TABLE_NAME}) keyed
+    ORDER BY endpoint_id, key_url, key_regex, line DESC) i"""
+# Statements applying a resolved import, by counter. Replace-all deletes the endpoints absent
+# from the import. Unchanged endpoints are not touched, so they are not rescheduled by the workers.
+ENDPOINTS_IMPORT_STATEMENTS = {
+    "deleted": f"""DELETE FROM {ENDPOINTS_TABLE_NAME} e
+    WHERE NOT EXISTS (SELECT 1 FROM {ENDPOINTS_IMPORT_TABLE_NAME} i WHERE i.endpoint_id = e.endpoint_id);""",
+    "updated": f"""UPDATE {ENDPOINTS_TABLE_NAME} e
+    SET url = i.url, regex = i.regex, interval = i.interval, max_body_bytes = i.max_body_bytes
+    FROM {_IMPORTED_ENDPOINTS}
+    WHERE e.endpoint_id = i.endpoint_id
+    AND (e.url, e.regex, e.interval, e.max_body_bytes)
+        IS DISTINCT FROM (i.url, i.regex, i.interval, i.max_body_bytes);""",
+    "inserted": f"""INSERT INTO {ENDPOINTS_TABLE_NAME} (url, regex, interval, max_body_bytes)
+    SELECT i.url, i.regex, i.interval, i.max_body_bytes
+    FROM {_IMPORTED_ENDPOINTS}
+    WHERE i.endpoint_id IS NULL
+    ORDER BY i.line;""",
+}
+# Imports are serialized, reads and the checks go on meanwhile
+ENDPOINTS_IMPORT_LOCK = f"LOCK TABLE {ENDPOINTS_TABLE_NAME} IN SHARE ROW EXCLUSIVE MODE;"
+
+def import_statements(replace: bool) -> List[Tuple[Optional[str], str]]:
+    """The (counter, statement) pairs applying a staged import, None for uncounted statements."""
+    counters = ["deleted", "updated", "inserted"] if replace else ["updated", "inserted"]
+    return ([(None, statement) for statement in ENDPOINTS_IMPORT_RESOLVE]
+            + [(counter, ENDPOINTS_IMPORT_STATEMENTS[counter]) for counter in counters])
+
+def _copy_text_value(value) -> str:
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def to_copy_text(rows: Sequence[Sequence[Any]]) -> str:
+    """Encode rows in the text COPY format."""
+    return "".join("\t".join(_copy_text_value(value) for value in row) + "\n" for row in rows)
+
+# Export formats, by name: the query exported and its COPY options, named the asyncpg way
+ENDPOINTS_EXPORT_QUERY = f"SELECT {ENDPOINT_COLUMNS} FROM {ENDPOINTS_TABLE_NAME} ORDER BY endpoint_id"
+ENDPOINTS_EXPORT_FORMATS = {
+    "csv": (ENDPOINTS_EXPORT_QUERY, {"format": "csv", "header": True}),
+    # One JSON object per line. JSON escapes every control character, so with control
+    # characters as delimiter and quote, the csv format never quotes or alters the lines.
+    "ndjson": (f"SELECT row_to_json(e)::text FROM ({ENDPOINTS_EXPORT_QUERY}) e",
+               {"format": "csv", "delimiter": "\x02", "quote": "\x01"}),
+}
+
+def copy_options(options: Dict[str, Any]) -> str:
+    """Render COPY options, e.g. {"format": "csv", "header": True} as FORMAT 'csv', HEADER true."""
+    rendered = []
+    for name, value in options.items():
+        value = str(value).lower() if isinstance(value, bool) else f"'{value}'"
+        rendered.append(f"{name.upper()} {value}")
+    return ", ".join(rendered)
+
+# pylint: disable=too-few-public-methods
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection remembering the statements prepared in its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def execute_prepared(cursor, name: str, query: str, params: Sequence[Any]):
+    """Execute a query prepared on the connection of the cursor, preparing it on first use.
+    Prepared statements outlive transactions, they are parsed and planned once per connection.
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f"PREPARE {name} AS {query};")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders});" if params else f"EXECUTE {name};", tuple(params))
+
+# pylint: disable=too-many-public-methods
 class EndpointManager:
     """
     This class deals with the database and endpoint management.
+    Methods are blocking and thread-safe. A thread asking for a connection
+    while all of them are in use waits for one instead of failing.
     """
-    def __init__(self):
+    def __init__(self,
+                 min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE):
         self.connection_pool = None
+        self._available = threading.BoundedSemaphore(max_size)
         try:
-            self.connection_pool = psycopg2.pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
+            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=min_size,
+                maxconn=max_size,
                 dbname=os.getenv("DB_NAME"),
                 user=os.getenv("DB_USER"),
                 password=os.getenv("DB_PASSWORD"),
                 host=os.getenv("DB_HOST"),
-                port=os.getenv("DB_PORT")
+                port=os.getenv("DB_PORT"),
+                connection_factory=PreparingConnection
             )
         except Exception as e:
             logger.error(f"Failed to initialize connection pool: {e}")
 
     def get_connection(self):
-        """Get a connection from the pool."""
+        """Get a connection from the pool, waiting for one if all are in use."""
         if self.connection_pool is None:
             raise RuntimeError("Database connection pool not initialized")
-        return self.connection_pool.getconn()
+        # ThreadedConnectionPool raises instead of waiting once exhausted.
+        # The slot is held until release_connection, so it can't be a with block.
+        self._available.acquire()  # pylint: disable=consider-using-with
+        try:
+            return self.connection_pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
 
     def release_connection(self, conn):
         """Release a connection back to the pool."""
         if self.connection_pool is not None:
-            self.connection_pool.putconn(conn)
+            # A connection broken by a network error is discarded, the pool opens a new one
+            self.connection_pool.putconn(conn, close=bool(conn.closed))
+            self._available.release()
 
     def assure_endpoint_table(self):
         """Check if endpoint table is present"""
@@ -61,15 +492,158 @@ class EndpointManager:
                     cursor.execute(
                         f"DROP SEQUENCE IF EXISTS {ENDPOINTS_TABLE_NAME}_endpoint_id_seq CASCADE;"
                         )
+                    cursor.execute(ENDPOINTS_TABLE_DDL)
+                for migration in ENDPOINTS_TABLE_MIGRATIONS:
+                    cursor.execute(migration)
+                for statement in ENDPOINT_CHANGES_DDL:
+                    cursor.execute(statement)
+                cursor.execute(
+                    f"""DELETE FROM {ENDPOINT_CHANGES_TABLE_NAME}
+                    WHERE changed_at < now() - INTERVAL %s;""",
+                    (ENDPOINT_CHANGES_RETENTION,)
+                    )
+                conn.commit()
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def assure_metrics_table(self):
+        """Check if the metrics hypertable is present.
+        Compression settings can only be changed while no chunk is compressed,
+        so they are applied only when the table is created.
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""SELECT EXISTS (
+                        SELECT 1 FROM information_schema.tables 
+                        WHERE table_name = '{METRICS_TABLE_NAME}');
+                    """
+                    )
+                present = cursor.fetchone()[0]
+                if not present:
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS timescaledb;")
+                    cursor.execute(METRICS_TABLE_DDL)
+                    cursor.execute(
+                        f"""SELECT create_hypertable('{METRICS_TABLE_NAME}', 'time',
+                        chunk_time_interval => INTERVAL %s, if_not_exists => TRUE);""",
+                        (METRICS_CHUNK_INTERVAL,)
+                        )
+                    cursor.execute(
+                        f"""CREATE INDEX IF NOT EXISTS {METRICS_TABLE_NAME}_endpoint_id_time_idx
+                        ON {METRICS_TABLE_NAME} (endpoint_id, time DESC);"""
+                        )
                     cursor.execute(f"""
-                        CREATE TABLE IF NOT EXISTS {ENDPOINTS_TABLE_NAME} (
-                            endpoint_id SERIAL PRIMARY KEY,
-                            url VARCHAR(255) not null,
-                            regex VARCHAR(255),
-                            interval INT CHECK (interval >= 5 AND interval <= 300)
+                        ALTER TABLE {METRICS_TABLE_NAME} SET (
+                            timescaledb.compress,
+                            timescaledb.compress_segmentby = 'endpoint_id',
+                            timescaledb.compress_orderby = 'time DESC'
                             );
                         """)
-                    conn.commit()
+                    cursor.execute(
+                        f"""SELECT add_compression_policy('{METRICS_TABLE_NAME}',
+                        INTERVAL %s, if_not_exists => TRUE);""",
+                        (METRICS_COMPRESS_AFTER,)
+                        )
+                for migration in METRICS_TABLE_MIGRATIONS:
+                    cursor.execute(migration)
+                for statement in METRICS_AGGREGATE_DDL:
+                    cursor.execute(statement)
+                conn.commit()
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def assure_workers_table(self):
+        """Check if the membership table is present"""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(WORKERS_TABLE_DDL)
+                conn.commit()
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def renew_lease(self, worker_id: str, lease_seconds: float) -> List[str]:
+        """Register or renew the lease of a worker, and return the ids of the live workers."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""INSERT INTO {WORKERS_TABLE_NAME} (worker_id, lease_expires_at)
+                    VALUES (%s, now() + make_interval(secs => %s))
+                    ON CONFLICT (worker_id) DO UPDATE
+                    SET heartbeat_at = now(), lease_expires_at = EXCLUDED.lease_expires_at;""",
+                    (worker_id, lease_seconds)
+                    )
+                cursor.execute(
+                    f"""DELETE FROM {WORKERS_TABLE_NAME}
+                    WHERE lease_expires_at < now() - INTERVAL %s;""",
+                    (WORKERS_RETENTION,)
+                    )
+                cursor.execute(
+                    f"""SELECT worker_id FROM {WORKERS_TABLE_NAME}
+                    WHERE lease_expires_at > now() ORDER BY worker_id;"""
+                    )
+                workers = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+                return workers
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def release_lease(self, worker_id: str) -> None:
+        """Leave the membership, so other workers take over right away."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {WORKERS_TABLE_NAME} WHERE worker_id = %s;",
+                    (worker_id,)
+                    )
+                conn.commit()
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def latest_change_version(self) -> int:
+        """Get the version of the last change of endpoints, 0 if none."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT COALESCE(MAX(version), 0) FROM {ENDPOINT_CHANGES_TABLE_NAME};")
+                return cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def fetch_endpoint_changes(self, after_version: int, limit: int) -> List[Tuple[int, int, Optional[Endpoint]]]:
+        """Fetch the changes of endpoints after a version, as (version, endpoint_id, endpoint or None)."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(ENDPOINT_CHANGES_QUERY.format(after="%s", limit="%s"), (after_version, limit))
+                return [build_endpoint_change(row) for row in cursor.fetchall()]
         except Exception as e:
             logger.error(e)
             conn.rollback()
@@ -88,18 +662,11 @@ class EndpointManager:
         try:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    f"""SELECT endpoint_id, url, regex, interval FROM 
+                    f"""SELECT {ENDPOINT_COLUMNS} FROM 
                     {ENDPOINTS_TABLE_NAME} 
                     where endpoint_id % {partition_count} = {partition_id};"""
                     )
-                rows = cursor.fetchall()
-                for row in rows:
-                    try:
-                        endpoints.append(Endpoint(row[0], row[1], row[2], row[3]))
-                    except re.error as e:
-                        # Invalid regex will be ignored
-                        logger.warning(e)
-                        continue
+                endpoints = build_endpoints(cursor.fetchall())
         except Exception as e:
             logger.error(e)
             conn.rollback()
@@ -116,17 +683,10 @@ class EndpointManager:
         try:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    f"""SELECT endpoint_id, url, regex, interval FROM 
+                    f"""SELECT {ENDPOINT_COLUMNS} FROM 
                     {ENDPOINTS_TABLE_NAME};"""
                     )
-                rows = cursor.fetchall()
-                for row in rows:
-                    try:
-                        endpoints.append(Endpoint(row[0], row[1], row[2], row[3]))
-                    except re.error as e:
-                        # Invalid regex will be ignored
-                        logger.warning(e)
-                        continue
+                endpoints = build_endpoints(cursor.fetchall())
         except Exception as e:
             logger.error(e)
             conn.rollback()
@@ -135,20 +695,41 @@ class EndpointManager:
             self.release_connection(conn)
         return endpoints
 
+    # pylint: disable=too-many-arguments
+    def list_endpoints(self, after: int, limit: int,
+                       url_prefix: Optional[str] = None,
+                       min_interval: Optional[int] = None,
+                       max_interval: Optional[int] = None,
+                       has_regex: Optional[bool] = None,
+                       offset: int = 0) -> List[EndpointRow]:
+        """List a page of endpoints after the endpoint_id cursor, as rows without compiled regex."""
+        name, query, params = list_endpoints_query(after, limit, url_prefix, min_interval, max_interval,
+                                                   has_regex, offset)
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_prepared(cursor, name, query, params)
+                rows = cursor.fetchall()
+                conn.commit()
+                return [EndpointRow(*row) for row in rows]
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
     def get_endpoint(self, endpoint_id: int) -> Optional[Endpoint]:
         """Get a specific endpoint by ID."""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    f"""SELECT endpoint_id, url, regex, interval FROM 
-                    {ENDPOINTS_TABLE_NAME} 
-                    WHERE endpoint_id = %s;""",
-                    (endpoint_id,)
-                    )
+                execute_prepared(cursor, "get_endpoint", GET_ENDPOINT_QUERY, (endpoint_id,))
                 row = cursor.fetchone()
+                # A read-only transaction, ended so the connection is returned idle
+                conn.commit()
                 if row:
-                    return Endpoint(row[0], row[1], row[2], row[3])
+                    return Endpoint(*row)
                 return None
         except Exception as e:
             logger.error(e)
@@ -157,20 +738,17 @@ class EndpointManager:
         finally:
             self.release_connection(conn)
 
-    def create_endpoint(self, url: str, regex: Optional[str], interval: int) -> Endpoint:
+    def create_endpoint(self, url: str, regex: Optional[str], interval: int,
+                        max_body_bytes: Optional[int] = None) -> Endpoint:
         """Create a new endpoint."""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    f"""INSERT INTO {ENDPOINTS_TABLE_NAME} (url, regex, interval)
-                    VALUES (%s, %s, %s)
-                    RETURNING endpoint_id, url, regex, interval;""",
-                    (url, regex, interval)
-                    )
+                execute_prepared(cursor, "create_endpoint", CREATE_ENDPOINT_QUERY,
+                                 (url, regex, interval, max_body_bytes))
                 row = cursor.fetchone()
                 conn.commit()
-                return Endpoint(row[0], row[1], row[2], row[3])
+                return Endpoint(*row)
         except Exception as e:
             logger.error(e)
             conn.rollback()
@@ -183,29 +761,20 @@ class EndpointManager:
         if not update_data:
             return self.get_endpoint(endpoint_id)
 
+        # One prepared statement per set of columns, at most 15 of them
+        columns = update_columns(update_data)
+        query = update_endpoint_query(columns)
+        values = [update_data[column] for column in columns] + [endpoint_id]
+
         conn = self.get_connection()
         try:
-            # Build the SET clause dynamically based on provided fields
-            set_clauses = []
-            values = []
-            for key, value in update_data.items():
-                set_clauses.append(f"{key} = %s")
-                values.append(value)
-            values.append(endpoint_id)  # Add endpoint_id for WHERE clause
-
             with conn.cursor() as cursor:
-                cursor.execute(
-                    f"""UPDATE {ENDPOINTS_TABLE_NAME}
-                    SET {', '.join(set_clauses)}
-                    WHERE endpoint_id = %s
-                    RETURNING endpoint_id, url, regex, interval;""",
-                    tuple(values)
-                    )
+                execute_prepared(cursor, f"update_endpoint_{'_'.join(columns)}", query, values)
                 row = cursor.fetchone()
                 if not row:
                     raise ValueError(f"Endpoint with ID {endpoint_id} not found")
                 conn.commit()
-                return Endpoint(row[0], row[1], row[2], row[3])
+                return Endpoint(*row)
         except Exception as e:
             logger.error(e)
             conn.rollback()
@@ -218,11 +787,7 @@ class EndpointManager:
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    f"""DELETE FROM {ENDPOINTS_TABLE_NAME}
-                    WHERE endpoint_id = %s;""",
-                    (endpoint_id,)
-                    )
+                execute_prepared(cursor, "delete_endpoint", DELETE_ENDPOINT_QUERY, (endpoint_id,))
                 if cursor.rowcount == 0:
                     raise ValueError(f"Endpoint with ID {endpoint_id} not found")
                 conn.commit()
@@ -233,12 +798,93 @@ class EndpointManager:
         finally:
             self.release_connection(conn)
 
+    def endpoint_stats(self, endpoint_id: int, start, end, bucket) -> List[Dict[str, Any]]:
+        """Aggregated metrics of an endpoint between two datetimes, per bucket (a timedelta of whole hours)."""
+        return self._fetch_dicts("endpoint_stats", ENDPOINT_STATS_QUERY, (endpoint_id, bucket, start, end))
+
+    def fleet_stats(self, start, end, worst: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Aggregated metrics of every endpoint between two datetimes, and the worst endpoints by uptime."""
+        totals = self._fetch_dicts("fleet_stats", FLEET_STATS_QUERY, (start, end))
+        return totals[0], self._fetch_dicts("fleet_worst", FLEET_WORST_QUERY, (start, end, worst))
+
+    def _fetch_dicts(self, name: str, query: str, params: Sequence[Any]) -> List[Dict[str, Any]]:
+        """Run a prepared read query and return its rows as dicts."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_prepared(cursor, name, query, params)
+                columns = [column.name for column in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                conn.commit()
+                return rows
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def import_endpoints(self, rows: Sequence[Sequence[Any]], replace: bool = False) -> Dict[str, int]:
+        """Merge validated rows (line, endpoint_id, url, regex, interval, max_body_bytes) into
+        endpoints, by endpoint_id when given, otherwise by (url, regex). With replace, endpoints
+        not imported are deleted. It is a single transaction, and it returns the number of rows
+        deleted, updated and inserted.
+        """
+        counts = {"rows": len(rows), "deleted": 0, "updated": 0, "inserted": 0}
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(ENDPOINTS_IMPORT_TABLE_DDL)
+                cursor.copy_expert(
+                    f"COPY {ENDPOINTS_IMPORT_TABLE_NAME} ({', '.join(ENDPOINTS_IMPORT_COLUMNS)}) FROM STDIN;",
+                    io.StringIO(to_copy_text(rows))
+                    )
+                cursor.execute(f"ANALYZE {ENDPOINTS_IMPORT_TABLE_NAME};")
+                cursor.execute(ENDPOINTS_IMPORT_LOCK)
+                for counter, statement in import_statements(replace):
+                    cursor.execute(statement)
+                    if counter:
+                        counts[counter] = cursor.rowcount
+                conn.commit()
+            return counts
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
+    def export_endpoints(self, export_format: str, write: Callable[[bytes], Any]):
+        """Stream every endpoint in one of ENDPOINTS_EXPORT_FORMATS with COPY, calling write for each chunk."""
+        query, options = ENDPOINTS_EXPORT_FORMATS[export_format]
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                # psycopg2 writes bytes to any object with a write method
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH ({copy_options(options)});",
+                                   types.SimpleNamespace(write=write))
+                conn.commit()
+        except Exception as e:
+            logger.error(e)
+            conn.rollback()
+            raise e
+        finally:
+            self.release_connection(conn)
+
     def check_readiness(self):
         """Ensure DB tables are ready."""
         self.assure_endpoint_table()
+        self.assure_metrics_table()
+        self.assure_workers_table()
         return self
 
+    def close(self):
+        """Close the connection pool."""
+        if self.connection_pool is not None:
+            self.connection_pool.closeall()
+            self.connection_pool = None
+
     def __del__(self):
         """Clean up the connection pool."""
-        if hasattr(self, 'connection_pool') and self.connection_pool is not None:
-            self.connection_pool.closeall()
+        if hasattr(self, 'connection_pool'):
+            self.close()
@@ -0,0 +1,119 @@
+"""
+This module evaluates the regex of an endpoint against a streamed response body.
+1. Read the body in chunks, up to a per-endpoint byte cap
+2. Match incrementally, keeping an overlap so a match across two chunks is still found
+3. Stop the download as soon as the result is known
+4. Give up, and flag the result, when the regex runs over its time budget
+5. Evaluate the regexes of several endpoints against one body, read once
+"""
+import codecs
+import os
+from typing import List, Optional, Sequence, Tuple
+
+from src.endpoint import Endpoint
+from src.worker.regex_pool import RegexEvaluator, RegexTimeout, regex_evaluator
+
+# Size of the chunks read from the socket
+BODY_CHUNK_SIZE = int(os.getenv("BODY_CHUNK_SIZE", "16384"))
+# Bytes read at most from a body, unless the endpoint sets its own max_body_bytes
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(1024 * 1024)))
+# Characters of the previous chunk searched again with the next one.
+# A match longer than this across a chunk boundary may be missed.
+REGEX_OVERLAP_CHARS = int(os.getenv("REGEX_OVERLAP_CHARS", "4096"))
+
+# pylint: disable=too-few-public-methods
+class StreamingMatcher:
+    """Search the regex of an endpoint in text fed chunk by chunk."""
+
+    def __init__(self, endpoint: Endpoint,
+                 overlap: int = REGEX_OVERLAP_CHARS,
+                 evaluator: RegexEvaluator = regex_evaluator):
+        self.endpoint = endpoint
+        self.overlap = overlap
+        self.evaluator = evaluator
+        self.matched = False
+        # The tail keeps one more character than the overlap, so anchors and
+        # lookbehinds at the start of the overlap see their real context.
+        self._tail = ""
+        self._tail_at_start = True
+
+    async def feed(self, text: str, final: bool = False) -> bool:
+        """Search the pattern in the text seen so far and tell if it matched.
+        Until the final chunk, a match reaching the end of the text is not
+        trusted, since more text could change it (e.g. a trailing $).
+        """
+        if self.matched:
+            return True
+        window = self._tail + text
+        end = await self.evaluator.search_end(self.endpoint, window, 0 if self._tail_at_start else 1)
+        if end is not None and (final or end < len(window)):
+            self.matched = True
+            return True
+        keep = self.overlap + 1
+        if len(window) > keep:
+            self._tail = window[-keep:]
+            self._tail_at_start = False
+        else:
+            self._tail = window
+        return False
+
+async def read_and_match(response, endpoint: Endpoint) -> Tuple[bool, int, bool, bool]:
+    """Evaluate the regex of the endpoint against the body of the response.
+    It returns whether the regex matched, the number of bytes read, whether
+    the body was truncated by the byte cap and whether the regex timed out.
+    Leaving the body unread makes aiohttp close the connection instead of
+    reusing it, which is cheaper than downloading megabytes nobody looks at.
+    """
+    return (await read_and_match_all(response, [endpoint]))[0]
+
+# pylint: disable=too-many-locals
+async def read_and_match_all(response, endpoints: Sequence[Endpoint]) -> List[Tuple[bool, int, bool, bool]]:
+    """Evaluate the regexes of several endpoints against one body, read once, e.g. for
+    checks sharing a request. Each endpoint gets the result read_and_match would give it,
+    and the download stops once every result is known.
+    """
+    if not endpoints:
+        return []
+    limits = [endpoint.max_body_bytes or MAX_BODY_BYTES for endpoint in endpoints]
+    matchers = [StreamingMatcher(endpoint) for endpoint in endpoints]
+    results: List[Optional[Tuple[bool, int, bool, bool]]] = [None] * len(endpoints)
+    pending = list(range(len(endpoints)))
+    try:
+        decoder_type = codecs.getincrementaldecoder(response.charset or "utf-8")
+    except LookupError:
+        # A charset Python doesn't know is read as UTF-8, as aiohttp's text() would
+        decoder_type = codecs.getincrementaldecoder("utf-8")
+    decoder = decoder_type(errors="replace")
+    bytes_read = 0
+    async for chunk in response.content.iter_chunked(BODY_CHUNK_SIZE):
+        end = bytes_read + len(chunk)
+        state = decoder.getstate()
+        text = decoder.decode(chunk)
+        for i in pending:
+            truncated = end > limits[i]
+            if truncated:
+                # The capped end of the chunk is decoded on its own, from the state before the chunk
+                capped = decoder_type(errors="replace")
+                capped.setstate(state)
+                piece, read = capped.decode(chunk[:limits[i] - bytes_read]), limits[i]
+            else:
+                piece, read = text, end
+            try:
+                # No text follows the capped piece, so a match reaching its end is trusted
+                if await matchers[i].feed(piece, final=truncated):
+                    results[i] = (True, read, False, False)
+                elif truncated:
+                    results[i] = (False, read, True, False)
+            except RegexTimeout:
+                results[i] = (False, read, False, True)
+        bytes_read = end
+        pending = [i for i in pending if results[i] is None]
+        if not pending:
+            return results
+    text = decoder.decode(b"", final=True)
+    for i in pending:
+        try:
+            results[i] = (await matchers[i].feed(text, final=True), bytes_read, False, False)
+        except RegexTimeout:
+            results[i] = (False, bytes_read, False, True)
+    return results
@@ -0,0 +1,62 @@
+"""
+This module lets checks of the same URL share one request.
+1. A check sending a request leads it, until its response headers come back
+2. A check of the same URL due meanwhile joins it, if it started at most COALESCE_WINDOW seconds ago
+3. The leader evaluates the regex of every joined endpoint against the one body it reads
+4. Each joined check gets the status, duration and phases of the request, and its own regex result
+Every check is a GET, so the URL alone tells requests apart. The scheduler gives endpoints of the
+same URL and interval the same deadlines, so their checks meet.
+"""
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+from src.endpoint import Endpoint
+
+# Share one request between the checks of the same URL
+CHECK_COALESCING = os.getenv("CHECK_COALESCING", "true").lower() == "true"
+# Seconds after its start a request can still be joined, before its response headers
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))
+
+# pylint: disable=too-few-public-methods
+class SharedRequest:
+    """A request in flight, the endpoints which joined it, and the result they wait for."""
+    __slots__ = ("url", "started", "joined", "result")
+
+    def __init__(self, url: str, started: float):
+        self.url = url
+        self.started = started
+        self.joined: List[Endpoint] = []
+        # Set by the leader to its Stat and the regex results of the joined endpoints
+        self.result = asyncio.get_running_loop().create_future()
+
+class RequestCoalescer:
+    """The requests of a process which can still be joined, by URL."""
+
+    def __init__(self, window: float = COALESCE_WINDOW):
+        self.window = window
+        self.requests: Dict[str, SharedRequest] = {}
+        # Checks which joined a request instead of sending their own
+        self.coalesced = 0
+
+    def join(self, endpoint: Endpoint, now: float) -> Optional[Tuple[SharedRequest, int]]:
+        """Join the request in flight to the URL of the endpoint, and return it with the
+        index of the endpoint in its results. None if there is no request to join.
+        """
+        shared = self.requests.get(endpoint.url)
+        if shared is None or now - shared.started > self.window:
+            return None
+        shared.joined.append(endpoint)
+        self.coalesced += 1
+        return shared, len(shared.joined) - 1
+
+    def lead(self, endpoint: Endpoint, now: float) -> SharedRequest:
+        """Open a request to the URL of the endpoint for others to join."""
+        shared = self.requests[endpoint.url] = SharedRequest(endpoint.url, now)
+        return shared
+
+    def close(self, shared: SharedRequest) -> List[Endpoint]:
+        """Stop endpoints from joining the request, e.g. once its body is being read, and return those which did."""
+        if self.requests.get(shared.url) is shared:
+            del self.requests[shared.url]
+        return shared.joined
@@ -0,0 +1,112 @@
+"""
+This module adapts the number of checks in flight to what the process can measure accurately.
+1. Watch the event loop lag, and the drift of every check: the part of its duration spent
+   in the process rather than in DNS, connect, TLS, time to first byte or transfer
+2. Cut the limit by LIMITER_DECREASE when either exceeds LIMITER_ACCURACY_BOUND
+3. Raise it by LIMITER_INCREASE while checks wait for a slot and measurements stay accurate
+4. Checks over the limit are deferred by the scheduler, those starting too late are flagged
+This is AIMD, as in TCP congestion control: the limit probes upwards slowly and backs off fast.
+"""
+import asyncio
+import os
+from typing import Dict, Sequence
+
+from src.utils import logger
+from src.worker.timing import UNKNOWN
+
+# Adapt the checks in flight to the accuracy bound, or keep WORKER_MAX_IN_FLIGHT
+ADAPTIVE_CONCURRENCY = os.getenv("WORKER_ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+# Seconds a measurement may be off by, because of loop lag or time spent in the process
+LIMITER_ACCURACY_BOUND = float(os.getenv("LIMITER_ACCURACY_BOUND", "0.05"))
+# Fraction of the checks of an interval allowed to drift beyond the accuracy bound
+LIMITER_DRIFTED_FRACTION = float(os.getenv("LIMITER_DRIFTED_FRACTION", "0.01"))
+# The limit never goes below this many checks in flight
+LIMITER_MIN_IN_FLIGHT = int(os.getenv("LIMITER_MIN_IN_FLIGHT", "10"))
+# Checks added to the limit after an interval without inaccurate measurements
+LIMITER_INCREASE = int(os.getenv("LIMITER_INCREASE", "10"))
+# Factor applied to the limit after an interval with inaccurate measurements
+LIMITER_DECREASE = float(os.getenv("LIMITER_DECREASE", "0.75"))
+# How often the limit is adjusted, in seconds
+LIMITER_INTERVAL = float(os.getenv("LIMITER_INTERVAL", "1.0"))
+
+# pylint: disable=too-many-instance-attributes
+class ConcurrencyLimiter:
+    """AIMD limit of the checks in flight of a Scheduler."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 scheduler,
+                 max_limit: int,
+                 min_limit: int = LIMITER_MIN_IN_FLIGHT,
+                 accuracy_bound: float = LIMITER_ACCURACY_BOUND,
+                 drifted_fraction: float = LIMITER_DRIFTED_FRACTION,
+                 increase: int = LIMITER_INCREASE,
+                 decrease: float = LIMITER_DECREASE,
+                 interval: float = LIMITER_INTERVAL):
+        """Start at max_limit, the limit the process was configured with."""
+        self.scheduler = scheduler
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.accuracy_bound = accuracy_bound
+        self.drifted_fraction = drifted_fraction
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.limit = max_limit
+        self.increases = 0
+        self.decreases = 0
+        # Signals of the current interval
+        self.max_loop_lag = 0.0
+        self.checks = 0
+        self.drifted = 0
+
+    def observe_loop_lag(self, lag: float):
+        """Take a sample of the event loop lag into account."""
+        if lag > self.max_loop_lag:
+            self.max_loop_lag = lag
+
+    def observe_check(self, duration: float, phases: Sequence[int]):
+        """Take the drift of a check into account. Checks with unknown phases, e.g. failed ones, are ignored."""
+        if UNKNOWN in phases:
+            return
+        self.checks += 1
+        if duration - sum(phases) / 1e6 > self.accuracy_bound:
+            self.drifted += 1
+
+    def adjust(self) -> int:
+        """Apply the signals of the interval to the limit, and start a new interval."""
+        # Checks waited for a slot during the interval
+        saturated, self.scheduler.saturated = self.scheduler.saturated, False
+        accurate = (self.max_loop_lag <= self.accuracy_bound
+                    and self.drifted <= self.drifted_fraction * self.checks)
+        if not accurate:
+            # Checks above the limit are still running, wait until they are done before cutting again
+            if self.scheduler.in_flight <= self.limit and self.limit > self.min_limit:
+                self.limit = max(int(self.limit * self.decrease), self.min_limit)
+                self.decreases += 1
+                logger.info(f"Concurrency limit cut to {self.limit}: max loop lag {self.max_loop_lag:.3f}s, "
+                            f"{self.drifted} of {self.checks} checks drifted")
+        elif saturated and self.limit < self.max_limit:
+            self.limit = min(self.limit + self.increase, self.max_limit)
+            self.increases += 1
+        self.scheduler.resize(self.limit)
+        self.max_loop_lag = 0.0
+        self.checks = self.drifted = 0
+        return self.limit
+
+    async def run(self):
+        """Adjust the limit every interval until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.adjust()
+
+    def stats(self) -> Dict[str, float]:
+        """Limiter stats used for capacity planning."""
+        return {
+            "limit": self.limit,
+            "max_limit": self.max_limit,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "deferred": self.scheduler.stats.deferred,
+            "late": self.scheduler.stats.late,
+        }
@@ -0,0 +1,117 @@
+"""
+This module keeps the checks of a process polite to the hosts they target.
+1. Key every endpoint by its origin, host and port, computed once when the Endpoint is built
+2. Give each limited origin a token bucket of HOST_RATE_LIMIT requests per second
+   and HOST_BURST requests at once, or the limits configured for it in HOST_RATE_LIMITS
+3. Spread requests over time: a check finding no token is deferred by the scheduler to the
+   time its token comes, so the checks of one origin end up evenly spaced
+4. Skip a check whose token wouldn't come within its interval, rather than letting the backlog grow
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+from src.endpoint import Endpoint
+
+# Requests per second to the same origin, 0 means unlimited
+HOST_RATE_LIMIT = float(os.getenv("HOST_RATE_LIMIT", "0"))
+# Requests sent at once to an origin which was quiet, 0 means the same as its rate
+HOST_BURST = float(os.getenv("HOST_BURST", "0"))
+# Limits of given origins, e.g. "testserver:8001=50/100,example.com=5": requests per second
+# and an optional burst. A host without a port matches every port of the host.
+HOST_RATE_LIMITS = os.getenv("HOST_RATE_LIMITS", "")
+
+Limit = Tuple[float, float]
+
+def parse_limits(limits: str) -> Dict[str, Limit]:
+    """Parse "host[:port]=rate[/burst],..." into the rate and burst of each host."""
+    parsed = {}
+    for item in filter(None, (item.strip() for item in limits.split(","))):
+        try:
+            host, limit = item.split("=")
+            rate, _, burst = limit.partition("/")
+            parsed[host.strip().lower()] = (float(rate), float(burst or 0))
+        except ValueError as e:
+            raise ValueError(f"Invalid host rate limit {item!r}, expected host[:port]=rate[/burst]") from e
+    return parsed
+
+# pylint: disable=too-few-public-methods
+class TokenBucket:
+    """Tokens of an origin. Tokens are reserved ahead, so the balance goes negative
+    while checks wait for theirs.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = now
+
+    def reserve(self, now: float, max_delay: float) -> Optional[float]:
+        """Take the next token and return the seconds until it comes, or None without
+        taking it if it would come after max_delay.
+        """
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+        if delay > max_delay:
+            self.tokens = tokens
+            return None
+        self.tokens = tokens - 1
+        return delay
+
+# pylint: disable=too-many-instance-attributes
+class HostLimiter:
+    """The token buckets of the origins checked by a process."""
+
+    def __init__(self,
+                 rate: float = HOST_RATE_LIMIT,
+                 burst: float = HOST_BURST,
+                 limits: Optional[Dict[str, Limit]] = None):
+        """Origins without their own limits get rate and burst."""
+        self.rate = rate
+        self.burst = burst
+        self.limits = parse_limits(HOST_RATE_LIMITS) if limits is None else limits
+        # origin -> its bucket, None if it is unlimited
+        self.buckets: Dict[str, Optional[TokenBucket]] = {}
+        self.deferred = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Tell if any origin is limited."""
+        return self.rate > 0 or any(rate > 0 for rate, _ in self.limits.values())
+
+    def limit_of(self, origin: str) -> Limit:
+        """The rate and burst of an origin."""
+        limit = self.limits.get(origin) or self.limits.get(origin.rpartition(":")[0])
+        if limit is None:
+            return self.rate, self.burst
+        return limit
+
+    def reserve(self, endpoint: Endpoint, now: float) -> Optional[float]:
+        """Reserve the next request to the origin of an endpoint. It returns the seconds to wait
+        before checking it, or None if the check should be skipped for this interval.
+        """
+        try:
+            bucket = self.buckets[endpoint.origin]
+        except KeyError:
+            rate, burst = self.limit_of(endpoint.origin)
+            bucket = self.buckets[endpoint.origin] = TokenBucket(rate, burst or rate, now) if rate > 0 else None
+        if bucket is None:
+            return 0.0
+        delay = bucket.reserve(now, endpoint.interval)
+        if delay is None:
+            self.skipped += 1
+        elif delay:
+            self.deferred += 1
+        return delay
+
+    def stats(self) -> Dict[str, float]:
+        """Host limiter stats, to tell whether the limits hold checks back."""
+        return {
+            "origins": len(self.buckets),
+            "limited_origins": sum(bucket is not None for bucket in self.buckets.values()),
+            "deferred": self.deferred,
+            "skipped": self.skipped,
+        }
@@ -0,0 +1,91 @@
+"""
+This module instruments the runtime of a worker process, to tell why checks are late.
+1. Measure the lag of the event loop with a task sleeping a fixed interval
+2. Time the stages of every check: start delay, HTTP, body, regex, hand-off and flush
+3. Read gauges such as the checks in flight and the depth of the metrics buffer when reported
+4. Log them with the other stats, and serve them on /metrics
+Each timing is one bucket increment in a windowed latency sketch, and the rows of a drain are
+bucketed together, so it is left on in production.
+"""
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from src.worker.latency_sketch import WindowedSketch, current_window, quantiles, LATENCY_SKETCH_WINDOW
+
+# How often the event loop lag is sampled, in seconds
+RUNTIME_LOOP_LAG_INTERVAL = float(os.getenv("RUNTIME_LOOP_LAG_INTERVAL", "0.25"))
+
+# Stages of a check, in order:
+# start_delay: from the deadline of the check to the start of its task
+# http: from the start of the request to the response headers
+# body: from the response headers to the end of the body read and its regex evaluation
+# regex: CPU time of one regex search, or the wait for an offloaded one
+# handoff: from the end of the check to the metrics handler draining its row
+# flush: time the metrics handler spends storing and sending a drain
+STAGES = ("start_delay", "http", "body", "regex", "handoff", "flush")
+REPORTED_QUANTILES = (0.5, 0.99)
+
+class RuntimeStats:
+    """Stage timings, loop lag and gauges of a worker process."""
+
+    def __init__(self, window: float = LATENCY_SKETCH_WINDOW):
+        self.window = window
+        self.stages: Dict[str, WindowedSketch] = {}
+        self.loop_lag = WindowedSketch("I")
+        self.max_loop_lag = 0.0
+        # Read when reported, so they cost nothing in between: name -> (Prometheus type, read)
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+        self.reset()
+
+    def reset(self):
+        """Forget every timing, e.g. at the start of a benchmark. Gauges are kept."""
+        self.stages = {stage: WindowedSketch("I") for stage in STAGES}
+        self.loop_lag = WindowedSketch("I")
+        self.max_loop_lag = 0.0
+
+    def record(self, stage: str, seconds: float, window: Optional[int] = None):
+        """Record the time one check spent in a stage."""
+        self.stages[stage].record(seconds, int(time.monotonic() // self.window) if window is None else window)
+
+    def record_many(self, stage: str, seconds: Sequence[float], window: Optional[int] = None):
+        """Record the time many checks spent in a stage, e.g. the rows of a drain."""
+        self.stages[stage].record_many(seconds, current_window(self.window) if window is None else window)
+
+    def gauge(self, name: str, read: Callable[[], float], kind: str = "gauge"):
+        """Register a value read each time the stats are reported, kind being "counter" if it only grows."""
+        self.gauges[name] = (kind, read)
+
+    async def monitor_loop_lag(self,
+                               interval: float = RUNTIME_LOOP_LAG_INTERVAL,
+                               on_lag: Optional[Callable[[float], None]] = None):
+        """Sleep interval seconds over and over, and record how late each wake-up is.
+        A late wake-up means a callback held the event loop, e.g. a regex or a large decode.
+        Each lag is also passed to on_lag, e.g. to adapt the checks in flight.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - started - interval, 0.0)
+            self.loop_lag.record(lag, current_window(self.window))
+            self.max_loop_lag = max(self.max_loop_lag, lag)
+            if on_lag is not None:
+                on_lag(lag)
+
+    def as_dict(self) -> Dict[str, object]:
+        """Output as a dict so it can be logged or exported. Percentiles cover the last one to two windows."""
+        window = current_window(self.window)
+        stats: Dict[str, object] = {}
+        for name, sketch in (("loop_lag", self.loop_lag), *self.stages.items()):
+            recent = sketch.recent(window)
+            p50, p99 = quantiles(recent, REPORTED_QUANTILES)
+            stats[name] = {"count": sum(part.count for part in recent), "p50": p50, "p99": p99}
+        stats["max_loop_lag"] = self.max_loop_lag
+        for name, (_, read) in self.gauges.items():
+            stats[name] = read()
+        return stats
+
+# The stats shared by the worker, the scheduler, the regex evaluator and the metrics handler of the process
+runtime_stats = RuntimeStats()
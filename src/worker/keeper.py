@@ -2,11 +2,15 @@
 It uses the new MetricsHandler and EndpointManager classes.
 """
 import asyncio
-from asyncio import Queue
+import os
 from typing import Any
 
 from src.utils import logger
 from src.worker.metrics_handler import MetricsHandler
+from src.worker.metrics_buffer import MetricsBuffer
+from src.worker.spool import Spool, METRICS_SPOOL_DIR
+from src.worker.metrics_store import MetricsStore
+from src.worker.truewatch_exporter import create_truewatch_exporter
 from src.endpoint_manager import EndpointManager
 
 class Keeper:
@@ -16,9 +20,14 @@ class Keeper:
         """Initialize the keeper with a worker."""
         self.worker = worker
         self._running = True
-        self.metrics_buffer = Queue()
-        self.metrics_handler = MetricsHandler(self.metrics_buffer)
+        self.spool = Spool()
+        # Spilled rows are spooled apart, they are still to be sent to TrueWatch
+        self.metrics_buffer = MetricsBuffer(spool=Spool(os.path.join(METRICS_SPOOL_DIR, "overflow")))
         self.endpoint_manager = EndpointManager()
+        self.metrics_handler = MetricsHandler(self.metrics_buffer,
+                                              MetricsStore(self.endpoint_manager, spool=self.spool),
+                                              create_truewatch_exporter(),
+                                              spool=self.spool)
 
     def stop(self):
         """Stop the keeper."""
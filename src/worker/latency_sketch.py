@@ -0,0 +1,262 @@
+"""
+This module keeps a latency sketch and status counters of every endpoint in memory.
+1. Record durations in a log-linear histogram of fixed size, the way HDR histograms do
+2. Merge sketches by adding their counts, e.g. to sum up every endpoint of a process
+3. Keep the last two windows of LATENCY_SKETCH_WINDOW seconds, so percentiles describe recent checks
+4. Count checks by status class since the start of the process
+"""
+import collections
+import itertools
+import math
+import os
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Seconds a window of the sketches lasts, percentiles cover the last one to two windows
+LATENCY_SKETCH_WINDOW = float(os.getenv("LATENCY_SKETCH_WINDOW", "300"))
+
+# Durations are counted in units of 100us, up to 2^19 units (52s), beyond HTTP_TIMEOUT
+SKETCH_UNIT = 1e-4
+SKETCH_MAX_BITS = 19
+# 2^4 linear sub-buckets per power of two: a bucket is at most 1/16 of its lower bound wide,
+# so the midpoint of a bucket is within 3.2% of any duration it counts
+SKETCH_SUB_BUCKET_BITS = 4
+SKETCH_SUB_BUCKETS = 1 << SKETCH_SUB_BUCKET_BITS
+SKETCH_BUCKETS = SKETCH_SUB_BUCKETS * (SKETCH_MAX_BITS - SKETCH_SUB_BUCKET_BITS + 1)
+
+# Status classes counted per endpoint, indexed by status // 100. No response or
+# a status outside 100-599 counts as "none"
+STATUS_CLASSES = ("none", "1xx", "2xx", "3xx", "4xx", "5xx")
+
+def bucket_index(duration: float) -> int:
+    """The bucket of a duration in seconds."""
+    value = int(duration / SKETCH_UNIT)
+    if value < SKETCH_SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - SKETCH_SUB_BUCKET_BITS - 1
+    return min(shift * SKETCH_SUB_BUCKETS + (value >> shift), SKETCH_BUCKETS - 1)
+
+def status_class(status_code: int) -> int:
+    """The index of the status class of a status code in STATUS_CLASSES."""
+    return status_code // 100 if 100 <= status_code < 600 else 0
+
+def bucket_bounds(index: int) -> Tuple[float, float]:
+    """The lower and upper bounds of a bucket, in seconds."""
+    if index < SKETCH_SUB_BUCKETS:
+        return index * SKETCH_UNIT, (index + 1) * SKETCH_UNIT
+    shift = index // SKETCH_SUB_BUCKETS - 1
+    mantissa = index - shift * SKETCH_SUB_BUCKETS
+    return (mantissa << shift) * SKETCH_UNIT, ((mantissa + 1) << shift) * SKETCH_UNIT
+
+class LatencySketch:
+    """A histogram of durations with SKETCH_BUCKETS buckets, its memory is fixed.
+    The buckets of an endpoint hold unsigned shorts, enough for a window of checks.
+    """
+    __slots__ = ("counts", "count", "low", "high")
+
+    def __init__(self, typecode: str = "H"):
+        self.counts = array(typecode, bytes(array(typecode).itemsize * SKETCH_BUCKETS))
+        self.count = 0
+        # The range of buckets holding counts, so reads and clears skip the empty ones
+        self.low = SKETCH_BUCKETS
+        self.high = -1
+
+    def record(self, duration: float):
+        """Count one duration in seconds."""
+        index = bucket_index(duration)
+        try:
+            self.counts[index] += 1
+        except OverflowError:
+            # A full bucket saturates instead of wrapping
+            return
+        self.count += 1
+        if index < self.low:
+            self.low = index
+        if index > self.high:
+            self.high = index
+
+    def record_counts(self, counts: Dict[int, int]):
+        """Count durations already bucketed, as bucket index -> number of durations.
+        Full buckets saturate instead of wrapping.
+        """
+        if not counts:
+            return
+        limit = (1 << 8 * self.counts.itemsize) - 1
+        for index, count in counts.items():
+            added = min(count, limit - self.counts[index])
+            self.counts[index] += added
+            self.count += added
+        self.low = min(self.low, *counts)
+        self.high = max(self.high, *counts)
+
+    def merge(self, other: "LatencySketch"):
+        """Add the counts of another sketch to this one."""
+        for index in range(other.low, other.high + 1):
+            if other.counts[index]:
+                self.counts[index] += other.counts[index]
+        self.count += other.count
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+
+    def clear(self):
+        """Forget every count."""
+        for index in range(self.low, self.high + 1):
+            self.counts[index] = 0
+        self.count = 0
+        self.low = SKETCH_BUCKETS
+        self.high = -1
+
+def current_window(length: float = LATENCY_SKETCH_WINDOW) -> int:
+    """The number of the window of the given length now."""
+    return int(time.monotonic() // length)
+
+def quantiles(sketches: Sequence[LatencySketch], fractions: Sequence[float]) -> List[Optional[float]]:
+    """The quantiles of the sketches merged, in seconds, None without durations.
+    A quantile is the midpoint of the bucket it falls in. Read in a single pass, without merging.
+    """
+    total = sum(sketch.count for sketch in sketches)
+    if not total:
+        return [None] * len(fractions)
+    low = min(sketch.low for sketch in sketches)
+    high = max(sketch.high for sketch in sketches)
+    ranks = sorted((max(math.ceil(fraction * total), 1), i) for i, fraction in enumerate(fractions))
+    if len(sketches) == 1:
+        counts = sketches[0].counts[low:high + 1]
+    else:
+        counts = map(sum, zip(*(sketch.counts[low:high + 1] for sketch in sketches)))
+    results: List[Optional[float]] = [None] * len(fractions)
+    pending = 0
+    for index, seen in enumerate(itertools.accumulate(counts), low):
+        while pending < len(ranks) and seen >= ranks[pending][0]:
+            lower, upper = bucket_bounds(index)
+            results[ranks[pending][1]] = (lower + upper) / 2
+            pending += 1
+        if pending == len(ranks):
+            break
+    return results
+
+class WindowedSketch:
+    """The latency sketches of the current and previous windows, and the count and sum of
+    every duration since the start of the process.
+    """
+    __slots__ = ("window", "current", "previous", "duration_sum", "durations")
+
+    def __init__(self, typecode: str = "H"):
+        self.window = 0
+        self.current = LatencySketch(typecode)
+        self.previous = LatencySketch(typecode)
+        # Since the start of the process, for the _sum and _count of a Prometheus summary
+        self.duration_sum = 0.0
+        self.durations = 0
+
+    def record(self, duration: float, window: int):
+        """Count one duration in seconds, in the given window."""
+        if window != self.window:
+            self._roll(window)
+        self.current.record(duration)
+        self.duration_sum += duration
+        self.durations += 1
+
+    def record_many(self, durations: Sequence[float], window: int):
+        """Count durations in seconds in the given window, bucketing them all before touching the sketch."""
+        if not durations:
+            return
+        if window != self.window:
+            self._roll(window)
+        self.current.record_counts(collections.Counter(map(bucket_index, durations)))
+        self.duration_sum += sum(durations)
+        self.durations += len(durations)
+
+    def recent(self, window: int) -> Tuple[LatencySketch, ...]:
+        """The sketches of the window and the one before, without changing them."""
+        if self.window == window:
+            return (self.current, self.previous)
+        if self.window == window - 1:
+            return (self.current,)
+        return ()
+
+    def _roll(self, window: int):
+        if window == self.window + 1:
+            self.current, self.previous = self.previous, self.current
+        else:
+            self.previous.clear()
+        self.current.clear()
+        self.window = window
+
+class EndpointSketch(WindowedSketch):
+    """The windowed latency sketch and the status counters of one endpoint."""
+    __slots__ = ("statuses",)
+
+    def __init__(self, typecode: str = "H"):
+        super().__init__(typecode)
+        self.statuses = array("Q", bytes(8 * len(STATUS_CLASSES)))
+
+    # pylint: disable=arguments-differ
+    def record(self, status_code: int, duration: float, window: int):
+        """Count one check. Only checks with a response have their duration recorded."""
+        self.statuses[status_class(status_code)] += 1
+        if status_code and not math.isnan(duration):
+            super().record(duration, window)
+
+    def record_checks(self, status_codes: Sequence[int], durations: Sequence[float], window: int):
+        """Count the checks of two columns at once, as record does one by one."""
+        for status_code, count in collections.Counter(status_codes).items():
+            self.statuses[status_class(status_code)] += count
+        # The durations of checks with a response, unless unknown
+        self.record_many(list(itertools.filterfalse(math.isnan, itertools.compress(durations, status_codes))),
+                         window)
+
+class EndpointSketches:
+    """The sketches of every endpoint of a process, and of the process as a whole."""
+
+    def __init__(self, window: float = LATENCY_SKETCH_WINDOW):
+        self.window = window
+        self.endpoints: Dict[int, EndpointSketch] = {}
+        # Wider counters, since every check of the process is counted here too
+        self.total = EndpointSketch("I")
+
+    def current_window(self) -> int:
+        """The number of the window now."""
+        return current_window(self.window)
+
+    def record(self, endpoint_id: int, status_code: int, duration: float, window: Optional[int] = None):
+        """Count one check of an endpoint. A NaN duration is unknown and not recorded."""
+        if window is None:
+            window = self.current_window()
+        sketch = self.endpoints.get(endpoint_id)
+        if sketch is None:
+            sketch = self.endpoints[endpoint_id] = EndpointSketch()
+        sketch.record(status_code, duration, window)
+        self.total.record(status_code, duration, window)
+
+    def record_batch(self, batch):
+        """Count every check of a StatBatch. Each row updates the sketch of its own endpoint,
+        and the process total is counted from the columns a whole batch at a time.
+        """
+        window = self.current_window()
+        size = len(batch)
+        status_codes, durations = batch.status_code[:size], batch.duration[:size]
+        endpoints = self.endpoints
+        for endpoint_id, status_code, duration in zip(batch.endpoint_id[:size], status_codes, durations):
+            sketch = endpoints.get(endpoint_id)
+            if sketch is None:
+                sketch = endpoints[endpoint_id] = EndpointSketch()
+            sketch.record(status_code, duration, window)
+        self.total.record_checks(status_codes, durations, window)
+
+    def retain(self, endpoint_ids: Set[int]):
+        """Forget the endpoints no longer checked by this process."""
+        for endpoint_id in [endpoint_id for endpoint_id in self.endpoints if endpoint_id not in endpoint_ids]:
+            del self.endpoints[endpoint_id]
+
+    def snapshot(self) -> List[Tuple[int, EndpointSketch]]:
+        """The sketches of every endpoint, to read them outside the event loop."""
+        return list(self.endpoints.items())
+
+def merged(sketches: Iterable[LatencySketch]) -> LatencySketch:
+    """A new sketch holding the counts of every sketch, e.g. of endpoints on different processes."""
+    result = LatencySketch("Q")
+    for sketch in sketches:
+        result.merge(sketch)
+    return result
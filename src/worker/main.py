@@ -2,15 +2,28 @@
 """Entry point of the program.
 This main function runs on a single core.
 Load configuration, Ensure DB is ready, Fetch sites from DB and Start monitoring sites.    
+With WORKER_MODE=supervisor, a supervisor runs this main function in one process per core.
 """
 import signal
 import asyncio
 import os
+from typing import Optional
 
 from src.utils import logger, load_config
 from src.worker.worker import Worker
 from src.worker.metrics_handler import MetricsHandler
-from src.endpoint_manager import EndpointManager
+from src.worker.metrics_buffer import MetricsBuffer
+from src.worker.spool import Spool, METRICS_SPOOL_DIR
+from src.worker.metrics_store import MetricsStore
+from src.worker.truewatch_exporter import create_truewatch_exporter
+from src.worker.supervisor import Supervisor, SUPERVISOR_HEARTBEAT_INTERVAL, NODE_COUNT
+from src.worker.latency_sketch import EndpointSketches
+from src.worker.metrics_server import MetricsServer, WORKER_METRICS_PORT, metrics_port
+from src.worker.instrumentation import runtime_stats
+from src.worker.regex_pool import regex_evaluator
+from src.worker.membership import Membership, use_rendezvous, default_worker_id
+from src.worker.reloader import EndpointReloader, partition_owner
+from src.async_endpoint_manager import create_endpoint_manager, resolve
 
 class WorkerManager:
     """Manager class to handle worker lifecycle."""
@@ -37,70 +50,141 @@ def signal_handler(sig, frame):
     logger.info("Received signal to terminate")
     worker_manager.stop_worker()
 
-async def run_worker(partition_id: int, partition_count: int, metrics_buffer):
-    """Run a worker process."""
-    try:
-        # Initialize endpoint manager
-        endpoint_manager = EndpointManager()
-        endpoint_manager.check_readiness()
-        
-        # Fetch endpoints for this partition
-        endpoints = endpoint_manager.fetch_endpoints(partition_count, partition_id)
-        
-        # Create and run worker
-        worker = Worker(metrics_buffer)
-        worker_manager.set_worker(worker)
-        await worker.run(endpoints)
-    except Exception as e:
-        logger.error(f"Error in worker {partition_id}: {e}")
-        raise e
+async def send_heartbeats(heartbeats, partition_id: int, worker: Worker, metrics_store: MetricsStore):
+    """Send the health and throughput of this process to the supervisor periodically."""
+    while True:
+        scheduler = worker.scheduler
+        heartbeats.put_nowait({
+            "partition_id": partition_id,
+            "pid": os.getpid(),
+            "endpoints": len(scheduler),
+            "in_flight": scheduler.in_flight,
+            "checks": worker.checks,
+            "max_lag": scheduler.stats.max_lag,
+            "rows_written": metrics_store.rows_written,
+        })
+        await asyncio.sleep(SUPERVISOR_HEARTBEAT_INTERVAL)
 
-async def run_metrics_handler(metrics_buffer):
-    """Run the metrics handler."""
-    try:
-        metrics_handler = MetricsHandler(metrics_buffer)
-        await metrics_handler.run()
-    except Exception as e:
-        logger.error(f"Error in metrics handler: {e}")
-        raise e
+def register_gauges(worker: Worker, metrics_buffer: MetricsBuffer, metrics_handler: MetricsHandler):
+    """Report the load of the worker and of the metrics pipeline with the runtime stats."""
+    runtime_stats.gauge("checks_in_flight", lambda: worker.scheduler.in_flight)
+    # The limit adapted to the accuracy bound, or WORKER_MAX_IN_FLIGHT
+    runtime_stats.gauge("checks_in_flight_limit", lambda: worker.scheduler.max_in_flight)
+    runtime_stats.gauge("endpoints", lambda: len(worker.scheduler))
+    runtime_stats.gauge("checks_total", lambda: worker.checks, "counter")
+    runtime_stats.gauge("metrics_buffer_batches", metrics_buffer.qsize)
+    runtime_stats.gauge("metrics_buffer_rows", metrics_buffer.rows)
+    runtime_stats.gauge("metrics_drain_rows", lambda: metrics_handler.stats.last_drain_rows)
+    runtime_stats.gauge("metrics_flush_seconds", lambda: metrics_handler.stats.last_flush_latency)
+    runtime_stats.gauge("regex_inline_cpu_seconds_total", lambda: regex_evaluator.inline_seconds, "counter")
+    runtime_stats.gauge("regex_offloaded_seconds_total", lambda: regex_evaluator.offloaded_seconds, "counter")
+
+async def load_endpoints(endpoint_manager, partition_id: int, partition_count: int):
+    """Fetch the endpoints of this partition, or those this worker owns among the live workers,
+    and start following their changes. It returns them with the reloader, and the membership
+    of the worker if endpoints are assigned by rendezvous hashing, None otherwise.
+    A worker owning nothing yet keeps running, it takes over endpoints when peers leave
+    or are created through the API.
+    """
+    membership = None
+    if use_rendezvous():
+        membership = Membership(endpoint_manager, os.getenv("WORKER_ID") or default_worker_id(partition_id))
+        owns = membership.owns
+    else:
+        owns = partition_owner(partition_count, partition_id)
+    # The change log is followed from before the fetch, so no change is missed
+    reloader = await EndpointReloader(endpoint_manager, owns).start()
+    if membership is not None:
+        endpoints = await membership.join()
+    else:
+        endpoints = await resolve(endpoint_manager.fetch_endpoints(partition_count, partition_id))
+    if not endpoints:
+        logger.warning("No endpoints found in database")
+    return endpoints, reloader, membership
 
-async def main():
-    """Main entry point for the worker."""
+# It wires every part of the process together
+# pylint: disable=too-many-locals
+async def main(partition_id: Optional[int] = None, partition_count: Optional[int] = None, heartbeats=None):
+    """Main entry point for the worker.
+    Without arguments, the partition is read from PARTITION_ID and PARTITION_COUNT.
+    Under a supervisor, heartbeats is the queue the health of the process is sent to.
+    """
     # Load configuration
     load_config()
+    if partition_id is None:
+        partition_id = int(os.getenv("PARTITION_ID", "0"))
+    if partition_count is None:
+        partition_count = int(os.getenv("PARTITION_COUNT", "1"))
     
     # Set up signal handlers
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    # Create worker and metrics handler
-    metrics_buffer = asyncio.Queue()
+    # Create worker and metrics handler.
+    # Rows the buffer or the DB can't take go to spools, and are replayed after a restart too.
+    # Worker processes of a node each have their own spools. Rows the buffer spilled are
+    # spooled apart, as they are still to be sent to TrueWatch when replayed.
+    spool = Spool(os.path.join(METRICS_SPOOL_DIR, f"partition-{partition_id}"))
+    overflow_spool = Spool(os.path.join(METRICS_SPOOL_DIR, f"partition-{partition_id}", "overflow"))
+    metrics_buffer = MetricsBuffer(spool=overflow_spool)
     
-    # Initialize endpoint manager
-    endpoint_manager = EndpointManager()
-    endpoint_manager.check_readiness()
+    # Initialize endpoint manager, DB_DRIVER=asyncpg keeps queries off the event loop
+    endpoint_manager = create_endpoint_manager()
+    await resolve(endpoint_manager.check_readiness())
     
-    # Fetch endpoints for this partition
-    endpoints = endpoint_manager.fetch_endpoints(os.getenv("PARTITION_COUNT"), os.getenv("PARTITION_ID"))
-    if not endpoints:
-        logger.warning("No endpoints found in database")
-        return
+    endpoints, reloader, membership = await load_endpoints(endpoint_manager, partition_id, partition_count)
     
-    # Create tasks for metrics handler and worker
-    tasks = []
+    # Start the metrics handler
+    # Percentiles and status counters of every endpoint are kept in memory for /metrics
+    sketches = EndpointSketches() if WORKER_METRICS_PORT else None
+    metrics_store = MetricsStore(endpoint_manager, spool=spool)
+    metrics_handler = MetricsHandler(metrics_buffer,
+                                     metrics_store,
+                                     create_truewatch_exporter(partition_id),
+                                     spool=spool,
+                                     sketches=sketches)
+    handler_task = asyncio.create_task(metrics_handler.run())
     
-    # Add metrics handler task
-    metrics_handler = MetricsHandler(metrics_buffer)
-    tasks.append(asyncio.create_task(metrics_handler.run()))
-    
-    # Add worker task
+    # Run the worker until it is stopped by a signal
     worker = Worker(metrics_buffer)
     worker_manager.set_worker(worker)
-    tasks.append(asyncio.create_task(worker.run(endpoints)))
-    
-    # Wait for all tasks to complete
-    await asyncio.gather(*tasks)
+    register_gauges(worker, metrics_buffer, metrics_handler)
+    background_tasks = [asyncio.create_task(reloader.run(worker.scheduler))]
+    metrics_server = None
+    if sketches is not None:
+        # Processes of a supervisor each listen on their own port
+        processes = partition_count // NODE_COUNT if heartbeats is not None else None
+        metrics_server = MetricsServer(sketches, worker.scheduler.endpoint_ids,
+                                       port=metrics_port(partition_id, processes),
+                                       runtime=runtime_stats)
+        await metrics_server.start()
+    if heartbeats is not None:
+        background_tasks.append(asyncio.create_task(send_heartbeats(heartbeats, partition_id, worker, metrics_store)))
+    if membership is not None:
+        background_tasks.append(asyncio.create_task(membership.run(worker.scheduler)))
+    try:
+        await worker.run(endpoints)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        if metrics_server is not None:
+            await metrics_server.close()
+        if membership is not None:
+            await membership.leave()
+        # The handler flushes what the worker handed off before stopping
+        metrics_handler.stop()
+        await handler_task
+        await resolve(endpoint_manager.close())
+        spool.close()
+        overflow_spool.close()
+
+def run_child(partition_id: int, partition_count: int, heartbeats):
+    """Entry point of a worker process started by the supervisor."""
+    asyncio.run(main(partition_id, partition_count, heartbeats))
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    
\ No newline at end of file
+    # WORKER_MODE=supervisor runs one worker process per usable core
+    if os.getenv("WORKER_MODE") == "supervisor":
+        Supervisor().run()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,118 @@
+"""
+This module assigns endpoints to the live workers of every node.
+1. Each worker holds a lease in the workers table, renewed with every heartbeat
+2. Each endpoint belongs to the live worker with the highest rendezvous hash of the pair
+3. When a worker joins or leaves, only the endpoints it gains or loses, about 1/N, are moved
+4. Moved endpoints are added to or removed from the running scheduler, without a restart
+5. Leases and endpoints are queried in a thread with psycopg2, so a rebalance never stalls the checks in flight
+"""
+import asyncio
+import hashlib
+import os
+import socket
+from typing import Iterable, List
+
+from src.utils import logger
+from src.endpoint import Endpoint
+from src.worker.scheduler import Scheduler
+from src.async_endpoint_manager import call
+
+# "modulo" splits endpoints by PARTITION_ID and PARTITION_COUNT, "rendezvous" among the live workers
+PARTITIONING = os.getenv("PARTITIONING", "modulo")
+# Seconds a worker stays live without heartbeat
+MEMBERSHIP_LEASE = float(os.getenv("MEMBERSHIP_LEASE", "30"))
+# How often a worker renews its lease and checks the membership, in seconds
+MEMBERSHIP_HEARTBEAT_INTERVAL = float(os.getenv("MEMBERSHIP_HEARTBEAT_INTERVAL", "10"))
+
+def use_rendezvous() -> bool:
+    """Tell if endpoints are assigned among the live workers."""
+    return PARTITIONING == "rendezvous"
+
+def default_worker_id(partition_id: int) -> str:
+    """A worker id unique in the cluster: the pod name and the process index."""
+    return f"{socket.gethostname()}-{partition_id}"
+
+def rendezvous_score(worker_id: str, endpoint_id: int) -> int:
+    """Stable hash of a (worker, endpoint) pair, the same in every process."""
+    digest = hashlib.blake2b(f"{worker_id}/{endpoint_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def owner(endpoint_id: int, workers: Iterable[str]) -> str:
+    """The worker an endpoint belongs to."""
+    return max(workers, key=lambda worker_id: rendezvous_score(worker_id, endpoint_id))
+
+def owned(endpoints: Iterable[Endpoint], workers: List[str], worker_id: str) -> List[Endpoint]:
+    """The endpoints belonging to a worker."""
+    if worker_id not in workers:
+        workers = workers + [worker_id]
+    return [endpoint for endpoint in endpoints if owner(endpoint.endpoint_id, workers) == worker_id]
+
+class Membership:
+    """Lease of one worker and the share of endpoints it owns."""
+
+    def __init__(self,
+                 endpoint_manager,
+                 worker_id: str,
+                 lease: float = MEMBERSHIP_LEASE,
+                 interval: float = MEMBERSHIP_HEARTBEAT_INTERVAL):
+        """Initialize the membership on top of an (Async)EndpointManager."""
+        self.endpoint_manager = endpoint_manager
+        self.worker_id = worker_id
+        self.lease = lease
+        self.interval = interval
+        self.workers: List[str] = []
+
+    async def join(self) -> List[Endpoint]:
+        """Take a lease and return the endpoints this worker owns."""
+        self.workers = await call(self.endpoint_manager.renew_lease, self.worker_id, self.lease)
+        endpoints = await self._owned_endpoints()
+        logger.info(f"Worker {self.worker_id} joined {len(self.workers)} workers, "
+                    f"it owns {len(endpoints)} endpoints")
+        return endpoints
+
+    async def run(self, scheduler: Scheduler):
+        """Renew the lease periodically, and rebalance the scheduler when the live workers change."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                workers = await call(self.endpoint_manager.renew_lease, self.worker_id, self.lease)
+            except Exception as e:
+                # Keep checking the current endpoints, peers take them over if the lease expires
+                logger.warning(f"Worker {self.worker_id} could not renew its lease: {e}")
+                continue
+            if workers != self.workers:
+                logger.info(f"Live workers changed from {len(self.workers)} to {len(workers)}")
+                self.workers = workers
+                await self.rebalance(scheduler)
+
+    def owns(self, endpoint_id: int) -> bool:
+        """Tell if an endpoint belongs to this worker among the live workers known."""
+        workers = self.workers if self.worker_id in self.workers else self.workers + [self.worker_id]
+        return owner(endpoint_id, workers) == self.worker_id
+
+    async def rebalance(self, scheduler: Scheduler):
+        """Schedule the endpoints gained and unschedule those lost, leaving the others untouched."""
+        endpoints = await self._owned_endpoints()
+        owned_ids = {endpoint.endpoint_id for endpoint in endpoints}
+        lost = scheduler.endpoint_ids() - owned_ids
+        for endpoint_id in lost:
+            scheduler.remove(endpoint_id)
+        gained = 0
+        for endpoint in endpoints:
+            if endpoint.endpoint_id not in scheduler:
+                # The first check is spread over one interval, so gained endpoints don't fire at once
+                scheduler.add(endpoint)
+                gained += 1
+        logger.info(f"Worker {self.worker_id} gained {gained} and lost {len(lost)} endpoints")
+
+    async def _owned_endpoints(self) -> List[Endpoint]:
+        endpoints = await call(self.endpoint_manager.fetch_all_endpoints)
+        # Hashing every endpoint with every worker takes a while with 20k endpoints, off the event loop
+        return await asyncio.to_thread(owned, endpoints, self.workers, self.worker_id)
+
+    async def leave(self):
+        """Release the lease, so peers take over without waiting for it to expire."""
+        try:
+            await call(self.endpoint_manager.release_lease, self.worker_id)
+        except Exception as e:
+            logger.warning(f"Worker {self.worker_id} could not release its lease: {e}")
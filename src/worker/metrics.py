@@ -1,13 +1,42 @@
 """
 Module for performance metrics.
+Durations and phases are measured on the monotonic clock by a PhaseTimer, the
+timestamp is the wall clock time the check started at.
+The worker writes its checks straight into a StatBatch, Stat builds a single
+check for the legacy paths and the tests.
 """
 import json
-import time
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
 
 from src.endpoint import Endpoint
+from src.worker.body_reader import read_and_match_all
+from src.worker.timing import PhaseTimer, UNKNOWN_PHASES
 
+# (regex_match, bytes_read, truncated, regex_timed_out) of a check whose body was not
+# evaluated, e.g. a failed request or a status other than 200. A check of an endpoint without
+# a regex has no regex_match, NULL in the DB, so it is up on any 200 response.
+NO_MATCH = (False, 0, False, False)
+NO_REGEX = (None, 0, False, False)
+
+def unmatched(endpoint: Endpoint) -> tuple:
+    """The regex result of a check of the endpoint whose body was not evaluated."""
+    return NO_MATCH if endpoint.regex_pattern else NO_REGEX
+
+async def evaluate_response(response, endpoints: Sequence[Endpoint]) -> List[tuple]:
+    """Evaluate the regexes of the endpoints against the body of a response, read once.
+    It returns the (regex_match, bytes_read, truncated, regex_timed_out) of each endpoint.
+    The body is only read if the status is 200.
+    """
+    results = [unmatched(endpoint) for endpoint in endpoints]
+    if response.status == 200:
+        with_regex = [i for i, endpoint in enumerate(endpoints) if endpoint.regex_pattern]
+        matched = await read_and_match_all(response, [endpoints[i] for i in with_regex])
+        for i, result in zip(with_regex, matched):
+            results[i] = result
+    return results
+
+# pylint: disable=too-many-instance-attributes
 @dataclass
 class Stat:
     """Class for storing endpoint monitoring statistics."""
@@ -16,24 +45,36 @@ class Stat:
     status_code: Optional[int] = None
     duration: Optional[float] = None
     regex_match: Optional[bool] = None
+    bytes_read: int = 0
+    truncated: bool = False
+    regex_timed_out: bool = False
+    # Started more than SCHEDULER_LATE_AFTER after its deadline
+    late: bool = False
+    # DNS, connect, TLS, time to first byte and transfer in microseconds, see timing.PHASES
+    phases: Tuple[int, ...] = UNKNOWN_PHASES
+    # Started with the Stat, and passed to the request as its trace_request_ctx
+    timer: PhaseTimer = field(default_factory=PhaseTimer, repr=False, compare=False)
     
     async def build_from_successful_http_req(self, response):
-        """Build stats from a successful HTTP response."""
+        """Build stats from a successful HTTP response. The duration covers the body."""
         self.status_code = response.status
-        self.duration = time.time() - self.timestamp
-            
-        if self.status_code == 200 and self.endpoint.regex:
-            text = await response.text()
-            self.regex_match = bool(self.endpoint.regex.match(text))
-        else:
-            self.regex_match = False
+        (self.regex_match,
+         self.bytes_read,
+         self.truncated,
+         self.regex_timed_out) = (await evaluate_response(response, [self.endpoint]))[0]
+        self._finish()
     
     def build_from_failed_http_req(self):
         """Build stats from a failed HTTP request."""
         self.status_code = 0
-        self.regex_match = False
-        self.duration = time.time() - self.timestamp
+        self.regex_match = unmatched(self.endpoint)[0]
+        self._finish()
+
+    def _finish(self):
+        self.timer.finish()
+        self.duration = self.timer.duration
+        self.phases = self.timer.phases()
 
     def __str__(self):
         """Output as a json string"""
-        return json.dumps(self.__dict__)
+        return json.dumps({key: value for key, value in self.__dict__.items() if key != "timer"})
@@ -0,0 +1,104 @@
+"""
+This module contains the bounded buffer between workers and the metrics handler.
+1. Workers put whole StatBatch objects
+2. The metrics handler drains every batch at once, when enough rows are buffered or a timeout is spent
+3. When the buffer is full, the overflow policy blocks the worker, drops the oldest batch, or spills to the spool
+"""
+import asyncio
+import collections
+import os
+import time
+from typing import Dict, List, Optional
+
+from src.utils import logger
+from src.worker.spool import Spool
+from src.worker.stat_batch import StatBatch
+
+# Batches buffered at most, whatever their number of rows
+METRICS_BUFFER_SIZE = int(os.getenv("METRICS_BUFFER_SIZE", "100"))
+# "block" makes workers wait, "drop-oldest" discards the oldest batch, "spill" appends to the spool
+METRICS_OVERFLOW_POLICY = os.getenv("METRICS_OVERFLOW_POLICY", "block")
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "spill")
+
+# pylint: disable=too-many-instance-attributes
+class MetricsBuffer:
+    """Bounded queue of StatBatch objects, drained a whole batch of batches at a time."""
+
+    def __init__(self,
+                 maxsize: int = METRICS_BUFFER_SIZE,
+                 overflow: str = METRICS_OVERFLOW_POLICY,
+                 spool: Optional[Spool] = None):
+        """Initialize the buffer. Spilled batches are replayed from the spool by the metrics handler."""
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spool = spool if spool is not None or overflow != "spill" else Spool()
+        self.dropped = 0
+        self.spilled = 0
+        self._batches = collections.deque()
+        self._rows = 0
+        # Set by every put, so a drain waiting for rows wakes up
+        self._put_event = asyncio.Event()
+        # Set whenever a drain makes room
+        self._room_event = asyncio.Event()
+
+    def qsize(self) -> int:
+        """Number of batches buffered in memory."""
+        return len(self._batches)
+
+    def rows(self) -> int:
+        """Number of rows buffered in memory."""
+        return self._rows
+
+    def full(self) -> bool:
+        """Tell if a put would overflow."""
+        return len(self._batches) >= self.maxsize
+
+    def stats(self) -> Dict[str, int]:
+        """Depth of the buffer and overflow counters, in batches and rows."""
+        return {
+            "batches": len(self._batches),
+            "rows": self._rows,
+            "dropped_rows": self.dropped,
+            "spilled_rows": self.spilled,
+        }
+
+    async def put(self, batch: StatBatch):
+        """Buffer a batch, applying the overflow policy if the buffer is full."""
+        if self.full():
+            if self.overflow == "block":
+                while self.full():
+                    self._room_event.clear()
+                    await self._room_event.wait()
+            elif self.overflow == "drop-oldest":
+                dropped = self._batches.popleft()
+                self._rows -= len(dropped)
+                self.dropped += len(dropped)
+                logger.warning(f"Dropping {len(dropped)} metrics, the metrics buffer is full")
+            else:
+                await asyncio.to_thread(self.spool.append, [batch])
+                self.spilled += len(batch)
+                return
+        self._batches.append(batch)
+        self._rows += len(batch)
+        self._put_event.set()
+
+    async def drain(self, min_rows: int, timeout: float) -> List[StatBatch]:
+        """Wait until min_rows rows are buffered or timeout seconds are spent, then take every batch."""
+        deadline = time.monotonic() + timeout
+        while self._rows < min_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._put_event.clear()
+            try:
+                await asyncio.wait_for(self._put_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batches = list(self._batches)
+        self._batches.clear()
+        self._rows = 0
+        self._room_event.set()
+        return batches
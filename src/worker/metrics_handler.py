@@ -1,30 +1,109 @@
 """This module handles metrics collection and sending to TrueWatch.
-1. Collect metrics from buffer
-2. Send metrics to TrueWatch
+1. Collect batches of metrics from buffer, once N rows are buffered or T milliseconds are spent
+2. Store metrics in the metrics hypertable
+3. Send metrics to TrueWatch
+4. Report the queue depth and flush latency, to tune N and T against end-to-end delay
+5. Replay the spool into the metrics hypertable once the DB is reachable again, and
+   send the rows the buffer spilled to TrueWatch and the sketches too
+6. Count every check in the latency sketches served on /metrics
+7. Time the hand-off and flush of every row for the runtime stats
 """
 import os
 import asyncio
-from typing import List
-from asyncio import Queue
-import requests
+import itertools
+import operator
+import time
+from typing import Dict, List, Optional
 
 from src.utils import logger
-from src.worker.metrics import Stat
+from src.worker.latency_sketch import EndpointSketches
+from src.worker.instrumentation import runtime_stats
+from src.worker.metrics_buffer import MetricsBuffer
+from src.worker.metrics_store import MetricsStore
+from src.worker.spool import Spool
+from src.worker.stat_batch import StatBatch
+from src.worker.truewatch_exporter import TrueWatchExporter
 
-PG_BATCH_SIZE = 1000
+# Rows drained from the buffer at once, unless the timeout is spent first
+METRICS_BATCH_ROWS = int(os.getenv("METRICS_BATCH_ROWS", "5000"))
+# Milliseconds waited at most for METRICS_BATCH_ROWS rows
+METRICS_BATCH_TIMEOUT_MS = float(os.getenv("METRICS_BATCH_TIMEOUT_MS", "200"))
+# How often the handler stats are logged, in seconds
+METRICS_REPORT_INTERVAL = float(os.getenv("METRICS_REPORT_INTERVAL", "60"))
+# How often the spool is checked for rows to replay, in seconds
+METRICS_REPLAY_INTERVAL = float(os.getenv("METRICS_REPLAY_INTERVAL", "5"))
 
-# TrueWatch configuration
-TRUEWATCH_ENABLED = os.getenv("TRUEWATCH_ENABLED", "true") == "true"
-truewatch_host = os.getenv("TRUEWATCH_HOST", "localhost")
-truewatch_port = int(os.getenv("TRUEWATCH_PORT", "9529"))
-truewatch_url = f"http://{truewatch_host}:{truewatch_port}"
+# pylint: disable=too-many-instance-attributes
+class MetricsHandlerStats:
+    """Drain and flush counters of a MetricsHandler."""
+
+    def __init__(self):
+        self.drains = 0
+        self.rows = 0
+        self.last_drain_rows = 0
+        self.max_drain_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.max_delay = 0.0
+        self._flush_latency_sum = 0.0
+
+    def record_drain(self, rows: int, flush_latency: float, delay: float):
+        """Record one drain, the time spent flushing it and the age of its oldest row."""
+        self.drains += 1
+        self.rows += rows
+        self.last_drain_rows = rows
+        self.max_drain_rows = max(self.max_drain_rows, rows)
+        self.last_flush_latency = flush_latency
+        self.max_flush_latency = max(self.max_flush_latency, flush_latency)
+        self.max_delay = max(self.max_delay, delay)
+        self._flush_latency_sum += flush_latency
+
+    @property
+    def mean_flush_latency(self) -> float:
+        """Mean flush latency of all drains in the reporting window."""
+        return self._flush_latency_sum / self.drains if self.drains else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        """Output as a dict so it can be logged or exported."""
+        return {
+            "drains": self.drains,
+            "rows": self.rows,
+            "last_drain_rows": self.last_drain_rows,
+            "max_drain_rows": self.max_drain_rows,
+            "last_flush_latency": self.last_flush_latency,
+            "mean_flush_latency": self.mean_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+            "max_delay": self.max_delay,
+        }
 
 class MetricsHandler:
     """Handler for processing and storing metrics."""
     
-    def __init__(self, metrics_buffer: Queue):
-        """Initialize the metrics handler."""
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 metrics_buffer: MetricsBuffer,
+                 metrics_store: Optional[MetricsStore] = None,
+                 exporter: Optional[TrueWatchExporter] = None,
+                 batch_rows: int = METRICS_BATCH_ROWS,
+                 batch_timeout_ms: float = METRICS_BATCH_TIMEOUT_MS,
+                 spool: Optional[Spool] = None,
+                 sketches: Optional[EndpointSketches] = None):
+        """Initialize the metrics handler.
+        Without a metrics store, metrics are not persisted in PostgreSQL.
+        Without an exporter, metrics are not sent to TrueWatch.
+        With a spool, rows spooled by the store are replayed into the store.
+        Rows the buffer spilled to a spool of its own never reached this handler, they are
+        replayed into the store, the exporter and the sketches.
+        With sketches, the duration and status of every check are counted in them.
+        """
         self.metrics_buffer = metrics_buffer
+        self.metrics_store = metrics_store
+        self.exporter = exporter
+        self.spool = spool
+        self.sketches = sketches
+        self.batch_rows = batch_rows
+        self.batch_timeout = batch_timeout_ms / 1000
+        self.stats = MetricsHandlerStats()
         self._running = True
 
     def stop(self):
@@ -34,76 +113,124 @@ class MetricsHandler:
     async def run(self):
         """Run the metrics handler."""
         logger.info(f"MetricsHandler {id(self)} started")
+        if self.exporter is not None:
+            await self.exporter.start()
+        replayers = []
+        if self.spool is not None and self.metrics_store is not None:
+            replayers.append(asyncio.create_task(self._replay_spool(self.spool)))
+        overflow = self.metrics_buffer.spool
+        if overflow is not None and overflow is not self.spool:
+            replayers.append(asyncio.create_task(self._replay_spool(overflow, export=True)))
+        last_report = time.monotonic()
         while self._running:
             try:
-                queue_size = self.metrics_buffer.qsize()
-                if queue_size > 0:
-                    logger.info(f"Processing {queue_size} metrics")
-                    metrics = []
-                    consumer_length = queue_size if queue_size < PG_BATCH_SIZE else PG_BATCH_SIZE
-                    logger.info(f"MetricsHandler consumes {consumer_length}")
-                    for _ in range(consumer_length):
-                        metric = await self.metrics_buffer.get()
-                        metrics.append(metric)
-                        await self._process_metric(metric)
-                        self.metrics_buffer.task_done()
-                    # Send metrics to TrueWatch if enabled
-                    self._send_metrics_to_truewatch(metrics)
+                # Sleeps until enough rows are buffered or the timeout is spent, never spins
+                batches = await self.metrics_buffer.drain(self.batch_rows, self.batch_timeout)
+                await self._process(batches)
             except Exception as e:
                 logger.error(f"Error processing metric: {e}")
                 await asyncio.sleep(1)
+
+            if time.monotonic() - last_report >= METRICS_REPORT_INTERVAL:
+                self._report()
+                last_report = time.monotonic()
+        for replayer in replayers:
+            replayer.cancel()
+        # Whatever workers handed off before stopping
+        await self._process(await self.metrics_buffer.drain(0, 0))
+        if self.metrics_store is not None:
+            await self.metrics_store.flush()
+        if self.exporter is not None:
+            await self.exporter.close()
         logger.info("Exiting MetricsHandler loop")
 
-    async def _process_metric(self, metric: Stat):
-        """Process a single metric."""
+    async def _process(self, batches: List[StatBatch]):
+        """Store and send drained batches, and record how long it took."""
+        if not batches:
+            # Nothing to consume, but the time budget of a partial batch may be spent
+            if self.metrics_store is not None:
+                await self.metrics_store.flush_if_due()
+            return
+        started = time.monotonic()
+        delay = time.time() - min((batch.timestamp[0] for batch in batches if len(batch)), default=time.time())
+        if self.sketches is not None:
+            for batch in batches:
+                self.sketches.record_batch(batch)
+        self._record_handoff(batches)
+        await self._store_metrics(batches)
+        # Send metrics to TrueWatch if enabled
+        await self._send_metrics_to_truewatch(batches)
+        flush_latency = time.monotonic() - started
+        self.stats.record_drain(sum(len(batch) for batch in batches), flush_latency, delay)
+        runtime_stats.record("flush", flush_latency)
+
+    @staticmethod
+    def _record_handoff(batches: List[StatBatch]):
+        """Record how long each row waited between the end of its check and this drain.
+        The waits are computed from the columns, and recorded a whole drain at a time.
+        """
+        now = time.time()
+        waits: List[float] = []
+        for batch in batches:
+            timestamps = batch.timestamp[:len(batch)]
+            # max() skips a NaN end, so a check of unknown duration ends when it started
+            ends = map(max, timestamps, map(operator.add, timestamps, batch.duration[:len(batch)]))
+            waits.extend(map(max, itertools.repeat(0.0), map(operator.sub, itertools.repeat(now), ends)))
+        runtime_stats.record_many("handoff", waits)
+
+    async def _replay_spool(self, spool: Spool, export: bool = False):
+        """Replay spooled rows, and commit each batch once stored. A crash before the
+        commit replays the batch again, which the store deduplicates, and TrueWatch too as
+        the points are the same. With export, rows are sent to the exporter and counted in
+        the sketches once stored.
+        """
+        while True:
+            await asyncio.sleep(METRICS_REPLAY_INTERVAL)
+            while spool:
+                batch, cursor = await asyncio.to_thread(spool.read, self.batch_rows)
+                if batch:
+                    inserted = None
+                    if self.metrics_store is not None:
+                        try:
+                            inserted = await self.metrics_store.replay(batch)
+                        except Exception as e:
+                            logger.warning(f"Metrics are still spooled, the DB is unreachable: {e}")
+                            break
+                    if export:
+                        if self.sketches is not None:
+                            self.sketches.record_batch(batch)
+                        await self._send_metrics_to_truewatch([batch])
+                    logger.info(f"Replayed {len(batch)} spooled metrics, {inserted} were new")
+                await asyncio.to_thread(spool.commit, cursor)
+                if not batch:
+                    break
+
+    def _report(self):
+        stats = self.stats.as_dict()
+        stats["queue"] = self.metrics_buffer.stats()
+        if self.spool is not None:
+            stats["spool"] = self.spool.stats()
+        if self.exporter is not None:
+            stats["truewatch"] = self.exporter.stats()
+        logger.info(f"MetricsHandler stats: {stats}")
+        # Start a new reporting window
+        self.stats = MetricsHandlerStats()
+
+    async def _store_metrics(self, batches: List[StatBatch]):
+        """Store batches of metrics in the database."""
+        if self.metrics_store is None:
+            return
         try:
-            # TODO: Store metric in database
-            logger.info(f"Processed metric for {metric.endpoint.url}")
+            for batch in batches:
+                await self.metrics_store.add(batch)
         except Exception as e:
-            logger.error(f"Error storing metric: {e}")
-
-    def _send_metrics_to_truewatch(self, metrics: List[Stat]):
-        """Send metrics to TrueWatch using HTTP API.
-        TrueWatch expects metrics in the following format:
-        {
-            "measurement": "site_uptime_watcher",
-            "tags": {
-                "endpoint": "url",
-                "status_code": "code",
-                "regex_match": "true/false"
-            },
-            "fields": {
-                "response_time": value,
-                "status_code": value,
-                "regex_match": 1/0
-            }
-        }
-        """
+            logger.error(f"Error storing metrics: {e}")
+
+    async def _send_metrics_to_truewatch(self, batches: List[StatBatch]):
+        """Queue batches for the TrueWatch exporter, which sends them in the background."""
+        if self.exporter is None:
+            return
         try:
-            # Prepare metrics data for all metrics in the batch
-            metrics_data = []
-            for metric in metrics:
-                # Create tags for the metrics
-                tags = {
-                    "endpoint": metric.endpoint.url,
-                    "status_code": str(metric.status_code),
-                    "regex_match": str(metric.regex_match).lower()
-                }
-                # Add metrics data
-                metrics_data.append({
-                    "measurement": "site_uptime_watcher",
-                    "tags": tags,
-                    "fields": {
-                        "response_time": metric.duration,
-                        "status_code": metric.status_code,
-                        "regex_match": 1 if metric.regex_match else 0
-                    }
-                })
-            # Send metrics via HTTP API
-            metrics_url = f"{truewatch_url}/v1/write/metrics"
-            response = requests.post(metrics_url, json=metrics_data, timeout=5)
-            if response.status_code != 200:
-                logger.error(f"Error sending metrics to TrueWatch: {response.status_code} - {response.text}")
+            await self.exporter.submit(batches)
         except Exception as e:
             logger.error(f"Error sending metrics to TrueWatch: {e}")
-            
\ No newline at end of file
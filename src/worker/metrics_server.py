@@ -0,0 +1,149 @@
+"""
+This module serves the in-memory stats of a worker process to Prometheus.
+1. Listen on WORKER_METRICS_PORT with a minimal aiohttp server, for /metrics only
+2. Render the latency sketches and status counters in the Prometheus text format
+3. Render the runtime stats of the process: loop lag, stage timings and gauges
+4. Render in a thread from a snapshot, so scraping thousands of endpoints doesn't stall the checks
+"""
+import asyncio
+import os
+from typing import Callable, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+from src.utils import logger
+from src.worker.instrumentation import RuntimeStats
+from src.worker.latency_sketch import EndpointSketch, EndpointSketches, WindowedSketch, STATUS_CLASSES, quantiles
+
+# Port of the /metrics listener, 0 disables it. Worker processes under a supervisor
+# listen on the ports following it, one each
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+WORKER_METRICS_HOST = os.getenv("WORKER_METRICS_HOST", "0.0.0.0")
+
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def metrics_port(partition_id: int, processes: Optional[int], base: int = WORKER_METRICS_PORT) -> int:
+    """The port of a worker process, processes being the number of processes on this node if supervised."""
+    if not base or not processes:
+        return base
+    return base + partition_id % processes
+
+def _value(value: Optional[float]) -> str:
+    return "NaN" if value is None else repr(value)
+
+def _summary(lines: List[str], name: str, labels: str, sketch: WindowedSketch, window: int):
+    """Append the quantiles, sum and count of a sketch, labels being empty or ending with a comma."""
+    values = quantiles(sketch.recent(window), QUANTILES)
+    for fraction, value in zip(QUANTILES, values):
+        lines.append(f'{name}{{{labels}quantile="{fraction}"}} {_value(value)}')
+    braces = f"{{{labels[:-1]}}}" if labels else ""
+    lines.append(f"{name}_sum{braces} {sketch.duration_sum!r}")
+    lines.append(f"{name}_count{braces} {sketch.durations}")
+
+def _statuses(lines: List[str], name: str, labels: str, sketch: EndpointSketch):
+    """Append the counters of the status classes seen."""
+    for status_class, count in zip(STATUS_CLASSES, sketch.statuses):
+        if count:
+            lines.append(f'{name}{{{labels}status="{status_class}"}} {count}')
+
+def render(total: EndpointSketch, snapshot: List[Tuple[int, EndpointSketch]], window: int) -> str:
+    """The sketches of a process in the Prometheus text format. It reads a snapshot taken
+    in the event loop, so it may run in a thread while checks are recorded.
+    """
+    lines = [
+        "# HELP watcher_check_duration_seconds Duration of the checks of this process, "
+        "over the last one to two windows.",
+        "# TYPE watcher_check_duration_seconds summary",
+    ]
+    _summary(lines, "watcher_check_duration_seconds", "", total, window)
+    lines += [
+        "# HELP watcher_checks_total Checks of this process by status class.",
+        "# TYPE watcher_checks_total counter",
+    ]
+    _statuses(lines, "watcher_checks_total", "", total)
+    lines += [
+        "# HELP watcher_endpoint_check_duration_seconds Duration of the checks of an endpoint, "
+        "over the last one to two windows.",
+        "# TYPE watcher_endpoint_check_duration_seconds summary",
+    ]
+    for endpoint_id, sketch in snapshot:
+        _summary(lines, "watcher_endpoint_check_duration_seconds", f'endpoint_id="{endpoint_id}",', sketch, window)
+    lines += [
+        "# HELP watcher_endpoint_checks_total Checks of an endpoint by status class.",
+        "# TYPE watcher_endpoint_checks_total counter",
+    ]
+    for endpoint_id, sketch in snapshot:
+        _statuses(lines, "watcher_endpoint_checks_total", f'endpoint_id="{endpoint_id}",', sketch)
+    lines.append("")
+    return "\n".join(lines)
+
+def render_runtime(runtime: RuntimeStats, window: int) -> str:
+    """The runtime stats of a process in the Prometheus text format. Gauges are read
+    as it renders, so it runs in the event loop.
+    """
+    lines = [
+        "# HELP watcher_event_loop_lag_seconds Lateness of the event loop waking up a sleeping task.",
+        "# TYPE watcher_event_loop_lag_seconds summary",
+    ]
+    _summary(lines, "watcher_event_loop_lag_seconds", "", runtime.loop_lag, window)
+    lines += [
+        "# HELP watcher_check_stage_seconds Time the checks of this process spent in each stage.",
+        "# TYPE watcher_check_stage_seconds summary",
+    ]
+    for stage, sketch in runtime.stages.items():
+        _summary(lines, "watcher_check_stage_seconds", f'stage="{stage}",', sketch, window)
+    for name, (kind, read) in runtime.gauges.items():
+        lines.append(f"# TYPE watcher_{name} {kind}")
+        lines.append(f"watcher_{name} {read()!r}")
+    lines.append("")
+    return "\n".join(lines)
+
+class MetricsServer:
+    """A /metrics listener of the sketches of a worker process."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 sketches: EndpointSketches,
+                 endpoint_ids: Optional[Callable[[], Set[int]]] = None,
+                 port: int = WORKER_METRICS_PORT,
+                 host: str = WORKER_METRICS_HOST,
+                 runtime: Optional[RuntimeStats] = None):
+        """endpoint_ids tells the endpoints still checked, the sketches of the others are dropped.
+        With runtime, the runtime stats of the process are served too.
+        """
+        self.sketches = sketches
+        self.endpoint_ids = endpoint_ids
+        self.runtime = runtime
+        self.port = port
+        self.host = host
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        """Start listening. A port already in use is logged, the worker runs without /metrics."""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logger.error(f"Metrics listener can't listen on port {self.port}: {e}")
+            await self.close()
+            return
+        logger.info(f"Metrics listener started on port {self.port}")
+
+    async def close(self):
+        """Stop listening."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        if self.endpoint_ids is not None:
+            self.sketches.retain(self.endpoint_ids())
+        window = self.sketches.current_window()
+        text = await asyncio.to_thread(render, self.sketches.total, self.sketches.snapshot(), window)
+        if self.runtime is not None:
+            text += render_runtime(self.runtime, window)
+        return web.Response(body=text.encode(), headers={"Content-Type": CONTENT_TYPE})
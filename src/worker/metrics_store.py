@@ -0,0 +1,210 @@
+"""
+This module persists metrics into the metrics hypertable.
+1. Buffer the batches drained from the metrics buffer
+2. Flush them with a binary COPY FROM STDIN when enough rows are buffered or the time budget is spent
+3. Run COPY in a thread, or with asyncpg, so the event loop keeps measuring latency
+4. Append the rows of a failed flush to the spool, and replay them without duplicates
+"""
+import asyncio
+import io
+import math
+import os
+import struct
+import time
+from typing import List, Optional, Union
+
+from src.utils import logger
+from src.endpoint_manager import (
+    EndpointManager,
+    METRICS_TABLE_NAME,
+    METRICS_REPLAY_TABLE_NAME,
+    METRICS_REPLAY_TABLE_DDL,
+    metrics_replay_insert,
+)
+from src.async_endpoint_manager import AsyncEndpointManager
+from src.worker.spool import Spool
+from src.worker.stat_batch import StatBatch, MATCH_UNKNOWN
+from src.worker.timing import PHASES, UNKNOWN
+
+# Flush as soon as this many rows are buffered
+METRICS_FLUSH_SIZE = int(os.getenv("METRICS_FLUSH_SIZE", "5000"))
+# Flush buffered rows at least this often, in seconds
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1.0"))
+# Rows kept in memory for retry while the DB is unreachable and there is no spool, older batches are dropped
+METRICS_MAX_PENDING = int(os.getenv("METRICS_MAX_PENDING", str(METRICS_FLUSH_SIZE * 20)))
+
+METRICS_COLUMNS = ("time", "endpoint_id", "status_code", "duration", "regex_match",
+                   "bytes_read", "truncated", "regex_timed_out", *(f"{phase}_us" for phase in PHASES), "late")
+
+# PostgreSQL binary COPY format, see https://www.postgresql.org/docs/current/sql-copy.html
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+# Every field is prefixed with its length, -1 meaning NULL
+_FIELD_COUNT = struct.Struct("!h")
+_TIMESTAMPTZ = struct.Struct("!iq")
+_INT4 = struct.Struct("!ii")
+_INT2 = struct.Struct("!ih")
+_FLOAT8 = struct.Struct("!id")
+_BOOL = struct.Struct("!ib")
+_NULL = struct.pack("!i", -1)
+# timestamptz is sent as microseconds since 2000-01-01 UTC
+_POSTGRES_EPOCH = 946684800
+
+def to_copy_binary(batches: List[StatBatch]) -> bytes:
+    """Encode batches in the binary COPY format, straight from their columns."""
+    payload = bytearray(_COPY_HEADER)
+    field_count = _FIELD_COUNT.pack(len(METRICS_COLUMNS))
+    for batch in batches:
+        phases = tuple(batch.phases.values())
+        for i in range(batch.size):
+            duration = batch.duration[i]
+            regex_match = batch.regex_match[i]
+            payload += field_count
+            payload += _TIMESTAMPTZ.pack(8, round((batch.timestamp[i] - _POSTGRES_EPOCH) * 1_000_000))
+            payload += _INT4.pack(4, batch.endpoint_id[i])
+            payload += _INT2.pack(2, batch.status_code[i])
+            payload += _NULL if math.isnan(duration) else _FLOAT8.pack(8, duration)
+            payload += _NULL if regex_match == MATCH_UNKNOWN else _BOOL.pack(1, regex_match)
+            payload += _INT4.pack(4, batch.bytes_read[i])
+            payload += _BOOL.pack(1, batch.truncated[i])
+            payload += _BOOL.pack(1, batch.regex_timed_out[i])
+            for column in phases:
+                payload += _NULL if column[i] == UNKNOWN else _INT4.pack(4, column[i])
+            payload += _BOOL.pack(1, batch.late[i])
+    payload += _COPY_TRAILER
+    return bytes(payload)
+
+# pylint: disable=too-many-instance-attributes
+class MetricsStore:
+    """Batch writer of the metrics hypertable."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 endpoint_manager: Union[EndpointManager, AsyncEndpointManager],
+                 flush_size: int = METRICS_FLUSH_SIZE,
+                 flush_interval: float = METRICS_FLUSH_INTERVAL,
+                 max_pending: int = METRICS_MAX_PENDING,
+                 spool: Optional[Spool] = None):
+        """Initialize the store on top of the connection pool of an (Async)EndpointManager.
+        With a spool, the rows of a failed flush are appended to it instead of being kept in memory.
+        """
+        self.endpoint_manager = endpoint_manager
+        self.spool = spool
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.rows_written = 0
+        self._pending: List[StatBatch] = []
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        # psycopg2 connections must not be shared by concurrent COPYs
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return self._pending_rows
+
+    def is_due(self) -> bool:
+        """Tell if enough rows are buffered or the time budget is spent."""
+        if not self._pending_rows:
+            return False
+        return (self._pending_rows >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval)
+
+    async def add(self, batch: StatBatch):
+        """Buffer a batch and flush if a trigger is reached."""
+        if len(batch):
+            self._pending.append(batch)
+            self._pending_rows += len(batch)
+        await self.flush_if_due()
+
+    async def flush_if_due(self):
+        """Flush only if enough rows are buffered or the time budget is spent."""
+        if self.is_due():
+            await self.flush()
+
+    async def flush(self):
+        """Write every buffered row with a single COPY."""
+        async with self._flush_lock:
+            batches, rows = self._pending, self._pending_rows
+            self._pending, self._pending_rows = [], 0
+            self._last_flush = time.monotonic()
+            if not batches:
+                return
+            try:
+                # Rows are packed in pure Python, off the event loop so checks keep their schedule
+                payload = await asyncio.to_thread(to_copy_binary, batches)
+                if isinstance(self.endpoint_manager, AsyncEndpointManager):
+                    await self.endpoint_manager.copy_metrics(METRICS_COLUMNS, payload)
+                else:
+                    await asyncio.to_thread(self._copy, payload)
+                self.rows_written += rows
+            except Exception as e:
+                logger.error(f"Error storing {rows} metrics: {e}")
+                await self._spool_or_keep(batches, rows)
+
+    async def replay(self, batch: StatBatch) -> int:
+        """Write rows read back from the spool, skipping those already stored.
+        It raises if the DB is still unreachable, and returns the number of rows inserted.
+        """
+        payload = await asyncio.to_thread(to_copy_binary, [batch])
+        if isinstance(self.endpoint_manager, AsyncEndpointManager):
+            inserted = await self.endpoint_manager.replay_metrics(METRICS_COLUMNS, payload)
+        else:
+            inserted = await asyncio.to_thread(self._replay, payload)
+        self.rows_written += inserted
+        return inserted
+
+    def _copy(self, payload: bytes):
+        """Run COPY FROM STDIN on a pooled connection. It runs in a worker thread."""
+        conn = self.endpoint_manager.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {METRICS_TABLE_NAME} ({', '.join(METRICS_COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(payload)
+                    )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            self.endpoint_manager.release_connection(conn)
+
+    def _replay(self, payload: bytes) -> int:
+        """Copy replayed rows into the replay table and insert the new ones. It runs in a worker thread."""
+        conn = self.endpoint_manager.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(METRICS_REPLAY_TABLE_DDL)
+                cursor.copy_expert(
+                    f"COPY {METRICS_REPLAY_TABLE_NAME} ({', '.join(METRICS_COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(payload)
+                    )
+                cursor.execute(metrics_replay_insert(METRICS_COLUMNS))
+                inserted = cursor.rowcount
+            conn.commit()
+            return inserted
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            self.endpoint_manager.release_connection(conn)
+
+    async def _spool_or_keep(self, batches: List[StatBatch], rows: int):
+        """Append the rows of a failed flush to the spool, or keep them in memory without one."""
+        if self.spool is not None:
+            try:
+                await asyncio.to_thread(self.spool.append, batches)
+                return
+            except Exception as e:
+                logger.error(f"Error spooling {rows} metrics: {e}")
+        self._keep_for_retry(batches, rows)
+
+    def _keep_for_retry(self, batches: List[StatBatch], rows: int):
+        """Put batches of a failed flush back in front of the buffer, within max_pending."""
+        self._pending = batches + self._pending
+        self._pending_rows += rows
+        while self._pending_rows > self.max_pending and len(self._pending) > 1:
+            dropped = self._pending.pop(0)
+            self._pending_rows -= len(dropped)
+            logger.warning(f"Dropping {len(dropped)} metrics, the metrics buffer is full")
@@ -0,0 +1,243 @@
+"""
+This module evaluates regular expressions without freezing the event loop.
+1. Safe patterns are matched inline, on the event loop, unless the text is unusually long
+2. Patterns at risk of catastrophic backtracking, and texts over a threshold, are sent
+   to a pool of matcher processes
+3. A match running over its time budget is cancelled by killing its process
+4. A matcher process which dies is replaced, and its match is run inline if the pattern is safe,
+   or flagged as not evaluated otherwise
+"""
+import asyncio
+import functools
+import multiprocessing
+import os
+import re
+import time
+from typing import Dict, Optional
+
+from src.utils import logger
+from src.endpoint import Endpoint
+from src.worker.instrumentation import runtime_stats
+
+# "inline" matches everything on the event loop, "process" offloads risky patterns and large texts
+REGEX_EVALUATION = os.getenv("REGEX_EVALUATION", "inline")
+# Texts longer than this, in characters, are matched in the process pool whatever the pattern.
+# It is above the windows of the body reader, a BODY_CHUNK_SIZE chunk and REGEX_OVERLAP_CHARS,
+# so the pattern alone decides for them.
+REGEX_OFFLOAD_THRESHOLD = int(os.getenv("REGEX_OFFLOAD_THRESHOLD", "65536"))
+# Number of matcher processes per worker process
+REGEX_POOL_SIZE = int(os.getenv("REGEX_POOL_SIZE", "2"))
+# Seconds a single offloaded match may run before it is cancelled
+REGEX_TIME_BUDGET = float(os.getenv("REGEX_TIME_BUDGET", "1.0"))
+
+class RegexTimeout(Exception):
+    """Raised if an offloaded match runs over its time budget, or its process dies with a risky pattern."""
+
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+# Escapes and character classes, which hold no group or quantifier
+_ESCAPE_OR_CLASS = re.compile(r"\\.|\[\^?\]?(?:\\.|[^\]\\])*\]")
+_INNERMOST_GROUP = re.compile(r"\(([^()]*)\)")
+_GROUP_PREFIX = re.compile(r"^\?(?:P<\w+>|<[=!]|[:=!])")
+_QUANTIFIER = re.compile(r"[*+?]|\{\d")
+_REPEAT = re.compile(r"[*+]|\{\d")
+# Stands for a group whose length varies, once reduced
+_VARYING = "\0"
+
+@functools.lru_cache(maxsize=4096)
+def backtracking_risk(pattern: str) -> bool:
+    """Tell if a pattern may backtrack catastrophically: it has a backreference, or a repeated
+    group whose length varies, e.g. (a+)+ or (a|aa)*. It is a heuristic on the text of the
+    pattern, innermost groups first.
+    """
+    if _BACKREFERENCE.search(pattern):
+        return True
+    text = _ESCAPE_OR_CLASS.sub("c", pattern)
+    while True:
+        group = _INNERMOST_GROUP.search(text)
+        if group is None:
+            return False
+        inner = _GROUP_PREFIX.sub("", group.group(1))
+        varying = bool(_QUANTIFIER.search(inner)) or "|" in inner or _VARYING in inner
+        if varying and _REPEAT.match(text, group.end()):
+            return True
+        text = text[:group.start()] + (_VARYING if varying else "c") + text[group.end():]
+
+def _serve(conn):
+    """Loop of a matcher process: receive (pattern, text, pos), send the end of the match or None."""
+    compiled = {}
+    # Tell the parent the process has booted, so boot time isn't charged to a match budget
+    conn.send(True)
+    while True:
+        try:
+            pattern, text, pos = conn.recv()
+        except EOFError:
+            return
+        try:
+            if pattern not in compiled:
+                compiled[pattern] = re.compile(pattern)
+            match = compiled[pattern].search(text, pos)
+            conn.send(None if match is None else match.end())
+        except Exception as e:
+            conn.send(e)
+
+class _MatcherProcess:
+    """A matcher process and the parent end of its pipe."""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    async def wait_ready(self):
+        """Wait until the process has booted."""
+        if not self.ready:
+            await self._receive()
+            self.ready = True
+
+    async def search_end(self, pattern: str, text: str, pos: int):
+        """Send one match and wait for its result without blocking the event loop.
+        The result is the end of the match, None, or the exception raised by the child.
+        """
+        self.conn.send((pattern, text, pos))
+        return await self._receive()
+
+    async def _receive(self):
+        """Receive the next message from the process without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+
+        def on_readable():
+            loop.remove_reader(self.conn.fileno())
+            try:
+                result.set_result(self.conn.recv())
+            except Exception as e:
+                result.set_exception(e)
+
+        loop.add_reader(self.conn.fileno(), on_readable)
+        try:
+            return await result
+        finally:
+            # A no-op if on_readable ran, needed if we were cancelled
+            loop.remove_reader(self.conn.fileno())
+
+    def kill(self):
+        """Kill the process, the only way to stop a runaway match."""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+# pylint: disable=too-many-instance-attributes
+class RegexEvaluator:
+    """Match inline or in a process pool, and count both."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 mode: str = REGEX_EVALUATION,
+                 offload_threshold: int = REGEX_OFFLOAD_THRESHOLD,
+                 pool_size: int = REGEX_POOL_SIZE,
+                 time_budget: float = REGEX_TIME_BUDGET):
+        self.offload = mode == "process"
+        self.offload_threshold = offload_threshold
+        self.pool_size = pool_size
+        self.time_budget = time_budget
+        self.inline = 0
+        self.offloaded = 0
+        self.timed_out = 0
+        # Matches whose process died, e.g. killed for its memory
+        self.crashed = 0
+        # CPU time of the inline matches, spent on the event loop
+        self.inline_seconds = 0.0
+        # Time waited for offloaded matches, spent in the matcher processes
+        self.offloaded_seconds = 0.0
+        # Spawned processes don't inherit the threads and sockets of the worker
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: Optional[asyncio.Queue] = None
+        self._processes = []
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of offloaded versus inline matches."""
+        return {"inline": self.inline, "offloaded": self.offloaded, "timed_out": self.timed_out,
+                "crashed": self.crashed}
+
+    async def search_end(self, endpoint: Endpoint, text: str, pos: int = 0) -> Optional[int]:
+        """Search the regex of the endpoint in text from pos and return the end of the match or None.
+        It raises RegexTimeout if an offloaded match runs over the time budget, or if its process
+        dies matching a pattern at risk of backtracking.
+        """
+        if not self.offload or (len(text) - pos <= self.offload_threshold
+                                and not backtracking_risk(endpoint.regex_pattern)):
+            return self._search_inline(endpoint, text, pos)
+
+        self.offloaded += 1
+        matcher = await self._acquire()
+        answered = False
+        started = time.perf_counter()
+        try:
+            await matcher.wait_ready()
+            end = await asyncio.wait_for(matcher.search_end(endpoint.regex_pattern, text, pos), self.time_budget)
+            answered = True
+        except asyncio.TimeoutError as e:
+            self.timed_out += 1
+            logger.warning(f"Regex of {endpoint.url} ran over its budget of {self.time_budget}s")
+            raise RegexTimeout(endpoint.regex_pattern) from e
+        except (EOFError, OSError) as e:
+            # The pipe broke, the process is replaced below
+            self.crashed += 1
+            logger.error(f"Matcher process died matching the regex of {endpoint.url}: {e!r}")
+            if backtracking_risk(endpoint.regex_pattern):
+                raise RegexTimeout(endpoint.regex_pattern) from e
+            end = None
+        finally:
+            elapsed = time.perf_counter() - started
+            self.offloaded_seconds += elapsed
+            runtime_stats.record("regex", elapsed)
+            # A process still busy with a match would answer the next one with a stale result
+            if not answered:
+                matcher = self._replace(matcher)
+            if self._idle is not None:
+                self._idle.put_nowait(matcher)
+        if not answered:
+            # Only the length of the text sent it to the pool, the pattern is safe to match inline
+            return self._search_inline(endpoint, text, pos)
+        if isinstance(end, Exception):
+            raise end
+        return end
+
+    def _search_inline(self, endpoint: Endpoint, text: str, pos: int) -> Optional[int]:
+        """Search on the event loop, and charge its CPU time to the inline matches."""
+        self.inline += 1
+        started = time.thread_time()
+        match = endpoint.search(text, pos)
+        elapsed = time.thread_time() - started
+        self.inline_seconds += elapsed
+        runtime_stats.record("regex", elapsed)
+        return None if match is None else match.end()
+
+    async def _acquire(self) -> _MatcherProcess:
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.pool_size):
+                self._idle.put_nowait(self._start())
+        return await self._idle.get()
+
+    def _start(self) -> _MatcherProcess:
+        matcher = _MatcherProcess(self._context)
+        self._processes.append(matcher)
+        return matcher
+
+    def _replace(self, matcher: _MatcherProcess) -> _MatcherProcess:
+        matcher.kill()
+        self._processes.remove(matcher)
+        return self._start()
+
+    def close(self):
+        """Kill every matcher process."""
+        for matcher in self._processes:
+            matcher.kill()
+        self._processes = []
+        self._idle = None
+
+# The evaluator shared by every check of the process
+regex_evaluator = RegexEvaluator()
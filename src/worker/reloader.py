@@ -0,0 +1,133 @@
+"""
+This module applies the changes of endpoints to a running scheduler.
+1. Read the change log of endpoints after the last version applied
+2. Add, reschedule or cancel only the endpoints changed, never reloading the whole list
+3. Wake up on NOTIFY with asyncpg, and poll the change log anyway, so a missed notification only delays a change
+4. Skip changes of endpoints owned by other workers
+5. Query psycopg2 in a thread, so polling never stalls the checks in flight
+"""
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Optional, Set
+
+from src.utils import logger
+from src.endpoint import Endpoint
+from src.worker.scheduler import Scheduler
+from src.async_endpoint_manager import call
+
+# How often the change log is polled, in seconds
+ENDPOINT_RELOAD_INTERVAL = float(os.getenv("ENDPOINT_RELOAD_INTERVAL", "5"))
+# Changes read at most at once
+ENDPOINT_RELOAD_BATCH = int(os.getenv("ENDPOINT_RELOAD_BATCH", "1000"))
+# A missing version is waited for this long, in seconds. Versions are taken in
+# order but committed in any order, and a rolled back change never shows up.
+ENDPOINT_RELOAD_GAP_TIMEOUT = float(os.getenv("ENDPOINT_RELOAD_GAP_TIMEOUT", "60"))
+
+def partition_owner(partition_count: int, partition_id: int) -> Callable[[int], bool]:
+    """Tell if an endpoint belongs to a partition, the way fetch_endpoints splits them."""
+    return lambda endpoint_id: endpoint_id % partition_count == partition_id
+
+# pylint: disable=too-many-instance-attributes
+class EndpointReloader:
+    """Follow the change log of endpoints with a version cursor."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 endpoint_manager,
+                 owns: Callable[[int], bool],
+                 interval: float = ENDPOINT_RELOAD_INTERVAL,
+                 batch: int = ENDPOINT_RELOAD_BATCH,
+                 gap_timeout: float = ENDPOINT_RELOAD_GAP_TIMEOUT):
+        """Initialize the reloader on top of an (Async)EndpointManager.
+        owns(endpoint_id) tells if this worker checks an endpoint.
+        """
+        self.endpoint_manager = endpoint_manager
+        self.owns = owns
+        self.interval = interval
+        self.batch = batch
+        self.gap_timeout = gap_timeout
+        # Every version up to the cursor is applied
+        self.version = 0
+        self.applied = 0
+        # Versions applied beyond a gap, and since when the gap is waited for
+        self._ahead: Set[int] = set()
+        self._gap_since: Optional[float] = None
+        self._notified = asyncio.Event()
+
+    async def start(self):
+        """Take the current version, before the endpoints are fetched, so no change falls in between.
+        With asyncpg, changes are applied as soon as they are notified.
+        """
+        self.version = await call(self.endpoint_manager.latest_change_version)
+        listen = getattr(self.endpoint_manager, "listen_endpoint_changes", None)
+        if listen is not None:
+            try:
+                await listen(self._on_notify)
+            except Exception as e:
+                logger.warning(f"Could not listen to endpoint changes, polling them: {e}")
+        return self
+
+    async def run(self, scheduler: Scheduler):
+        """Apply the changes of endpoints to the scheduler until cancelled."""
+        while True:
+            try:
+                await asyncio.wait_for(self._notified.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._notified.clear()
+            try:
+                await self.reload(scheduler)
+            except Exception as e:
+                logger.warning(f"Could not reload endpoints, retrying: {e}")
+
+    async def reload(self, scheduler: Scheduler) -> int:
+        """Apply the changes logged since the cursor, and return how many endpoints changed."""
+        changed = 0
+        after = self.version
+        while True:
+            changes = await call(self.endpoint_manager.fetch_endpoint_changes, after, self.batch)
+            # Several changes of an endpoint collapse into its current row
+            latest: Dict[int, Optional[Endpoint]] = {}
+            for version, endpoint_id, endpoint in changes:
+                if version not in self._ahead:
+                    latest[endpoint_id] = endpoint
+                self._ahead.add(version)
+            for endpoint_id, endpoint in latest.items():
+                self._apply(scheduler, endpoint_id, endpoint)
+            changed += len(latest)
+            if len(changes) < self.batch:
+                break
+            after = changes[-1][0]
+        self._advance()
+        if changed:
+            self.applied += changed
+            logger.info(f"Applied changes of {changed} endpoints, up to version {self.version}")
+        return changed
+
+    def _apply(self, scheduler: Scheduler, endpoint_id: int, endpoint: Optional[Endpoint]):
+        """Schedule a created or updated endpoint, cancel a deleted one."""
+        if endpoint is None or not self.owns(endpoint_id):
+            scheduler.remove(endpoint_id)
+        else:
+            scheduler.update(endpoint)
+
+    def _advance(self):
+        """Move the cursor over the versions applied without gap, or past a gap waited for too long."""
+        while self.version + 1 in self._ahead:
+            self.version += 1
+            self._ahead.discard(self.version)
+        if not self._ahead:
+            self._gap_since = None
+            return
+        now = time.monotonic()
+        if self._gap_since is None:
+            self._gap_since = now
+        elif now - self._gap_since >= self.gap_timeout:
+            # The missing versions were rolled back, or will never be seen again
+            self.version = min(self._ahead) - 1
+            self._gap_since = None
+            self._advance()
+
+    def _on_notify(self, _version: int):
+        self._notified.set()
@@ -0,0 +1,304 @@
+"""
+This module contains the Scheduler which replaces one coroutine per endpoint.
+1. Keep every endpoint in a single min-heap ordered by its next deadline
+2. Dispatch due checks to a bounded pool of request tasks
+3. Advance deadlines at a fixed rate, independent of how long a check takes
+4. Report scheduling lag per tick
+5. Let the limit of checks in flight be resized while running, and flag checks starting late
+6. Defer or skip checks held back by a throttle, e.g. the rate limit of their host
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import zlib
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from src.utils import logger
+from src.endpoint import Endpoint
+from src.worker.instrumentation import runtime_stats
+
+# Called with a due endpoint and the time: seconds to defer its check by, None to skip it
+Throttle = Callable[[Endpoint, float], Optional[float]]
+
+def phase_of(endpoint: Endpoint) -> float:
+    """Seconds into each interval the checks of an endpoint are due at. Derived from the URL,
+    so endpoints of the same URL and interval are due together and can share a request,
+    while different URLs are spread evenly over the interval.
+    """
+    return zlib.crc32(endpoint.url.encode()) / 2 ** 32 * endpoint.interval
+
+# Maximum number of checks in flight at the same time in one process
+MAX_IN_FLIGHT = int(os.getenv("WORKER_MAX_IN_FLIGHT", "1000"))
+# Upper bound of how long the scheduler sleeps between two ticks, in seconds
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "0.1"))
+# How often the lag summary is logged, in seconds
+LAG_REPORT_INTERVAL = float(os.getenv("SCHEDULER_LAG_REPORT_INTERVAL", "60"))
+# Lag above this value, in seconds, means the process is overcommitted
+LAG_WARNING_THRESHOLD = float(os.getenv("SCHEDULER_LAG_WARNING_THRESHOLD", "1.0"))
+# A check starting this many seconds after its deadline is flagged as late
+LATE_AFTER = float(os.getenv("SCHEDULER_LATE_AFTER", "1.0"))
+
+# Seconds from the deadline of the running check to its start, set in the task of each check
+check_start_delay: ContextVar[float] = ContextVar("check_start_delay", default=0.0)
+
+# pylint: disable=too-few-public-methods
+class _Entry:
+    """A scheduled endpoint. Cancelled entries are skipped lazily when popped.
+    An entry deferred by the throttle keeps the deadline it was due at, and runs when popped again.
+    """
+    __slots__ = ("endpoint", "cancelled", "deferred_from")
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.cancelled = False
+        self.deferred_from: Optional[float] = None
+
+# pylint: disable=too-many-instance-attributes
+class SchedulerStats:
+    """Scheduling lag and throughput counters of a Scheduler."""
+
+    def __init__(self):
+        self.ticks = 0
+        self.dispatched = 0
+        self.skipped = 0
+        # Checks skipped by the throttle
+        self.throttled = 0
+        # Checks which waited for a slot, and checks which started more than LATE_AFTER late
+        self.deferred = 0
+        self.late = 0
+        self.last_tick_lag = 0.0
+        self.last_tick_dispatched = 0
+        self.max_lag = 0.0
+        self._lag_sum = 0.0
+
+    def record_tick(self, lags: List[float]):
+        """Record the lags of the checks dispatched during one tick."""
+        self.ticks += 1
+        self.last_tick_dispatched = len(lags)
+        self.last_tick_lag = max(lags) if lags else 0.0
+        self.dispatched += len(lags)
+        self._lag_sum += sum(lags)
+        self.max_lag = max(self.max_lag, self.last_tick_lag)
+
+    @property
+    def mean_lag(self) -> float:
+        """Mean lag of all checks dispatched in the reporting window."""
+        return self._lag_sum / self.dispatched if self.dispatched else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        """Output as a dict so it can be logged or exported."""
+        return {
+            "ticks": self.ticks,
+            "dispatched": self.dispatched,
+            "skipped": self.skipped,
+            "throttled": self.throttled,
+            "deferred": self.deferred,
+            "late": self.late,
+            "last_tick_lag": self.last_tick_lag,
+            "mean_lag": self.mean_lag,
+            "max_lag": self.max_lag,
+        }
+
+class Scheduler:
+    """
+    A single scheduler per worker process.
+    Deadlines are kept on the monotonic clock of the event loop, and the next
+    deadline of an endpoint is its previous deadline plus its interval, so a
+    slow response never shifts the following checks.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 check: Callable[[Endpoint], Awaitable[None]],
+                 max_in_flight: int = MAX_IN_FLIGHT,
+                 tick: float = SCHEDULER_TICK,
+                 late_after: float = LATE_AFTER,
+                 throttle: Optional[Throttle] = None):
+        """Initialize the scheduler with the coroutine that runs one check.
+        The throttle, if any, is called with each due endpoint and the time, and returns
+        the seconds to defer its check by, or None to skip it for this interval.
+        """
+        assert max_in_flight > 0, "max_in_flight must be positive"
+        self.check = check
+        self.max_in_flight = max_in_flight
+        self.tick = tick
+        self.late_after = late_after
+        self.throttle = throttle
+        # Set when a check waits for a slot, cleared by whoever adapts max_in_flight
+        self.saturated = False
+        self.stats = SchedulerStats()
+        self._heap = []
+        self._entries: Dict[int, _Entry] = {}
+        self._sequence = itertools.count()
+        self._in_flight = set()
+        self._slot_released = asyncio.Event()
+        self._running = True
+
+    @property
+    def in_flight(self) -> int:
+        """Number of checks currently running."""
+        return len(self._in_flight)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, endpoint_id: int) -> bool:
+        return endpoint_id in self._entries
+
+    def endpoint_ids(self) -> Set[int]:
+        """Ids of the endpoints currently scheduled."""
+        return set(self._entries)
+
+    def add(self, endpoint: Endpoint, first_deadline: Optional[float] = None):
+        """Schedule an endpoint.
+        Without an explicit deadline, the first check is spread over one interval by
+        the phase of the endpoint, so a freshly started process doesn't fire every check at once.
+        """
+        self.remove(endpoint.endpoint_id)
+        if first_deadline is None:
+            now = self._now()
+            first_deadline = now + (phase_of(endpoint) - now) % endpoint.interval
+        entry = _Entry(endpoint)
+        self._entries[endpoint.endpoint_id] = entry
+        heapq.heappush(self._heap, (first_deadline, next(self._sequence), entry))
+
+    def update(self, endpoint: Endpoint):
+        """Apply a changed endpoint.
+        With the same interval, the next check keeps its deadline and uses the new
+        URL and regex. A new interval reschedules it, spread over the new interval.
+        """
+        entry = self._entries.get(endpoint.endpoint_id)
+        if entry is None or entry.endpoint.interval != endpoint.interval:
+            self.add(endpoint)
+        else:
+            entry.endpoint = endpoint
+
+    def remove(self, endpoint_id: int):
+        """Unschedule an endpoint. Its heap item is dropped when it becomes due."""
+        entry = self._entries.pop(endpoint_id, None)
+        if entry is not None:
+            entry.cancelled = True
+
+    def resize(self, max_in_flight: int):
+        """Change the limit of checks in flight. Checks above a lowered limit run to completion."""
+        assert max_in_flight > 0, "max_in_flight must be positive"
+        if max_in_flight > self.max_in_flight:
+            self._slot_released.set()
+        self.max_in_flight = max_in_flight
+
+    def stop(self):
+        """Stop dispatching new checks."""
+        self._running = False
+        self._slot_released.set()
+
+    async def run(self):
+        """Dispatch due checks until stopped, then wait for in-flight checks."""
+        logger.info(f"Scheduler {id(self)} started with {len(self)} endpoints")
+        last_report = self._now()
+        while self._running:
+            lags = await self._dispatch_due()
+            self.stats.record_tick(lags)
+
+            now = self._now()
+            if now - last_report >= LAG_REPORT_INTERVAL:
+                self._report()
+                last_report = now
+
+            await asyncio.sleep(self._time_to_next_deadline())
+
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        logger.info("Exiting the scheduler loop")
+
+    async def _dispatch_due(self) -> List[float]:
+        """Start every check whose deadline has passed and return their lags."""
+        lags = []
+        while self._running and self._heap and self._heap[0][0] <= self._now():
+            deadline, _, entry = heapq.heappop(self._heap)
+            if entry.cancelled:
+                continue
+            if entry.deferred_from is not None:
+                # Lag, lateness and the next check are measured from the deadline it was due at
+                deadline, entry.deferred_from = entry.deferred_from, None
+            elif self.throttle is not None:
+                delay = self.throttle(entry.endpoint, self._now())
+                if delay is None:
+                    self.stats.throttled += 1
+                    self._push_next(deadline, entry, self._now())
+                    continue
+                if delay > 0:
+                    entry.deferred_from = deadline
+                    heapq.heappush(self._heap, (self._now() + delay, next(self._sequence), entry))
+                    continue
+            await self._wait_for_slot()
+            if not self._running:
+                break
+            now = self._now()
+            lags.append(now - deadline)
+
+            task = asyncio.create_task(self._run_check(entry.endpoint, deadline))
+            self._in_flight.add(task)
+            task.add_done_callback(self._on_check_done)
+
+            self._push_next(deadline, entry, now)
+        return lags
+
+    def _push_next(self, deadline: float, entry: _Entry, now: float):
+        """Schedule the check following the one due at deadline."""
+        next_deadline = deadline + entry.endpoint.interval
+        if next_deadline <= now:
+            # We fell behind by more than one interval: skip the missed
+            # checks instead of firing them back to back.
+            missed = int((now - next_deadline) // entry.endpoint.interval) + 1
+            self.stats.skipped += missed
+            next_deadline += missed * entry.endpoint.interval
+        heapq.heappush(self._heap, (next_deadline, next(self._sequence), entry))
+
+    async def _wait_for_slot(self):
+        """Block the dispatch loop while the pool of request tasks is full."""
+        if self._running and len(self._in_flight) >= self.max_in_flight:
+            self.saturated = True
+            self.stats.deferred += 1
+        while self._running and len(self._in_flight) >= self.max_in_flight:
+            self._slot_released.clear()
+            await self._slot_released.wait()
+
+    async def _run_check(self, endpoint: Endpoint, deadline: float):
+        """Run one check, never letting an exception kill the scheduler."""
+        # Includes the dispatch lag and the wait of the task to be run
+        start_delay = self._now() - deadline
+        runtime_stats.record("start_delay", start_delay)
+        # The task has its own context, so the check can read the delay of its own start
+        check_start_delay.set(start_delay)
+        if start_delay > self.late_after:
+            self.stats.late += 1
+        try:
+            await self.check(endpoint)
+        except Exception as e:
+            logger.error(f"Error checking {endpoint.url}: {e}")
+
+    def _on_check_done(self, task: asyncio.Task):
+        self._in_flight.discard(task)
+        self._slot_released.set()
+
+    def _time_to_next_deadline(self) -> float:
+        if not self._heap:
+            return self.tick
+        return min(self.tick, max(0.0, self._heap[0][0] - self._now()))
+
+    def _report(self):
+        stats = self.stats.as_dict()
+        stats["in_flight"] = self.in_flight
+        stats["max_in_flight"] = self.max_in_flight
+        if stats["max_lag"] > LAG_WARNING_THRESHOLD:
+            logger.warning(f"Scheduler is overcommitted: {stats}")
+        else:
+            logger.info(f"Scheduler stats: {stats}")
+        # Start a new reporting window
+        self.stats = SchedulerStats()
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_running_loop().time()
@@ -0,0 +1,127 @@
+"""
+This module manages the HTTP session shared by all checks of a worker process.
+1. Build one aiohttp ClientSession with a tunable TCPConnector
+2. Reuse a single SSL context for every TLS connection
+3. Report connector stats: open, idle and acquired connections
+4. Mark the phases of every check on its PhaseTimer, see timing.py
+"""
+import os
+import ssl
+import time
+from typing import Dict, Optional
+import aiohttp
+
+from src.worker.timing import add_phase_callbacks, create_ssl_context
+
+# Total number of simultaneous connections, 0 means unlimited
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "1000"))
+# Simultaneous connections to the same (host, port, ssl), 0 means unlimited
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "0"))
+# Seconds an idle keep-alive connection is kept in the pool
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+# Seconds a resolved host is cached, 0 disables the DNS cache
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+# Total timeout of one check in seconds
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+# pylint: disable=too-many-instance-attributes
+class SessionManager:
+    """Owns the ClientSession and TCPConnector of a worker process."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 limit: int = HTTP_LIMIT,
+                 limit_per_host: int = HTTP_LIMIT_PER_HOST,
+                 keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT,
+                 dns_cache_ttl: int = HTTP_DNS_CACHE_TTL,
+                 timeout: float = HTTP_TIMEOUT,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        """Initialize the manager. The session is created lazily by open().
+        Only a PhaseTimingSSLContext splits TCP connect from the TLS handshake, with another
+        ssl_context the handshake is counted in connect.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        # Building an SSL context loads the CA bundle, so do it once per process
+        self.ssl_context = ssl_context or create_ssl_context()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.connector: Optional[aiohttp.TCPConnector] = None
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connect_time = 0.0
+
+    async def open(self) -> aiohttp.ClientSession:
+        """Create the shared session. It must be called inside the event loop."""
+        if self.session is not None and not self.session.closed:
+            return self.session
+        self.connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=self.dns_cache_ttl > 0,
+            ttl_dns_cache=self.dns_cache_ttl or None,
+            ssl=self.ssl_context,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=self.connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[self._build_trace_config()],
+        )
+        return self.session
+
+    async def close(self):
+        """Close the session and every pooled connection."""
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+        self.connector = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def stats(self) -> Dict[str, float]:
+        """Connector stats used to size nodes."""
+        idle = acquired = 0
+        if self.connector is not None and not self.connector.closed:
+            # aiohttp has no public API for the pool content
+            # pylint: disable=protected-access
+            idle = sum(len(conns) for conns in self.connector._conns.values())
+            acquired = len(self.connector._acquired)
+        created = self.connections_created
+        return {
+            "open": idle + acquired,
+            "idle": idle,
+            "acquired": acquired,
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "connections_created": created,
+            "connections_reused": self.connections_reused,
+            "mean_connect_time": self.connect_time / created if created else 0.0,
+        }
+
+    def _build_trace_config(self) -> aiohttp.TraceConfig:
+        """Count new versus reused connections and the time spent connecting, and time the phases of checks."""
+        trace_config = aiohttp.TraceConfig()
+        add_phase_callbacks(trace_config)
+
+        # pylint: disable=unused-argument
+        async def on_connection_create_start(session, context, params):
+            context.connect_started = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            self.connections_created += 1
+            self.connect_time += time.perf_counter() - context.connect_started
+
+        async def on_connection_reuseconn(session, context, params):
+            self.connections_reused += 1
+
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
@@ -0,0 +1,293 @@
+"""
+This module contains the local spool of check results the sinks could not take.
+1. Results are appended as fixed-width binary records to fixed-size memory-mapped segment files
+2. A reader takes them back in order, and commits its position once they are stored
+3. Segments fully read are deleted, the oldest are dropped beyond a maximum number of segments
+4. Records and the committed position survive a restart, so nothing is lost but uncommitted reads are replayed
+5. Segments of the former record format, without phases, are converted when the spool is opened
+"""
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from src.utils import logger
+from src.worker.stat_batch import StatBatch, MATCH_UNKNOWN
+from src.worker.timing import UNKNOWN_PHASES
+
+# Directory of the segment files
+METRICS_SPOOL_DIR = os.getenv("METRICS_SPOOL_DIR", "/tmp/siteuptimewatcher/spool")
+# Size of a segment file. 64 MiB hold 1M results
+METRICS_SPOOL_SEGMENT_BYTES = int(os.getenv("METRICS_SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Segments kept at most, about 9 hours of 20k endpoints checked every 10s with the defaults
+METRICS_SPOOL_MAX_SEGMENTS = int(os.getenv("METRICS_SPOOL_MAX_SEGMENTS", "64"))
+
+# crc32 of the rest of the record, endpoint_id, timestamp, duration, bytes_read,
+# status_code, regex_match, truncated, regex_timed_out, late, the dns, connect, tls,
+# ttfb and transfer phases, padding to 64 bytes.
+# A slot never written is all zeros, and its crc32 never matches.
+RECORD = struct.Struct("<Iqddqhbbbb5i2x")
+SEGMENT_SUFFIX = ".segment"
+# The former 48-byte records without phases, in .seg files. late took a byte of their
+# padding, so records written before it read as not late.
+LEGACY_RECORD = struct.Struct("<Iqddqhbbbb6x")
+LEGACY_SEGMENT_SUFFIX = ".seg"
+# Records converted from legacy segments at a time
+LEGACY_BATCH_SIZE = 10000
+CHECKPOINT = struct.Struct("<qq")
+CHECKPOINT_FILE = "checkpoint"
+
+# A position in the spool: (segment number, byte offset in the segment)
+Cursor = Tuple[int, int]
+
+def encode_record(batch: StatBatch, i: int) -> bytes:
+    """Encode row i of a batch as a fixed-width record."""
+    body = RECORD.pack(0, batch.endpoint_id[i], batch.timestamp[i], batch.duration[i],
+                       batch.bytes_read[i], batch.status_code[i], batch.regex_match[i],
+                       batch.truncated[i], batch.regex_timed_out[i], batch.late[i],
+                       *(column[i] for column in batch.phases.values()))[4:]
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+def decode_record(buffer, offset: int, record_format: struct.Struct = RECORD) -> Optional[tuple]:
+    """Decode the record at offset, None if the slot is empty or torn."""
+    record = record_format.unpack_from(buffer, offset)
+    if record[0] != zlib.crc32(buffer[offset + 4:offset + record_format.size]):
+        return None
+    return record[1:]
+
+def append_record(batch: StatBatch, record: tuple):
+    """Append a decoded record to a batch, a legacy one without phases too."""
+    (endpoint_id, timestamp, duration, bytes_read, status_code, regex_match, truncated, timed_out,
+     late, *phases) = record
+    batch.append_row(endpoint_id, None, timestamp, status_code,
+                     None if math.isnan(duration) else duration,
+                     None if regex_match == MATCH_UNKNOWN else bool(regex_match),
+                     bytes_read, bool(truncated), bool(timed_out), phases or UNKNOWN_PHASES, bool(late))
+
+# pylint: disable=too-many-instance-attributes
+class Spool:
+    """Append-only spool of fixed-width records in memory-mapped segments.
+    Only the segment being written and the one being read are mapped, so the
+    memory cost is fixed however long the outage is. Methods are blocking and
+    thread-safe, coroutines call them with asyncio.to_thread.
+    """
+
+    def __init__(self,
+                 directory: str = METRICS_SPOOL_DIR,
+                 segment_bytes: int = METRICS_SPOOL_SEGMENT_BYTES,
+                 max_segments: int = METRICS_SPOOL_MAX_SEGMENTS):
+        """Open the spool, recovering the segments and position of a previous run."""
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes - segment_bytes % RECORD.size
+        self.max_segments = max_segments
+        self.appended = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+
+        # The checkpoint of legacy segments is a position in them
+        legacy = self._segments(LEGACY_SEGMENT_SUFFIX)
+        legacy_read = self._load_checkpoint() if legacy else None
+        if legacy:
+            (self.directory / CHECKPOINT_FILE).unlink(missing_ok=True)
+
+        segments = self._segments()
+        self._read: Cursor = self._load_checkpoint()
+        if not segments:
+            segments = [self._read[0]]
+        if self._read[0] < segments[0]:
+            self._read = (segments[0], 0)
+        self._write: Cursor = (segments[-1], self._find_end(segments[-1]))
+        self._read = min(self._read, self._write)
+        if legacy:
+            self._convert_legacy(legacy, legacy_read)
+
+    def __len__(self):
+        """Number of records not committed yet, counting every slot of the segments in between."""
+        with self._lock:
+            records_per_segment = self.segment_bytes // RECORD.size
+            (read_seq, read_offset), (write_seq, write_offset) = self._read, self._write
+            if read_seq == write_seq:
+                return max(write_offset - read_offset, 0) // RECORD.size
+            middle = len([seq for seq in self._segments() if read_seq < seq < write_seq])
+            return (self.segment_bytes - read_offset) // RECORD.size \
+                + middle * records_per_segment + write_offset // RECORD.size
+
+    def stats(self) -> Dict[str, int]:
+        """Pending records and segments, appended and dropped records."""
+        pending = len(self)
+        return {
+            "pending": pending,
+            "segments": len(self._segments()),
+            "appended": self.appended,
+            "dropped": self.dropped,
+        }
+
+    def append(self, batches: List[StatBatch]) -> int:
+        """Append every row of the batches and return how many were appended."""
+        appended = 0
+        with self._lock:
+            start = self._write[1]
+            for batch in batches:
+                for i in range(batch.size):
+                    seq, offset = self._write
+                    if offset + RECORD.size > self.segment_bytes:
+                        self._flush(seq, start, offset)
+                        seq, offset = self._rotate()
+                        start = 0
+                    self._map(seq)[offset:offset + RECORD.size] = encode_record(batch, i)
+                    self._write = (seq, offset + RECORD.size)
+                    appended += 1
+            # Make the records durable, appends only happen while the sinks are down
+            self._flush(self._write[0], start, self._write[1])
+        self.appended += appended
+        return appended
+
+    def read(self, max_records: int) -> Tuple[StatBatch, Cursor]:
+        """Read up to max_records records from the committed position, without committing.
+        It returns them as a batch and the cursor to commit once they are stored.
+        """
+        with self._lock:
+            batch = StatBatch(max_records)
+            seq, offset = self._read
+            while not batch.is_full() and (seq, offset) < self._write:
+                if offset + RECORD.size > self.segment_bytes:
+                    seq, offset = self._next_segment(seq), 0
+                    continue
+                record = decode_record(self._map(seq), offset)
+                if record is None:
+                    if seq == self._write[0]:
+                        break
+                    # A torn record ends a segment that was rotated after a crash
+                    seq, offset = self._next_segment(seq), 0
+                    continue
+                append_record(batch, record)
+                offset += RECORD.size
+            return batch, (seq, offset)
+
+    def commit(self, cursor: Cursor):
+        """Persist the position of the reader, and delete the segments before it."""
+        with self._lock:
+            self._read = max(self._read, cursor)
+            self._save_checkpoint()
+            for seq in self._segments():
+                if seq >= self._read[0]:
+                    break
+                self._delete(seq)
+
+    def close(self):
+        """Unmap every segment."""
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.flush()
+                mapped.close()
+            self._maps = {}
+
+    def _segments(self, suffix: str = SEGMENT_SUFFIX) -> List[int]:
+        return sorted(int(path.stem) for path in self.directory.glob(f"*{suffix}"))
+
+    def _convert_legacy(self, legacy: List[int], read: Cursor):
+        """Append the uncommitted records of legacy segments to the spool, and delete them.
+        A crash while converting replays some records twice, which the DB deduplicates.
+        """
+        converted = 0
+        for seq in legacy:
+            path = self.directory / f"{seq:012d}{LEGACY_SEGMENT_SUFFIX}"
+            if seq >= read[0]:
+                data = path.read_bytes()
+                batch = StatBatch(LEGACY_BATCH_SIZE)
+                offset = read[1] if seq == read[0] else 0
+                while offset + LEGACY_RECORD.size <= len(data):
+                    record = decode_record(data, offset, LEGACY_RECORD)
+                    if record is None:
+                        break
+                    append_record(batch, record)
+                    offset += LEGACY_RECORD.size
+                    if batch.is_full():
+                        converted += self.append([batch])
+                        batch = StatBatch(LEGACY_BATCH_SIZE)
+                converted += self.append([batch])
+            path.unlink()
+        self.appended -= converted
+        logger.info(f"Converted {converted} spooled metrics from {len(legacy)} legacy segments")
+
+    def _path(self, seq: int) -> Path:
+        return self.directory / f"{seq:012d}{SEGMENT_SUFFIX}"
+
+    def _map(self, seq: int) -> mmap.mmap:
+        """Map a segment, creating it if needed. Only the read and write segments stay mapped."""
+        mapped = self._maps.get(seq)
+        if mapped is not None:
+            return mapped
+        for mapped_seq in list(self._maps):
+            if mapped_seq not in (self._read[0], self._write[0], seq):
+                self._maps.pop(mapped_seq).close()
+        with open(self._path(seq), "a+b") as f:
+            if os.fstat(f.fileno()).st_size < self.segment_bytes:
+                f.truncate(self.segment_bytes)
+            mapped = mmap.mmap(f.fileno(), self.segment_bytes)
+        self._maps[seq] = mapped
+        return mapped
+
+    def _find_end(self, seq: int) -> int:
+        """Find the end of the records of a segment. Records are a prefix, so bisect."""
+        mapped = self._map(seq)
+        low, high = 0, self.segment_bytes // RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            if decode_record(mapped, middle * RECORD.size) is None:
+                high = middle
+            else:
+                low = middle + 1
+        return low * RECORD.size
+
+    def _next_segment(self, seq: int) -> int:
+        later = [s for s in self._segments() if s > seq]
+        return later[0] if later else self._write[0]
+
+    def _flush(self, seq: int, start: int, end: int):
+        """Write the records between two offsets of a segment to disk, not the whole segment."""
+        if end <= start:
+            return
+        # msync takes offsets aligned to pages
+        aligned = start - start % mmap.ALLOCATIONGRANULARITY
+        self._map(seq).flush(aligned, end - aligned)
+
+    def _rotate(self) -> Cursor:
+        """Start a new segment, dropping the oldest beyond max_segments."""
+        self._write = (self._write[0] + 1, 0)
+        self._map(self._write[0])
+        segments = self._segments()
+        while len(segments) > self.max_segments:
+            oldest = segments.pop(0)
+            dropped = (self.segment_bytes - (self._read[1] if oldest == self._read[0] else 0)) // RECORD.size
+            if oldest >= self._read[0]:
+                self.dropped += dropped
+                logger.warning(f"Dropping {dropped} spooled metrics, the spool is full")
+                self._read = (segments[0], 0)
+                self._save_checkpoint()
+            self._delete(oldest)
+        return self._write
+
+    def _delete(self, seq: int):
+        mapped = self._maps.pop(seq, None)
+        if mapped is not None:
+            mapped.close()
+        self._path(seq).unlink(missing_ok=True)
+
+    def _load_checkpoint(self) -> Cursor:
+        try:
+            return CHECKPOINT.unpack((self.directory / CHECKPOINT_FILE).read_bytes())
+        except (FileNotFoundError, struct.error):
+            return (0, 0)
+
+    def _save_checkpoint(self):
+        path = self.directory / CHECKPOINT_FILE
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(CHECKPOINT.pack(*self._read))
+        os.replace(tmp_path, path)
@@ -0,0 +1,100 @@
+"""
+Module for the columnar buffer of check results.
+Results are written into preallocated typed arrays and handed off to the
+metrics handler a whole batch at a time, instead of one Stat object per check.
+"""
+import os
+from array import array
+from typing import Optional, Sequence
+
+from src.endpoint import Endpoint
+from src.worker.timing import PHASES, UNKNOWN_PHASES
+
+# Number of results a batch holds before it is handed off
+STAT_BATCH_SIZE = int(os.getenv("STAT_BATCH_SIZE", "1000"))
+
+# regex_match is a tri-state column: no value, no match, match
+MATCH_UNKNOWN = -1
+
+# pylint: disable=too-many-instance-attributes
+class StatBatch:
+    """Fixed-capacity columns of check results."""
+
+    def __init__(self, capacity: int = STAT_BATCH_SIZE):
+        """Preallocate every column."""
+        self.capacity = capacity
+        self.size = 0
+        self.endpoint_id = array("q", bytes(8 * capacity))
+        self.timestamp = array("d", bytes(8 * capacity))
+        # NaN means the duration is unknown
+        self.duration = array("d", bytes(8 * capacity))
+        self.status_code = array("h", bytes(2 * capacity))
+        self.regex_match = array("b", bytes(capacity))
+        self.bytes_read = array("q", bytes(8 * capacity))
+        self.truncated = array("b", bytes(capacity))
+        self.regex_timed_out = array("b", bytes(capacity))
+        # The check started more than SCHEDULER_LATE_AFTER after its deadline
+        self.late = array("b", bytes(capacity))
+        # Phases of the check in microseconds, -1 when not reached or not known
+        self.phases = {phase: array("i", bytes(4 * capacity)) for phase in PHASES}
+        # References to the interned URLs, needed by TrueWatch tags, None for rows read from the spool
+        self.url = [None] * capacity
+
+    def __len__(self):
+        return self.size
+
+    def is_full(self) -> bool:
+        """Tell if no more results fit in the batch."""
+        return self.size >= self.capacity
+
+    # pylint: disable=too-many-arguments
+    def append(self,
+               endpoint: Endpoint,
+               timestamp: float,
+               status_code: int,
+               duration: Optional[float],
+               regex_match: Optional[bool],
+               bytes_read: int = 0,
+               truncated: bool = False,
+               regex_timed_out: bool = False,
+               phases: Sequence[int] = UNKNOWN_PHASES,
+               late: bool = False):
+        """Write the result of one check into the next row."""
+        self.append_row(endpoint.endpoint_id, endpoint.url, timestamp, status_code, duration,
+                        regex_match, bytes_read, truncated, regex_timed_out, phases, late)
+
+    # pylint: disable=too-many-arguments
+    def append_row(self,
+                   endpoint_id: int,
+                   url: Optional[str],
+                   timestamp: float,
+                   status_code: int,
+                   duration: Optional[float],
+                   regex_match: Optional[bool],
+                   bytes_read: int = 0,
+                   truncated: bool = False,
+                   regex_timed_out: bool = False,
+                   phases: Sequence[int] = UNKNOWN_PHASES,
+                   late: bool = False):
+        """Write a row without its Endpoint, e.g. one read back from the spool."""
+        if self.is_full():
+            raise IndexError("StatBatch is full")
+        i = self.size
+        self.endpoint_id[i] = endpoint_id
+        self.url[i] = url
+        self.timestamp[i] = timestamp
+        self.status_code[i] = status_code or 0
+        self.duration[i] = float("nan") if duration is None else duration
+        self.regex_match[i] = MATCH_UNKNOWN if regex_match is None else int(regex_match)
+        self.bytes_read[i] = bytes_read
+        self.truncated[i] = truncated
+        self.regex_timed_out[i] = regex_timed_out
+        self.late[i] = late
+        for column, value in zip(self.phases.values(), phases):
+            column[i] = value
+        self.size = i + 1
+
+    def append_stat(self, stat):
+        """Write a Stat built by a check into the next row."""
+        self.append(stat.endpoint, stat.timestamp, stat.status_code, stat.duration,
+                    stat.regex_match, stat.bytes_read, stat.truncated, stat.regex_timed_out, stat.phases, stat.late)
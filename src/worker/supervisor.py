@@ -0,0 +1,224 @@
+"""
+This module runs one shared-nothing worker process per usable core.
+1. Detect the usable cores, capped by the cgroup CPU quota of the container
+2. Start one child process per core, each monitoring its own partition
+3. Restart crashed or silent children, with a backoff
+4. Aggregate the heartbeats of the children into health and throughput stats
+"""
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.utils import logger
+
+# Number of worker processes, detected from the cores and the CPU quota if unset
+WORKER_PROCESSES = os.getenv("WORKER_PROCESSES")
+# Nodes running a supervisor, and the index of this one, to split partitions across nodes
+NODE_COUNT = int(os.getenv("NODE_COUNT", "1"))
+NODE_INDEX = int(os.getenv("NODE_INDEX", "0"))
+# How often children send a heartbeat, in seconds
+SUPERVISOR_HEARTBEAT_INTERVAL = float(os.getenv("SUPERVISOR_HEARTBEAT_INTERVAL", "5"))
+# A child without heartbeat for this long is killed and restarted, in seconds
+SUPERVISOR_HEARTBEAT_TIMEOUT = float(os.getenv("SUPERVISOR_HEARTBEAT_TIMEOUT", "60"))
+# Delay before restarting a crashed child, doubled for each crash in a row, in seconds
+SUPERVISOR_RESTART_BACKOFF = float(os.getenv("SUPERVISOR_RESTART_BACKOFF", "1"))
+SUPERVISOR_RESTART_BACKOFF_MAX = float(os.getenv("SUPERVISOR_RESTART_BACKOFF_MAX", "60"))
+# How often the aggregated stats are logged, in seconds
+SUPERVISOR_REPORT_INTERVAL = float(os.getenv("SUPERVISOR_REPORT_INTERVAL", "60"))
+# A child running this long is considered healthy again, and its backoff is reset
+HEALTHY_UPTIME = 60
+
+def cgroup_cpu_quota(cgroup_root: str = "/sys/fs/cgroup") -> Optional[float]:
+    """Read the CPU quota of the container in cores, None if unlimited or unknown."""
+    root = Path(cgroup_root)
+    try:
+        # cgroup v2: "max 100000" or "200000 100000"
+        quota, period = (root / "cpu.max").read_text().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 means unlimited
+        quota = int((root / "cpu" / "cpu.cfs_quota_us").read_text())
+        period = int((root / "cpu" / "cpu.cfs_period_us").read_text())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+def usable_cores(cgroup_root: str = "/sys/fs/cgroup") -> int:
+    """Count the cores this process may run on, rounded up to the CPU quota of the container."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        cores = min(cores, math.ceil(quota))
+    return max(cores, 1)
+
+# pylint: disable=too-few-public-methods, too-many-instance-attributes
+class _Child:
+    """A worker process and what the supervisor knows about it."""
+
+    def __init__(self, index: int, partition_id: int):
+        self.index = index
+        self.partition_id = partition_id
+        self.process = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.crashes_in_a_row = 0
+        self.restarts = 0
+        self.heartbeat: Dict = {}
+        self.heartbeat_at = 0.0
+        # Checks and rows written as of the last stats, to count those done since
+        self.reported = (0, 0)
+
+    def counted_since_reported(self) -> Tuple[int, int]:
+        """The checks and rows written since the last stats. A restarted child counts from zero again."""
+        current = (self.heartbeat.get("checks", 0), self.heartbeat.get("rows_written", 0))
+        counted = tuple(now - last if now >= last else now for now, last in zip(current, self.reported))
+        self.reported = current
+        return counted
+
+class Supervisor:
+    """Start, watch and restart one worker process per core."""
+
+    def __init__(self,
+                 processes: Optional[int] = None,
+                 target: Optional[Callable] = None,
+                 node_count: int = NODE_COUNT,
+                 node_index: int = NODE_INDEX):
+        """Initialize the supervisor. target(partition_id, partition_count, heartbeats) runs in each child."""
+        if processes is None:
+            processes = int(WORKER_PROCESSES) if WORKER_PROCESSES else usable_cores()
+        if target is None:
+            # Imported here, since src.worker.main imports this module
+            from src.worker.main import run_child  # pylint: disable=import-outside-toplevel
+            target = run_child
+        self.target = target
+        self.partition_count = processes * node_count
+        # Spawned children don't inherit the state of the supervisor, they share nothing
+        self._context = multiprocessing.get_context("spawn")
+        self.heartbeats = self._context.Queue()
+        self.children = [_Child(i, node_index * processes + i) for i in range(processes)]
+        self._running = True
+        self._last_stats = time.monotonic()
+
+    def stop(self, *_):
+        """Stop the children and the supervisor."""
+        self._running = False
+
+    def run(self):
+        """Run until stopped, restarting children that crash or go silent."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        logger.info(f"Supervisor starting {len(self.children)} workers "
+                    f"for {self.partition_count} partitions")
+        for child in self.children:
+            self._start(child)
+        last_report = time.monotonic()
+        while self._running:
+            self._collect_heartbeats(timeout=1)
+            self._watch_children()
+            if time.monotonic() - last_report >= SUPERVISOR_REPORT_INTERVAL:
+                logger.info(f"Supervisor stats: {self.stats()}")
+                last_report = time.monotonic()
+        self._stop_children()
+        logger.info("Exiting the supervisor")
+
+    def stats(self) -> Dict:
+        """Aggregate the last heartbeats of the children."""
+        now = time.monotonic()
+        heartbeats = [child.heartbeat for child in self.children]
+        counted = [child.counted_since_reported() for child in self.children]
+        elapsed = max(now - self._last_stats, 1e-9)
+        self._last_stats = now
+        return {
+            "children": len(self.children),
+            "alive": sum(1 for child in self.children if child.process and child.process.is_alive()),
+            "healthy": sum(1 for child in self.children if self._is_healthy(child, now)),
+            "restarts": sum(child.restarts for child in self.children),
+            "endpoints": sum(h.get("endpoints", 0) for h in heartbeats),
+            "in_flight": sum(h.get("in_flight", 0) for h in heartbeats),
+            "checks_per_second": sum(checks for checks, _ in counted) / elapsed,
+            "rows_per_second": sum(rows for _, rows in counted) / elapsed,
+            "max_lag": max((h.get("max_lag", 0.0) for h in heartbeats), default=0.0),
+        }
+
+    def _start(self, child: _Child):
+        child.process = self._context.Process(
+            target=self.target,
+            args=(child.partition_id, self.partition_count, self.heartbeats),
+            name=f"worker-{child.partition_id}",
+            )
+        child.process.start()
+        child.started_at = time.monotonic()
+        # The first heartbeat is due one timeout after the start
+        child.heartbeat_at = child.started_at
+        logger.info(f"Started worker {child.partition_id} as process {child.process.pid}")
+
+    def _collect_heartbeats(self, timeout: float):
+        """Read the heartbeats sent by the children, waiting up to timeout for the first one."""
+        try:
+            heartbeat = self.heartbeats.get(timeout=timeout)
+            while True:
+                self._record(heartbeat)
+                heartbeat = self.heartbeats.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _record(self, heartbeat: Dict):
+        for child in self.children:
+            if child.partition_id == heartbeat.get("partition_id") and child.process \
+                    and child.process.pid == heartbeat.get("pid"):
+                child.heartbeat = heartbeat
+                child.heartbeat_at = time.monotonic()
+
+    def _is_healthy(self, child: _Child, now: float) -> bool:
+        return bool(child.process and child.process.is_alive()
+                    and now - child.heartbeat_at < SUPERVISOR_HEARTBEAT_TIMEOUT)
+
+    def _watch_children(self):
+        now = time.monotonic()
+        for child in self.children:
+            if child.process is None:
+                if now >= child.restart_at:
+                    child.restarts += 1
+                    self._start(child)
+                continue
+            if child.process.is_alive():
+                if now - child.heartbeat_at >= SUPERVISOR_HEARTBEAT_TIMEOUT:
+                    logger.error(f"Worker {child.partition_id} sent no heartbeat "
+                                 f"for {SUPERVISOR_HEARTBEAT_TIMEOUT}s, killing it")
+                    child.process.kill()
+                continue
+            self._schedule_restart(child, now)
+
+    def _schedule_restart(self, child: _Child, now: float):
+        """Forget a dead child and restart it after a backoff growing with crashes in a row."""
+        child.process.join()
+        if now - child.started_at >= HEALTHY_UPTIME:
+            child.crashes_in_a_row = 0
+        delay = min(SUPERVISOR_RESTART_BACKOFF * 2 ** child.crashes_in_a_row, SUPERVISOR_RESTART_BACKOFF_MAX)
+        child.crashes_in_a_row += 1
+        logger.error(f"Worker {child.partition_id} exited with code {child.process.exitcode}, "
+                     f"restarting it in {delay}s")
+        child.process = None
+        child.heartbeat = {}
+        child.restart_at = now + delay
+
+    def _stop_children(self):
+        """Ask every child to stop, and kill those still running after the grace period."""
+        alive: List[_Child] = [child for child in self.children if child.process and child.process.is_alive()]
+        for child in alive:
+            child.process.terminate()
+        for child in alive:
+            child.process.join(timeout=SUPERVISOR_HEARTBEAT_TIMEOUT)
+            if child.process.is_alive():
+                child.process.kill()
+                child.process.join()
@@ -0,0 +1,120 @@
+"""
+This module times the phases of every check on the monotonic clock.
+1. Mark the phases of a request with aiohttp trace callbacks and perf_counter_ns
+2. Split TCP connect from the TLS handshake, which aiohttp has no signal for, with an SSL
+   context marking when the handshake of the connection being created starts
+3. Hand the phases over as whole microseconds: DNS, connect, TLS, time to first byte and transfer
+A phase the check never reached is -1. A check on a reused connection spends 0 in DNS, connect and TLS.
+"""
+import contextvars
+import ssl
+import time
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import aiohttp
+
+# Phases of a check, as stored with each metric
+PHASES = ("dns", "connect", "tls", "ttfb", "transfer")
+# A phase the check never reached
+UNKNOWN = -1
+UNKNOWN_PHASES = (UNKNOWN,) * len(PHASES)
+
+# The timer of the connection the current check is creating, if any
+_connecting: contextvars.ContextVar[Optional["PhaseTimer"]] = contextvars.ContextVar("connecting", default=None)
+
+# pylint: disable=too-many-instance-attributes
+class PhaseTimer:
+    """perf_counter_ns marks of one check, set by the check and the trace callbacks of the session."""
+    __slots__ = ("started", "dns_started", "dns_ended", "connect_started", "tcp_connected",
+                 "connected", "request_sent", "response_started", "ended")
+
+    def __init__(self):
+        self.started = time.perf_counter_ns()
+        self.dns_started = self.dns_ended = 0
+        self.connect_started = self.tcp_connected = self.connected = 0
+        self.request_sent = self.response_started = self.ended = 0
+
+    def finish(self):
+        """Mark the end of the check, once its body is read or it failed."""
+        self.ended = time.perf_counter_ns()
+
+    @property
+    def duration(self) -> float:
+        """Seconds from the start of the check to its end."""
+        return ((self.ended or time.perf_counter_ns()) - self.started) / 1e9
+
+    def phases(self) -> Tuple[int, int, int, int, int]:
+        """DNS, connect, TLS, time to first byte and transfer, in microseconds."""
+        dns = _span(self.dns_started, self.dns_ended)
+        if self.connect_started and self.connected:
+            # The host is resolved while the connection is created, so DNS is taken out of connect
+            tcp_connected = self.tcp_connected or self.connected
+            connect = max((tcp_connected - self.connect_started) // 1000 - max(dns, 0), 0)
+            tls = _span(self.tcp_connected, self.connected) if self.tcp_connected else 0
+            dns = max(dns, 0)
+        elif self.request_sent:
+            # The connection came from the pool
+            dns = connect = tls = 0
+        else:
+            connect = tls = UNKNOWN
+        return dns, connect, tls, _span(self.request_sent, self.response_started), \
+            _span(self.response_started, self.ended)
+
+def _span(start: int, end: int) -> int:
+    return (end - start) // 1000 if start and end else UNKNOWN
+
+def timer_of(context: SimpleNamespace) -> Optional[PhaseTimer]:
+    """The timer of the request a trace callback is called for, None if it isn't timed."""
+    timer = context.trace_request_ctx
+    return timer if isinstance(timer, PhaseTimer) else None
+
+def add_phase_callbacks(trace_config: aiohttp.TraceConfig):
+    """Mark the phases of requests made with trace_request_ctx=PhaseTimer()."""
+
+    def mark(attribute: str):
+        # pylint: disable=unused-argument
+        async def on_signal(session, context, params):
+            timer = timer_of(context)
+            if timer is not None:
+                setattr(timer, attribute, time.perf_counter_ns())
+        return on_signal
+
+    # pylint: disable=unused-argument
+    async def on_connection_create_start(session, context, params):
+        timer = timer_of(context)
+        if timer is not None:
+            timer.connect_started = time.perf_counter_ns()
+            # The connection is created by this task, so the SSL context sees the timer
+            _connecting.set(timer)
+
+    async def on_connection_create_end(session, context, params):
+        timer = timer_of(context)
+        if timer is not None:
+            timer.connected = time.perf_counter_ns()
+            _connecting.set(None)
+
+    trace_config.on_dns_resolvehost_start.append(mark("dns_started"))
+    trace_config.on_dns_resolvehost_end.append(mark("dns_ended"))
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_headers_sent.append(mark("request_sent"))
+    # Sent once the status line and headers of the response are read
+    trace_config.on_request_end.append(mark("response_started"))
+
+class PhaseTimingSSLContext(ssl.SSLContext):
+    """An SSL context marking the end of the TCP connect of a timed check.
+    asyncio wraps the socket of a connection once it is connected, right before the handshake.
+    """
+
+    def wrap_bio(self, *args, **kwargs):
+        timer = _connecting.get()
+        if timer is not None:
+            timer.tcp_connected = time.perf_counter_ns()
+        return super().wrap_bio(*args, **kwargs)
+
+def create_ssl_context() -> PhaseTimingSSLContext:
+    """The context of ssl.create_default_context, splitting TCP connect from the TLS handshake."""
+    context = PhaseTimingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
@@ -0,0 +1,266 @@
+"""
+This module exports metrics to TrueWatch (DataKit) without blocking the checks.
+1. Encode batches in line protocol and gzip them, in a thread
+2. Send them with aiohttp, a bounded number of requests at a time
+3. Retry failed requests with exponential backoff
+4. Spool payloads still failing to disk, and replay them once TrueWatch recovers
+"""
+import asyncio
+import gzip
+import math
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from src.utils import logger
+from src.worker.stat_batch import StatBatch, MATCH_UNKNOWN
+from src.worker.timing import UNKNOWN
+
+# TrueWatch configuration
+TRUEWATCH_ENABLED = os.getenv("TRUEWATCH_ENABLED", "true") == "true"
+truewatch_host = os.getenv("TRUEWATCH_HOST", "localhost")
+truewatch_port = int(os.getenv("TRUEWATCH_PORT", "9529"))
+truewatch_url = f"http://{truewatch_host}:{truewatch_port}"
+
+# Requests sent to TrueWatch at the same time
+TRUEWATCH_CONCURRENCY = int(os.getenv("TRUEWATCH_CONCURRENCY", "2"))
+# Payloads waiting to be sent, beyond that they are spooled right away
+TRUEWATCH_QUEUE_SIZE = int(os.getenv("TRUEWATCH_QUEUE_SIZE", "100"))
+# Seconds a request may take
+TRUEWATCH_TIMEOUT = float(os.getenv("TRUEWATCH_TIMEOUT", "5"))
+# Attempts of a payload before it is spooled
+TRUEWATCH_MAX_ATTEMPTS = int(os.getenv("TRUEWATCH_MAX_ATTEMPTS", "5"))
+# First and largest delay between two attempts, in seconds
+TRUEWATCH_BACKOFF_BASE = float(os.getenv("TRUEWATCH_BACKOFF_BASE", "0.5"))
+TRUEWATCH_BACKOFF_MAX = float(os.getenv("TRUEWATCH_BACKOFF_MAX", "30"))
+# Directory of the payloads that could not be sent
+TRUEWATCH_SPOOL_DIR = os.getenv("TRUEWATCH_SPOOL_DIR", "/tmp/siteuptimewatcher/truewatch")
+# Bytes of spooled payloads kept at most, the oldest are deleted beyond
+TRUEWATCH_SPOOL_MAX_BYTES = int(os.getenv("TRUEWATCH_SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+# How often the spool is checked for payloads to replay, in seconds
+TRUEWATCH_REPLAY_INTERVAL = float(os.getenv("TRUEWATCH_REPLAY_INTERVAL", "10"))
+
+MEASUREMENT = "site_uptime_watcher"
+
+def _escape_tag(value: str) -> str:
+    """Escape a tag value of the line protocol."""
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def to_line_protocol(batches: List[StatBatch]) -> bytes:
+    """Encode batches in line protocol, one line per check with a nanosecond timestamp:
+    site_uptime_watcher,endpoint=url,status_code=200,regex_match=true response_time=0.1,...,ttfb_us=80000i
+    Phases of a check not reached or not known are left out.
+    """
+    lines = []
+    # Endpoints are checked again and again, their escaped URL is computed once per payload
+    escaped_urls = {}
+    for batch in batches:
+        phases = batch.phases.items()
+        for i in range(batch.size):
+            url = batch.url[i]
+            escaped_url = escaped_urls.get(url)
+            if escaped_url is None:
+                escaped_url = escaped_urls[url] = _escape_tag(url)
+            status_code = batch.status_code[i]
+            duration = batch.duration[i]
+            regex_match = batch.regex_match[i]
+            match_tag = "none" if regex_match == MATCH_UNKNOWN else ("true" if regex_match else "false")
+            fields = (f"status_code={status_code}i,regex_match={1 if regex_match == 1 else 0}i,"
+                      f"bytes_read={batch.bytes_read[i]}i,truncated={batch.truncated[i]}i,"
+                      f"regex_timed_out={batch.regex_timed_out[i]}i,late={batch.late[i]}i")
+            if not math.isnan(duration):
+                fields = f"response_time={duration!r},{fields}"
+            for phase, column in phases:
+                if column[i] != UNKNOWN:
+                    fields += f",{phase}_us={column[i]}i"
+            lines.append(f"{MEASUREMENT},endpoint={escaped_url},status_code={status_code},"
+                         f"regex_match={match_tag} {fields} {int(batch.timestamp[i] * 1e9)}")
+    return ("\n".join(lines) + "\n").encode()
+
+def encode(batches: List[StatBatch]) -> bytes:
+    """Encode batches in gzipped line protocol."""
+    return gzip.compress(to_line_protocol(batches), compresslevel=6)
+
+def rejected(status: int) -> bool:
+    """Tell if TrueWatch refused a payload for good. Client errors other than 429 never succeed."""
+    return 400 <= status < 500 and status != 429
+
+# pylint: disable=too-many-instance-attributes
+class TrueWatchExporter:
+    """Send metrics to TrueWatch in the background, spooling what can't be sent."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 url: str = truewatch_url,
+                 concurrency: int = TRUEWATCH_CONCURRENCY,
+                 queue_size: int = TRUEWATCH_QUEUE_SIZE,
+                 max_attempts: int = TRUEWATCH_MAX_ATTEMPTS,
+                 backoff_base: float = TRUEWATCH_BACKOFF_BASE,
+                 backoff_max: float = TRUEWATCH_BACKOFF_MAX,
+                 spool_dir: str = TRUEWATCH_SPOOL_DIR,
+                 spool_max_bytes: int = TRUEWATCH_SPOOL_MAX_BYTES):
+        """Initialize the exporter. Payloads spooled by a previous run are replayed too."""
+        self.metrics_url = f"{url}/v1/write/metrics?precision=ns"
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.spool_dir = Path(spool_dir)
+        self.spool_max_bytes = spool_max_bytes
+        self.sent = 0
+        self.retried = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks: List[asyncio.Task] = []
+        self._spool_seq = 0
+        self._spool_lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of sent, retried, spooled, replayed and dropped payloads."""
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+        }
+
+    async def start(self):
+        """Open the HTTP session and start the senders and the spool replayer."""
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=TRUEWATCH_TIMEOUT),
+            headers={"Content-Encoding": "gzip", "Content-Type": "text/plain"},
+            )
+        self._tasks = [asyncio.create_task(self._send_queued()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._replay_spool()))
+        return self
+
+    async def close(self):
+        """Stop sending. Payloads still queued are spooled, so they are sent after a restart."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            await asyncio.to_thread(self._spool, self._queue.get_nowait())
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def submit(self, batches: List[StatBatch]):
+        """Encode batches and queue them for sending. It never waits for TrueWatch."""
+        if not batches:
+            return
+        payload = await asyncio.to_thread(encode, batches)
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            await asyncio.to_thread(self._spool, payload)
+
+    async def _send_queued(self):
+        """Loop of a sender: send queued payloads, spooling those that keep failing."""
+        while True:
+            payload = await self._queue.get()
+            if not await self._send_with_retries(payload):
+                await asyncio.to_thread(self._spool, payload)
+
+    async def _send_with_retries(self, payload: bytes) -> bool:
+        """Send a payload, retrying with exponential backoff and jitter.
+        Tell if it is done with, sent or rejected for good.
+        """
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self.retried += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+            try:
+                status = await self._send(payload)
+            except Exception as e:
+                logger.error(f"Error sending metrics to TrueWatch: {e}")
+                continue
+            if status < 300:
+                self.sent += 1
+                return True
+            if rejected(status):
+                self.dropped += 1
+                return True
+        return False
+
+    async def _send(self, payload: bytes) -> int:
+        """Send a payload once, and return the status of the response."""
+        async with self._session.post(self.metrics_url, data=payload) as response:
+            if response.status >= 300:
+                text = await response.text()
+                if rejected(response.status):
+                    logger.error(f"TrueWatch rejected metrics, dropping them: {response.status} - {text}")
+                else:
+                    logger.error(f"Error sending metrics to TrueWatch: {response.status} - {text}")
+            return response.status
+
+    async def _replay_spool(self):
+        """Resend spooled payloads, oldest first, and stop at the first one still failing."""
+        while True:
+            await asyncio.sleep(TRUEWATCH_REPLAY_INTERVAL)
+            for path in await asyncio.to_thread(self._spool_files):
+                try:
+                    payload = await asyncio.to_thread(path.read_bytes)
+                    status = await self._send(payload)
+                except FileNotFoundError:
+                    # Deleted meanwhile by the size cap of the spool
+                    continue
+                except Exception as e:
+                    logger.warning(f"TrueWatch is still unreachable: {e}")
+                    break
+                if status >= 300 and not rejected(status):
+                    break
+                await asyncio.to_thread(path.unlink, True)
+                if status < 300:
+                    self.replayed += 1
+                else:
+                    self.dropped += 1
+
+    def _spool_files(self) -> List[Path]:
+        return sorted(self.spool_dir.glob("*.lp.gz"))
+
+    def _spool(self, payload: bytes):
+        """Write a payload to its own file, and delete the oldest beyond spool_max_bytes.
+        It runs in threads, which spool one at a time.
+        """
+        with self._spool_lock:
+            self._spool_seq += 1
+            path = self.spool_dir / f"{time.time_ns():020d}-{self._spool_seq:08d}.lp.gz"
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(payload)
+            # A payload is visible only once it is completely written
+            os.replace(tmp_path, path)
+            self.spooled += 1
+
+            files = self._spool_files()
+            sizes = [f.stat().st_size for f in files]
+            total = sum(sizes)
+            for f, size in zip(files, sizes):
+                if total <= self.spool_max_bytes:
+                    break
+                logger.warning(f"Deleting spooled metrics {f}, the TrueWatch spool is full")
+                f.unlink(missing_ok=True)
+                total -= size
+
+def create_truewatch_exporter(partition_id: Optional[int] = None) -> Optional[TrueWatchExporter]:
+    """Create the exporter, or None if TrueWatch is disabled.
+    Worker processes of a node each have their own spool, in a directory named after their partition.
+    """
+    if not TRUEWATCH_ENABLED:
+        return None
+    if partition_id is None:
+        return TrueWatchExporter()
+    return TrueWatchExporter(spool_dir=os.path.join(TRUEWATCH_SPOOL_DIR, f"partition-{partition_id}"))
@@ -1,67 +1,228 @@
 """ 
     Worker sends HTTP requests and collect metrics for a URL.
     Worker also provisions keepers.
+    Checks are dispatched by a single Scheduler per process.
+    Results are written straight into the rows of columnar StatBatch objects,
+    with no object per check, and only whole batches are handed off to the metrics handler.
+    A ConcurrencyLimiter adapts the checks in flight to keep measurements accurate,
+    and a HostLimiter spreads the checks of each origin under its rate limit.
+    Checks of the same URL share one request through a RequestCoalescer.
 """
 
 import asyncio
+import os
 import time
-import re
-from typing import List
-import aiohttp
+from typing import Dict, List, Optional, Set, Tuple
 
 from src.utils import logger
 from src.endpoint import Endpoint
 from src.worker import metrics
+from src.worker.scheduler import Scheduler, MAX_IN_FLIGHT, check_start_delay
+from src.worker.concurrency_limiter import ConcurrencyLimiter, ADAPTIVE_CONCURRENCY
+from src.worker.host_limiter import HostLimiter
+from src.worker.coalescer import RequestCoalescer, SharedRequest, CHECK_COALESCING
+from src.worker.session import SessionManager
+from src.worker.regex_pool import regex_evaluator
+from src.worker.timing import PhaseTimer
+from src.worker.stat_batch import StatBatch, STAT_BATCH_SIZE
+from src.worker.metrics_buffer import MetricsBuffer
+from src.worker.instrumentation import runtime_stats
 
+# How often the connector and regex stats are logged, in seconds
+CONNECTOR_REPORT_INTERVAL = float(os.getenv("CONNECTOR_REPORT_INTERVAL", "60"))
+# A partial batch is handed off at least this often, in seconds
+STAT_HANDOFF_INTERVAL = float(os.getenv("STAT_HANDOFF_INTERVAL", "1.0"))
+
+# pylint: disable=too-many-instance-attributes
 class Worker:
     """Worker class to handle endpoint monitoring."""
     
-    def __init__(self, stats_buffer=None):
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 stats_buffer=None,
+                 max_in_flight: int = MAX_IN_FLIGHT,
+                 session_manager: Optional[SessionManager] = None,
+                 batch_size: int = STAT_BATCH_SIZE,
+                 adaptive_concurrency: bool = ADAPTIVE_CONCURRENCY,
+                 host_limiter: Optional[HostLimiter] = None,
+                 coalescing: bool = CHECK_COALESCING):
         """Initialize the worker."""
-        # This buffer is used between workers and keepers
-        self.statsBuffer = stats_buffer if stats_buffer is not None else asyncio.Queue()
+        # This buffer is used between workers and keepers, it carries StatBatch objects
+        self.statsBuffer = stats_buffer if stats_buffer is not None else MetricsBuffer()
+        self.batch_size = batch_size
+        self.batch = StatBatch(batch_size)
+        # One session, hence one connection pool, is shared by all checks
+        self.session_manager = session_manager or SessionManager()
         self.session = None
         self._running = True
+        # Checks completed since the start, for throughput stats
+        self.checks = 0
+        # Checks are held back in the scheduler, before they take a slot or a connection
+        self.host_limiter = host_limiter or HostLimiter()
+        self.coalescer = RequestCoalescer() if coalescing else None
+        # URL -> when the request reserved for it starts, on the clock of the scheduler
+        self._planned: Dict[str, float] = {}
+        # Endpoints dispatched to join a planned request, without a token of their own
+        self._tokenless: Set[int] = set()
+        throttle = None
+        if self.host_limiter.enabled:
+            throttle = self.throttle if self.coalescer is not None else self.host_limiter.reserve
+        self.scheduler = Scheduler(self.check, max_in_flight, throttle=throttle)
+        # max_in_flight is then the upper bound of the limit
+        self.limiter = ConcurrencyLimiter(self.scheduler, max_in_flight) if adaptive_concurrency else None
 
     async def __aenter__(self):
-        """Set up aiohttp session."""
-        self.session = aiohttp.ClientSession()
+        """Set up the shared aiohttp session."""
+        self.session = await self.session_manager.open()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Clean up aiohttp session."""
-        if self.session:
-            await self.session.close()
+        """Clean up the shared aiohttp session."""
+        await self.session_manager.close()
+        self.session = None
 
     def stop(self):
         """Stop the worker."""
         self._running = False
+        self.scheduler.stop()
 
     async def run(self, endpoints: List[Endpoint]):
         """Run the worker with the given endpoints."""
         logger.info(f"Worker {id(self)} started")
-        tasks = []
-        for endpoint in endpoints:
-            tasks.append(asyncio.create_task(self.monitor(endpoint)))
-        await asyncio.gather(*tasks)
+        async with self:
+            for endpoint in endpoints:
+                self.scheduler.add(endpoint)
+            reporter = asyncio.create_task(self._report_stats())
+            handoff = asyncio.create_task(self._hand_off_periodically())
+            on_lag = self.limiter.observe_loop_lag if self.limiter is not None else None
+            loop_lag = asyncio.create_task(runtime_stats.monitor_loop_lag(on_lag=on_lag))
+            limiter = asyncio.create_task(self.limiter.run()) if self.limiter is not None else None
+            try:
+                await self.scheduler.run()
+            finally:
+                reporter.cancel()
+                handoff.cancel()
+                loop_lag.cancel()
+                if limiter is not None:
+                    limiter.cancel()
+                regex_evaluator.close()
+                await self.hand_off()
         logger.info("Exiting the worker loop")
 
-    async def monitor(self, endpoint: Endpoint):
-        """ Send HTTP requests and collect metrics from responses."""
-        async with aiohttp.ClientSession() as session:
-            while self._running:
-                # Create a new metric object
-                metric = metrics.Stat(endpoint, time.time())
-                try:
-                    resp = await session.get(endpoint.url)
-                    await metric.build_from_successful_http_req(resp)
-                except Exception as e:
-                    logger.error(f"Error monitoring {endpoint.url}: {e}")
-                    metric.build_from_failed_http_req(e)
-                finally:
-                    await self.statsBuffer.put(metric)
-                    await asyncio.sleep(endpoint.interval)
-            logger.info("Exiting the monitor loop")
+    async def _report_stats(self):
+        """Log connector and regex stats periodically so nodes can be sized."""
+        while self._running:
+            await asyncio.sleep(CONNECTOR_REPORT_INTERVAL)
+            logger.info(f"Connector stats: {self.session_manager.stats()}")
+            logger.info(f"Regex stats: {regex_evaluator.stats()}")
+            logger.info(f"Runtime stats: {runtime_stats.as_dict()}")
+            if self.limiter is not None:
+                logger.info(f"Concurrency limiter stats: {self.limiter.stats()}")
+            if self.host_limiter.enabled:
+                logger.info(f"Host limiter stats: {self.host_limiter.stats()}")
+            if self.coalescer is not None:
+                logger.info(f"Coalesced checks: {self.coalescer.coalesced}")
+
+    async def hand_off(self):
+        """Hand off the current batch, if not empty, to the metrics handler."""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, StatBatch(self.batch_size)
+        await self.statsBuffer.put(batch)
+
+    async def _hand_off_periodically(self):
+        """Hand off partial batches, so metrics of a quiet worker aren't held back."""
+        while self._running:
+            await asyncio.sleep(STAT_HANDOFF_INTERVAL)
+            await self.hand_off()
+
+    def throttle(self, endpoint: Endpoint, now: float) -> Optional[float]:
+        """Take a host token for a check which sends its own request, see HostLimiter.reserve.
+        A check of a URL whose request is planned or in flight, started at most the coalescing
+        window ago, is deferred to its start to join it, and takes no token.
+        """
+        planned = self._planned.get(endpoint.url)
+        if planned is not None and now - planned <= self.coalescer.window:
+            self._tokenless.add(endpoint.endpoint_id)
+            return max(planned - now, 0.0)
+        delay = self.host_limiter.reserve(endpoint, now)
+        if delay is not None:
+            self._planned[endpoint.url] = now + delay
+        return delay
+
+    # pylint: disable=too-many-locals
+    async def check(self, endpoint: Endpoint):
+        """ Send one HTTP request and write its metrics straight into the batch.
+        A request to the same URL in flight is joined instead, see coalescer.py.
+        """
+        started = time.perf_counter()
+        shared = None
+        if self.coalescer is not None:
+            joined = self.coalescer.join(endpoint, started)
+            tokenless = endpoint.endpoint_id in self._tokenless
+            self._tokenless.discard(endpoint.endpoint_id)
+            if joined is not None:
+                await self._check_joined(endpoint, *joined)
+                return
+            if tokenless:
+                # The request it was to join is gone, so it takes a token to send its own
+                delay = self.host_limiter.reserve(endpoint, asyncio.get_running_loop().time())
+                if delay is None:
+                    return
+                await asyncio.sleep(delay)
+                started = time.perf_counter()
+            shared = self.coalescer.lead(endpoint, started)
+        timestamp = time.time()
+        # Set by the scheduler in the task of this check
+        late = check_start_delay.get() > self.scheduler.late_after
+        # The trace callbacks of the session mark the phases of the request on the timer
+        timer = PhaseTimer()
+        status_code, results = 0, [metrics.unmatched(endpoint)]
+        try:
+            async with self.session.get(endpoint.url, trace_request_ctx=timer) as resp:
+                headers_received = time.perf_counter()
+                runtime_stats.record("http", headers_received - started)
+                # The body can't be read twice, so nobody joins once it is being read
+                joined_endpoints = self.coalescer.close(shared) if shared is not None else []
+                results = await metrics.evaluate_response(resp, [endpoint, *joined_endpoints])
+                status_code = resp.status
+                runtime_stats.record("body", time.perf_counter() - headers_received)
+        except Exception as e:
+            logger.error(f"Error monitoring {endpoint.url}: {e}")
+            status_code, results = 0, [metrics.unmatched(endpoint)]
+        finally:
+            timer.finish()
+            duration, phases = timer.duration, timer.phases()
+            if shared is not None:
+                self.coalescer.close(shared)
+                # Nobody joins it anymore, later checks of the URL take their own token
+                if self._planned.get(endpoint.url, float("inf")) <= asyncio.get_running_loop().time():
+                    del self._planned[endpoint.url]
+                if not shared.result.done():
+                    shared.result.set_result((timestamp, status_code, duration, phases, results[1:]))
+            await self._record(endpoint, timestamp, status_code, duration, results[0], phases, late)
+            if self.limiter is not None:
+                self.limiter.observe_check(duration, phases)
+
+    async def _check_joined(self, endpoint: Endpoint, shared: SharedRequest, index: int):
+        """Wait for the request an endpoint joined, and record it with its own regex result."""
+        late = check_start_delay.get() > self.scheduler.late_after
+        timestamp, status_code, duration, phases, results = await asyncio.shield(shared.result)
+        result = results[index] if index < len(results) else metrics.unmatched(endpoint)
+        await self._record(endpoint, timestamp, status_code, duration, result, phases, late)
+
+    # pylint: disable=too-many-arguments
+    async def _record(self, endpoint: Endpoint, timestamp: float, status_code: int, duration: float,
+                      result: tuple, phases: Tuple[int, ...], late: bool):
+        """Write the result of a check into the batch, and hand the batch off once full.
+        result is (regex_match, bytes_read, truncated, regex_timed_out), see metrics.evaluate_response.
+        """
+        regex_match, bytes_read, truncated, regex_timed_out = result
+        self.batch.append_row(endpoint.endpoint_id, endpoint.url, timestamp, status_code, duration,
+                              regex_match, bytes_read, truncated, regex_timed_out, phases, late)
+        self.checks += 1
+        if self.batch.is_full():
+            await self.hand_off()
 
     def process_endpoint(self, endpoint: Endpoint):
         """Process a single endpoint."""
@@ -82,8 +243,8 @@ class Worker:
                 content = await response.text()
                 is_up = response.status == 200
                 
-                if is_up and endpoint.regex:
-                    is_up = bool(re.search(endpoint.regex, content))
+                if is_up:
+                    is_up = endpoint.matches(content)
                 
                 logger.info(f"Endpoint {endpoint.url} is {'up' if is_up else 'down'}")
                 # TODO: Store metrics in database
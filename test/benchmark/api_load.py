@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This script measures the throughput and latency of the API under concurrent requests.
+BENCHMARK_CONCURRENCY clients send requests back to back for BENCHMARK_DURATION
+seconds: mostly GET /endpoints/{id}, and some GET /endpoints and PUT /endpoints/{id}
+writing back the same interval. It reports requests/s and latency percentiles.
+Run it against a build before and after a change, with BENCHMARK_LABEL telling them apart.
+It needs an API at API_URL, on a DB filled by test.client.generate_endpoints.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+
+from src.utils import logger
+
+API_URL = os.getenv("API_URL", "http://localhost:8080")
+CONCURRENCY = int(os.getenv("BENCHMARK_CONCURRENCY", "50"))
+DURATION = float(os.getenv("BENCHMARK_DURATION", "30"))
+LABEL = os.getenv("BENCHMARK_LABEL", "api")
+
+def percentile(latencies, fraction):
+    """Percentile of sorted latencies, in milliseconds."""
+    return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 3)
+
+def summarize(latencies, errors, elapsed):
+    """Summarize the latencies of every request."""
+    latencies = sorted(latencies)
+    return {
+        "label": LABEL,
+        "concurrency": CONCURRENCY,
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": percentile(latencies, 1.0),
+    }
+
+async def send(session, endpoints):
+    """Send one request of the mix, and tell if it succeeded."""
+    endpoint = random.choice(endpoints)
+    dice = random.random()
+    if dice < 0.8:
+        request = session.get(f"{API_URL}/endpoints/{endpoint['endpoint_id']}")
+    elif dice < 0.9:
+        request = session.get(f"{API_URL}/endpoints", params={"limit": 100})
+    else:
+        request = session.put(f"{API_URL}/endpoints/{endpoint['endpoint_id']}",
+                              json={"interval": endpoint["interval"]})
+    async with request as response:
+        await response.read()
+        return response.status < 400
+
+async def client(session, endpoints, deadline, latencies, errors):
+    """Send requests back to back until the deadline."""
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            ok = await send(session, endpoints)
+        except aiohttp.ClientError:
+            ok = False
+        latencies.append(time.perf_counter() - started)
+        if not ok:
+            errors.append(1)
+
+async def main():
+    """ This is an independent script."""
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with session.get(f"{API_URL}/endpoints", params={"limit": 100}) as response:
+            endpoints = await response.json()
+        if not endpoints:
+            logger.error("No endpoints to request, fill the DB with test.client.generate_endpoints")
+            return
+        latencies, errors = [], []
+        started = time.monotonic()
+        await asyncio.gather(*(client(session, endpoints, started + DURATION, latencies, errors)
+                               for _ in range(CONCURRENCY)))
+        elapsed = time.monotonic() - started
+    logger.info(json.dumps(summarize(latencies, len(errors), elapsed)))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This script measures how many checks a worker process sustains, and how accurately.
+A farm of BENCHMARK_SERVER_PROCESSES processes serves the seeded responses of
+test.server.test_server on loopback. For each of BENCHMARK_SIZES, a fresh process runs
+a Worker and a MetricsHandler on that many endpoints checked every BENCHMARK_INTERVAL
+seconds. After one interval of warm-up, it measures for BENCHMARK_DURATION seconds:
+- checks/s, and checks per CPU second, i.e. per core;
+- the start delay of checks and the event loop lag, as percentiles;
+- the measured duration minus the latency the server injected;
+- the limit of checks in flight the process adapted to;
+- the RSS of the process.
+Each result is logged as one JSON line, and all of them are written to BENCHMARK_OUTPUT
+if set, so runs before and after a change can be compared.
+It needs no DB: metrics go to a sink that only compares durations.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+
+from src.utils import logger
+from src.endpoint import Endpoint
+from src.worker.worker import Worker
+from src.worker.metrics_buffer import MetricsBuffer
+from src.worker.metrics_handler import MetricsHandler
+from src.worker.instrumentation import runtime_stats
+from src.worker.latency_sketch import quantiles
+from test.server.test_server import ResponseProfile, serve_farm
+
+SIZES = [int(size) for size in os.getenv("BENCHMARK_SIZES", "1000,10000,50000").split(",")]
+DURATION = float(os.getenv("BENCHMARK_DURATION", "60"))
+INTERVAL = int(os.getenv("BENCHMARK_INTERVAL", "5"))
+SERVER_PROCESSES = int(os.getenv("BENCHMARK_SERVER_PROCESSES", "2"))
+PORT = int(os.getenv("BENCHMARK_PORT", "8002"))
+SEED = int(os.getenv("BENCHMARK_SEED", "42"))
+REGEX = os.getenv("BENCHMARK_REGEX", ".*welcome")
+LABEL = os.getenv("BENCHMARK_LABEL", "worker")
+OUTPUT = os.getenv("BENCHMARK_OUTPUT")
+
+class MeasurementSink:
+    """Stands for the metrics store: it compares each measured duration with the injected latency."""
+
+    def __init__(self, injected: array):
+        self.injected = injected
+        self.errors = array("d")
+        self.rows = 0
+        self.failed = 0
+
+    def reset(self):
+        """Start the measurement window."""
+        self.errors = array("d")
+        self.rows = 0
+        self.failed = 0
+
+    async def add(self, batch):
+        """Compare the durations of a batch."""
+        for i in range(len(batch)):
+            self.rows += 1
+            duration = batch.duration[i]
+            if not batch.status_code[i] or duration != duration:
+                self.failed += 1
+            else:
+                self.errors.append(duration - self.injected[batch.endpoint_id[i]])
+
+    async def flush(self):
+        """Nothing is buffered."""
+
+    async def flush_if_due(self):
+        """Nothing is buffered."""
+
+def percentile(values, fraction):
+    """Percentile of sorted values, in milliseconds."""
+    if not values:
+        return None
+    return round(values[min(int(len(values) * fraction), len(values) - 1)] * 1000, 3)
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def rss_mb() -> Dict[str, float]:
+    """Current and peak resident memory of this process."""
+    current = 0
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"rss_mb": round(current / 2 ** 20, 1), "peak_rss_mb": round(peak / 2 ** 20, 1)}
+
+async def measure(size: int) -> Dict:
+    """Run a worker on size endpoints and measure it."""
+    random.seed(SEED)
+    profile = ResponseProfile()
+    injected = array("d", [0.0] * (size + 1))
+    for endpoint_id in range(1, size + 1):
+        injected[endpoint_id] = profile.response(str(endpoint_id))[0]
+    endpoints = [Endpoint(endpoint_id, f"http://127.0.0.1:{PORT}/{endpoint_id}", REGEX, INTERVAL)
+                 for endpoint_id in range(1, size + 1)]
+
+    metrics_buffer = MetricsBuffer()
+    sink = MeasurementSink(injected)
+    metrics_handler = MetricsHandler(metrics_buffer, sink)
+    worker = Worker(metrics_buffer)
+    handler_task = asyncio.create_task(metrics_handler.run())
+    worker_task = asyncio.create_task(worker.run(endpoints))
+
+    # First checks are spread over one interval
+    await asyncio.sleep(INTERVAL)
+    # Windows longer than the measurement, so percentiles cover all of it
+    runtime_stats.window = DURATION + INTERVAL
+    runtime_stats.reset()
+    sink.reset()
+    checks = worker.checks
+    cpu = time.process_time()
+    started = time.perf_counter()
+    await asyncio.sleep(DURATION)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    checks = worker.checks - checks
+    memory = rss_mb()
+    window = runtime_stats.stages["start_delay"].window
+    start_delays = quantiles(runtime_stats.stages["start_delay"].recent(window), (0.5, 0.9, 0.99, 1.0))
+    loop_lags = quantiles(runtime_stats.loop_lag.recent(runtime_stats.loop_lag.window), (0.5, 0.99))
+
+    worker.stop()
+    await worker_task
+    metrics_handler.stop()
+    await handler_task
+
+    errors = sorted(sink.errors)
+    return {
+        "label": LABEL,
+        "endpoints": size,
+        "interval_s": INTERVAL,
+        "elapsed_s": round(elapsed, 3),
+        "checks": checks,
+        "failed_checks": sink.failed,
+        "checks_per_second": round(checks / elapsed, 1),
+        "cpu_utilization": round(cpu / elapsed, 3),
+        "checks_per_core_second": round(checks / cpu, 1) if cpu else None,
+        "start_delay_p50_ms": milliseconds(start_delays[0]),
+        "start_delay_p90_ms": milliseconds(start_delays[1]),
+        "start_delay_p99_ms": milliseconds(start_delays[2]),
+        "start_delay_max_ms": milliseconds(start_delays[3]),
+        "loop_lag_p50_ms": milliseconds(loop_lags[0]),
+        "loop_lag_p99_ms": milliseconds(loop_lags[1]),
+        "loop_lag_max_ms": milliseconds(runtime_stats.max_loop_lag),
+        "concurrency_limit": worker.scheduler.max_in_flight,
+        "measurement_error_p50_ms": percentile(errors, 0.5),
+        "measurement_error_p99_ms": percentile(errors, 0.99),
+        "measurement_error_mean_ms": round(sum(errors) / len(errors) * 1000, 3) if errors else None,
+        **memory,
+    }
+
+def run_size(size: int) -> Dict:
+    """Entry point of the process measuring one size."""
+    return asyncio.run(measure(size))
+
+def main():
+    """ This is an independent script."""
+    context = multiprocessing.get_context("spawn")
+    farm = [context.Process(target=serve_farm, args=(PORT,), daemon=True) for _ in range(SERVER_PROCESSES)]
+    for process in farm:
+        process.start()
+    # Let the farm bind its port
+    time.sleep(2)
+    results = []
+    try:
+        for size in SIZES:
+            # A fresh process per size, so the RSS of one size doesn't carry over to the next
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_size, size).result()
+            logger.info(json.dumps(result))
+            results.append(result)
+    finally:
+        for process in farm:
+            process.terminate()
+            process.join()
+    if OUTPUT:
+        with open(OUTPUT, "w", encoding="utf-8") as output:
+            json.dump({"label": LABEL, "seed": SEED, "results": results}, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This script measures how much the DB backends stall the event loop.
+A probe coroutine wakes up every millisecond and records how late it is, the
+way an in-flight latency measurement would be delayed, while the endpoint
+list is fetched repeatedly with the psycopg2 and then the asyncpg backend.
+It needs a reachable DB filled by test.client.generate_endpoints.
+"""
+
+import asyncio
+import json
+import os
+import statistics
+
+from src.utils import load_config, logger
+from src.endpoint_manager import EndpointManager
+from src.async_endpoint_manager import AsyncEndpointManager
+
+PROBE_INTERVAL = 0.001
+ROUNDS = int(os.getenv("BENCHMARK_ROUNDS", "20"))
+
+async def probe(lags, stop: asyncio.Event):
+    """Record how late the event loop wakes up this coroutine."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(loop.time() - expected)
+
+def summarize(name, lags, elapsed):
+    """Summarize the lags of the probe in milliseconds."""
+    lags = sorted(lags)
+    return {
+        "backend": name,
+        "rounds": ROUNDS,
+        "elapsed_s": round(elapsed, 3),
+        "max_stall_ms": round(lags[-1] * 1000, 3),
+        "p99_stall_ms": round(lags[int(len(lags) * 0.99)] * 1000, 3),
+        "mean_stall_ms": round(statistics.mean(lags) * 1000, 3),
+    }
+
+async def measure(name, fetch):
+    """Run the probe while fetching the endpoint list ROUNDS times."""
+    lags = []
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    prober = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(PROBE_INTERVAL * 10)
+    started = loop.time()
+    for _ in range(ROUNDS):
+        await fetch()
+    elapsed = loop.time() - started
+    stop.set()
+    await prober
+    return summarize(name, lags, elapsed)
+
+async def main():
+    """ This is an independent script."""
+    load_config()
+    results = []
+
+    sync_manager = EndpointManager()
+    async def sync_fetch():
+        # This is how the worker and the API used to call the DB: inline, from a coroutine
+        sync_manager.fetch_all_endpoints()
+    results.append(await measure("psycopg2", sync_fetch))
+    sync_manager.close()
+
+    async_manager = await AsyncEndpointManager().open()
+    results.append(await measure("asyncpg", async_manager.fetch_all_endpoints))
+    await async_manager.close()
+
+    for result in results:
+        logger.info(json.dumps(result))
+
+if __name__ == "__main__":
+    asyncio.run(main())
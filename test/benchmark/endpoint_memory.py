@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This script measures the memory and the load time of endpoints.
+It builds endpoints from rows shaped like the ones of test.client.generate_endpoints,
+with the slotted, interned Endpoint and with the dict-based Endpoint it replaced,
+which compiled a private copy of each pattern.
+The load time is the part of fetch_endpoints spent turning fetched rows into
+endpoints, so it runs without a DB.
+"""
+
+import gc
+import json
+import os
+import re
+import time
+import tracemalloc
+
+from src.utils import logger
+from src.endpoint import Endpoint
+
+SIZES = [int(size) for size in os.getenv("BENCHMARK_SIZES", "100000,1000000").split(",")]
+
+# pylint: disable=too-few-public-methods
+class LegacyEndpoint:
+    """The Endpoint before slots and interning."""
+    def __init__(self, endpoint_id, url, regex, interval):
+        self.endpoint_id = endpoint_id
+        self.url = url
+        self.regex = regex
+        self._compiled_regex = re.compile(regex) if regex else None
+        self.interval = interval
+
+def generate_rows(size):
+    """Rows as psycopg2 returns them: every string is a distinct object."""
+    welcome = "welcome"
+    return [(i, f"http://testserver:8001/{i}", ".*" + welcome, 5 + i % 26) for i in range(1, size + 1)]
+
+def measure(name, build, size):
+    """Measure the bytes per endpoint and the load time of one representation."""
+    gc.collect()
+    tracemalloc.start()
+    rows = generate_rows(size)
+    started = time.perf_counter()
+    endpoints = [build(*row) for row in rows]
+    elapsed = time.perf_counter() - started
+    # the rows are released once loaded, so only the row strings endpoints keep alive are counted
+    del rows
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        "representation": name,
+        "endpoints": len(endpoints),
+        "bytes_per_endpoint": round(allocated / len(endpoints), 1),
+        "load_time_s": round(elapsed, 3),
+    }
+    del endpoints
+    return result
+
+def main():
+    """ This is an independent script."""
+    for size in SIZES:
+        for name, build in (("legacy", LegacyEndpoint), ("slotted", Endpoint)):
+            logger.info(json.dumps(measure(name, build, size)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring, too-few-public-methods
+"""Fakes shared by the tests: aiohttp responses, and batches of check results."""
+
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+from unittest.mock import MagicMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.stat_batch import StatBatch
+from endpoint import Endpoint
+
+ENDPOINT = Endpoint(7, "http://testserver:8001", ".*welcome", 5)
+
+class FakeStream:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.bytes_served = 0
+
+    async def iter_chunked(self, n):
+        size = min(n, self.chunk_size)
+        for i in range(0, len(self.data), size):
+            self.bytes_served += len(self.data[i:i + size])
+            yield self.data[i:i + size]
+
+class FakeResponse:
+    def __init__(self, status=200, resp_data=None, chunk_size=4):
+        self.status = status
+        self.resp_data = resp_data
+        self.charset = "utf-8"
+        self.content = FakeStream((resp_data or "").encode(), chunk_size)
+        self.elapsed = MagicMock()
+        self.elapsed.total_seconds = lambda: 0.1
+
+    async def text(self):
+        return self.resp_data
+
+# pylint: disable=too-many-arguments
+def make_batch(size: int = 1,
+               endpoint: Endpoint = ENDPOINT,
+               timestamp: Optional[float] = None,
+               interval: float = 0.0,
+               status_code: int = 200,
+               duration: Optional[float] = 0.5,
+               regex_match: Optional[bool] = True,
+               capacity: Optional[int] = None,
+               **columns) -> StatBatch:
+    """A batch of size identical checks of an endpoint, taken interval seconds apart from
+    timestamp, now by default. columns are passed on to StatBatch.append.
+    """
+    batch = StatBatch(capacity or size)
+    start = time.time() if timestamp is None else timestamp
+    for i in range(size):
+        batch.append(endpoint, start + i * interval, status_code, duration, regex_match, **columns)
+    return batch
+
+@pytest.fixture
+def aiohttp_response():
+    """The class of a fake aiohttp response, whose body is served in chunks of chunk_size bytes."""
+    return FakeResponse
+
+@pytest.fixture
+def create_batch():
+    """A factory of batches of identical checks, see make_batch."""
+    return make_batch
@@ -1,32 +1,112 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-""" This is the test server that we are going to monitor."""
+""" This is the test server that we are going to monitor.
+Responses follow seeded distributions of latency, status and body size, and a path
+always gets the same response, so a benchmark knows the latency it injected:
+- TEST_SERVER_SEED picks the draw.
+- Latencies are log-normal around TEST_SERVER_LATENCY_MEDIAN_MS, spread by TEST_SERVER_LATENCY_SIGMA.
+- Statuses are drawn from the weights of TEST_SERVER_STATUSES, e.g. "200:80,404:10,500:10".
+- Bodies of a 200 are log-normal around TEST_SERVER_BODY_MEDIAN_BYTES, spread by
+  TEST_SERVER_BODY_SIGMA, and end with "welcome".
+The FastAPI app is the target of docker-compose. The aiohttp farm serves the same
+responses much faster, for benchmarks on loopback.
+"""
 
-import random
 import asyncio
-from fastapi import FastAPI, Response, status
+import functools
+import math
+import os
+import random
+from typing import List, Tuple
+
+from aiohttp import web
+from fastapi import FastAPI, Response
 from fastapi.requests import Request
 import uvicorn
 
+SEED = int(os.getenv("TEST_SERVER_SEED", "42"))
+LATENCY_MEDIAN_MS = float(os.getenv("TEST_SERVER_LATENCY_MEDIAN_MS", "50"))
+LATENCY_SIGMA = float(os.getenv("TEST_SERVER_LATENCY_SIGMA", "1.0"))
+# Stays below the timeout of a check
+LATENCY_MAX_MS = float(os.getenv("TEST_SERVER_LATENCY_MAX_MS", "10000"))
+STATUSES = os.getenv("TEST_SERVER_STATUSES", "200:80,404:10,500:10")
+BODY_MEDIAN_BYTES = float(os.getenv("TEST_SERVER_BODY_MEDIAN_BYTES", "2048"))
+BODY_SIGMA = float(os.getenv("TEST_SERVER_BODY_SIGMA", "1.0"))
+BODY_MAX_BYTES = int(os.getenv("TEST_SERVER_BODY_MAX_BYTES", str(1024 * 1024)))
+
+WELCOME = b"You are always welcome!"
+# Lines of filler keep the ".*welcome" of generated endpoints linear
+FILLER_LINE = b"lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do\n"
+ERROR_BODIES = {404: b"NOT FOUND", 500: b"SERVER ERROR"}
+
+def parse_statuses(statuses: str) -> Tuple[List[int], List[float]]:
+    """Parse "200:80,500:20" into the codes and their weights."""
+    codes, weights = [], []
+    for item in statuses.split(","):
+        code, weight = item.split(":")
+        codes.append(int(code))
+        weights.append(float(weight))
+    return codes, weights
+
+class ResponseProfile:
+    """The seeded response of every path."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 seed: int = SEED,
+                 latency_median_ms: float = LATENCY_MEDIAN_MS,
+                 latency_sigma: float = LATENCY_SIGMA,
+                 statuses: str = STATUSES,
+                 body_median_bytes: float = BODY_MEDIAN_BYTES,
+                 body_sigma: float = BODY_SIGMA):
+        self.seed = seed
+        self.latency_mu = math.log(latency_median_ms / 1000)
+        self.latency_sigma = latency_sigma
+        self.codes, self.weights = parse_statuses(statuses)
+        self.body_mu = math.log(body_median_bytes)
+        self.body_sigma = body_sigma
+        self.response = functools.lru_cache(maxsize=None)(self._draw)
+
+    def _draw(self, path: str) -> Tuple[float, int, int]:
+        """The latency in seconds, status and body size of a path.
+        A string seed is hashed the same way in every process, unlike hash().
+        """
+        rng = random.Random(f"{self.seed}:{path}")
+        latency = min(rng.lognormvariate(self.latency_mu, self.latency_sigma), LATENCY_MAX_MS / 1000)
+        status = rng.choices(self.codes, self.weights)[0]
+        size = min(max(int(rng.lognormvariate(self.body_mu, self.body_sigma)), len(WELCOME)), BODY_MAX_BYTES)
+        return latency, status, size
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def body(status: int, size: int) -> bytes:
+        """The body of a response, filler ending with "welcome" for a 200."""
+        if status != 200:
+            return ERROR_BODIES.get(status, b"ERROR")
+        filler = size - len(WELCOME)
+        return (FILLER_LINE * (filler // len(FILLER_LINE) + 1))[:filler] + WELCOME
+
+profile = ResponseProfile()
 app = FastAPI()
 
 @app.get("/{full_path:path}")
-async def catch_all(_: Request):
-    """We ignore any input and return a random response."""
-    rand_val = random.randint(0, 100)
-
-    # 20% chance of high latency
-    if rand_val % 5 == 0:
-        await asyncio.sleep(1)
-    else:
-        await asyncio.sleep(0.01)
-
-    if rand_val <= 10:
-        return Response(content="SERVER ERROR", status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    if rand_val <= 20:
-        return Response(content="NOT FOUND", status_code=status.HTTP_404_NOT_FOUND)
-    return "You are always welcome!"
+async def catch_all(full_path: str, _: Request):
+    """We ignore any input and return the seeded response of the path."""
+    latency, status, size = profile.response(full_path)
+    await asyncio.sleep(latency)
+    return Response(content=profile.body(status, size), status_code=status)
+
+async def handle_farm_request(request: web.Request) -> web.Response:
+    """The seeded response of the path, served by aiohttp."""
+    latency, status, size = profile.response(request.match_info["path"])
+    await asyncio.sleep(latency)
+    return web.Response(body=profile.body(status, size), status=status)
 
+def serve_farm(port: int, host: str = "127.0.0.1"):
+    """Serve the seeded responses with aiohttp. Processes serving the same port share it."""
+    farm = web.Application()
+    farm.router.add_get("/{path:.*}", handle_farm_request)
+    web.run_app(farm, host=host, port=port, reuse_port=True, access_log=None, print=None)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001, log_level="debug")
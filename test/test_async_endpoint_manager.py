@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from async_endpoint_manager import AsyncEndpointManager, resolve
+from endpoint_manager import execute_prepared, escape_like, list_endpoints_query
+
+def create_manager(**pool_methods):
+    manager = AsyncEndpointManager()
+    manager.connection_pool = MagicMock(**{name: AsyncMock(return_value=value) for name, value in pool_methods.items()})
+    return manager
+
+@pytest.mark.asyncio
+async def test_resolve_supports_both_backends():
+    async def coroutine():
+        return 1
+    assert await resolve(coroutine()) == 1
+    assert await resolve(2) == 2
+
+@pytest.mark.asyncio
+async def test_fetch_endpoints_skips_invalid_regex():
+    manager = create_manager(fetch=[(1, "http://testserver:8001/1", ".*welcome", 5),
+                                    (2, "http://testserver:8001/2", "(", 5)])
+    endpoints = await manager.fetch_endpoints("2", "1")
+
+    assert [endpoint.endpoint_id for endpoint in endpoints] == [1]
+    assert manager.connection_pool.fetch.call_args.args[1:] == (2, 1)
+
+@pytest.mark.asyncio
+async def test_update_endpoint_numbers_placeholders():
+    manager = create_manager(fetchrow=(3, "http://testserver:8001/3", None, 10))
+    endpoint = await manager.update_endpoint(3, {"url": "http://testserver:8001/3", "interval": 10})
+
+    assert endpoint.interval == 10
+    sql, *values = manager.connection_pool.fetchrow.call_args.args
+    assert "SET url = $1, interval = $2" in sql
+    assert "WHERE endpoint_id = $3" in sql
+    assert values == ["http://testserver:8001/3", 10, 3]
+
+@pytest.mark.asyncio
+async def test_update_endpoint_rejects_unknown_columns():
+    manager = create_manager(fetchrow=None)
+    with pytest.raises(ValueError):
+        await manager.update_endpoint(3, {"endpoint_id = 0; --": 1})
+    manager.connection_pool.fetchrow.assert_not_called()
+
+def test_statements_are_prepared_once_per_connection():
+    cursor = MagicMock()
+    cursor.connection.prepared = set()
+
+    execute_prepared(cursor, "get_endpoint", "SELECT 1 WHERE $1 = 1", (1,))
+    execute_prepared(cursor, "get_endpoint", "SELECT 1 WHERE $1 = 1", (2,))
+
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert statements == ["PREPARE get_endpoint AS SELECT 1 WHERE $1 = 1;",
+                          "EXECUTE get_endpoint (%s);",
+                          "EXECUTE get_endpoint (%s);"]
+    assert cursor.execute.call_args.args[1] == (2,)
+
+@pytest.mark.asyncio
+async def test_list_endpoints_pages_by_cursor_with_filters():
+    manager = create_manager(fetch=[(7, "http://testserver:8001/7", "(", 10, None)])
+    rows = await manager.list_endpoints(5, 100, url_prefix="http://testserver:8001/", max_interval=30)
+
+    # Rows are not validated, the invalid regex is listed as stored
+    assert rows[0].regex == "("
+    sql, *values = manager.connection_pool.fetch.call_args.args
+    assert "endpoint_id > $1 AND url LIKE $2 AND interval <= $3" in sql
+    assert "ORDER BY endpoint_id" in sql and "LIMIT $4" in sql
+    assert values == [5, "http://testserver:8001/%", 30, 100]
+
+def test_deprecated_offset_skips_rows_after_the_cursor():
+    name, query, params = list_endpoints_query(0, 100, offset=200)
+
+    assert name == "list_endpoints_offset"
+    assert query.endswith("LIMIT $2 OFFSET $3")
+    assert params == [0, 100, 200]
+
+def test_url_prefix_wildcards_are_escaped():
+    assert escape_like("http://a_b/100%") == "http://a\\_b/100\\%"
+
+@pytest.mark.asyncio
+async def test_delete_missing_endpoint():
+    manager = create_manager(execute="DELETE 0")
+    with pytest.raises(ValueError):
+        await manager.delete_endpoint(42)
+
+@pytest.mark.asyncio
+async def test_pool_must_be_opened():
+    with pytest.raises(RuntimeError):
+        await AsyncEndpointManager().get_endpoint(1)
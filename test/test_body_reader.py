@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.body_reader import StreamingMatcher, read_and_match, read_and_match_all
+from endpoint import Endpoint
+
+async def feed_all(matcher, text, chunk_size):
+    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    for chunk in chunks[:-1]:
+        if await matcher.feed(chunk):
+            return True
+    return await matcher.feed(chunks[-1], final=True)
+
+@pytest.mark.asyncio
+async def test_match_across_chunk_boundary():
+    matcher = StreamingMatcher(Endpoint(1, "http://testserver:8001", "always welcome", 5), overlap=16)
+    assert await feed_all(matcher, "You are always welcome!", 3) is True
+
+@pytest.mark.asyncio
+async def test_anchors_keep_their_meaning():
+    start_anchored = Endpoint(1, "http://testserver:8001", "^welcome", 5)
+    assert await feed_all(StreamingMatcher(start_anchored, overlap=16), "You are welcome", 4) is False
+    assert await feed_all(StreamingMatcher(start_anchored, overlap=16), "welcome home", 4) is True
+
+    end_anchored = Endpoint(1, "http://testserver:8001", r"[0-9]{2}:[0-9]{2}$", 5)
+    assert await feed_all(StreamingMatcher(end_anchored, overlap=16), "at 12:00 or later", 4) is False
+    assert await feed_all(StreamingMatcher(end_anchored, overlap=16), "welcome at 12:00", 4) is True
+
+@pytest.mark.asyncio
+async def test_download_stops_once_matched(aiohttp_response):
+    resp = aiohttp_response(200, "welcome" + "x" * 1000, chunk_size=16)
+    matched, bytes_read, truncated, _ = await read_and_match(resp, Endpoint(1, "http://testserver:8001", "welcome", 5))
+
+    assert matched is True
+    assert truncated is False
+    assert bytes_read == 16
+    assert resp.content.bytes_served == 16
+
+@pytest.mark.asyncio
+async def test_multibyte_characters_split_across_chunks(aiohttp_response):
+    resp = aiohttp_response(200, "välkommen", chunk_size=2)
+    matched, bytes_read, _, _ = await read_and_match(resp, Endpoint(1, "http://testserver:8001", "välkommen", 5))
+
+    assert matched is True
+    assert bytes_read == len("välkommen".encode())
+
+@pytest.mark.asyncio
+async def test_one_body_for_several_regexes(aiohttp_response):
+    resp = aiohttp_response(200, "You are always welcome!" + "x" * 100, chunk_size=8)
+    endpoints = [
+        Endpoint(1, "http://testserver:8001", "always", 5),
+        Endpoint(2, "http://testserver:8001", "welcome", 5, max_body_bytes=12),
+        Endpoint(3, "http://testserver:8001", "welcome", 5),
+        Endpoint(4, "http://testserver:8001", "goodbye", 5),
+    ]
+
+    results = await read_and_match_all(resp, endpoints)
+
+    assert results == [
+        (True, 16, False, False),
+        (False, 12, True, False),
+        (True, 24, False, False),
+        (False, 123, False, False),
+    ]
+    # the body is read once, whatever the number of regexes
+    assert resp.content.bytes_served == 123
+
+@pytest.mark.asyncio
+async def test_match_ending_at_the_byte_cap(aiohttp_response):
+    resp = aiohttp_response(200, "You are always welcome!" + "x" * 100, chunk_size=8)
+    capped_endpoint = Endpoint(1, "http://testserver:8001", "welcome.*", 5, max_body_bytes=22)
+
+    assert await read_and_match(resp, capped_endpoint) == (True, 22, False, False)
+
+@pytest.mark.asyncio
+async def test_unknown_charset_is_read_as_utf8(aiohttp_response):
+    resp = aiohttp_response(200, "välkommen", chunk_size=4)
+    resp.charset = "x-unknown-charset"
+    endpoint = Endpoint(1, "http://testserver:8001", "välkommen", 5)
+
+    assert await read_and_match(resp, endpoint) == (True, 10, False, False)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from api.bulk import format_of, read_import, stream_export
+from async_endpoint_manager import AsyncEndpointManager
+
+async def body(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+def test_format_of_content_type():
+    assert format_of("application/x-ndjson; charset=utf-8") == "ndjson"
+    assert format_of("text/csv") == "csv"
+    with pytest.raises(ValueError):
+        format_of("application/json")
+
+@pytest.mark.asyncio
+async def test_ndjson_lines_split_across_chunks():
+    rows, errors = await read_import(body(
+        b'{"url": "http://testserver:8001/1", "interval": 5}\n{"url": "http://test',
+        b'server:8001/2", "regex": ".*welcome", "interval": 10, "endpoint_id": 7}\n\n',
+        ), "ndjson")
+
+    assert not errors
+    assert rows == [(1, None, "http://testserver:8001/1", None, 5, None),
+                    (2, 7, "http://testserver:8001/2", ".*welcome", 10, None)]
+
+@pytest.mark.asyncio
+async def test_csv_with_empty_fields_as_null():
+    rows, errors = await read_import(body(
+        b"endpoint_id,url,regex,interval,max_body_bytes\r\n",
+        b"1,http://TestServer:8001,,5,\r\n2,http://testserver:8001/2,\"a,b\",30,4096\r\n",
+        ), "csv")
+
+    assert not errors
+    # urls are normalised like the API does
+    assert rows == [(2, 1, "http://testserver:8001/", None, 5, None),
+                    (3, 2, "http://testserver:8001/2", "a,b", 30, 4096)]
+
+@pytest.mark.asyncio
+async def test_every_invalid_line_is_reported():
+    _, errors = await read_import(body(
+        b'{"url": "http://testserver:8001/1", "interval": 5}\n',
+        b'{"url": "ftp://testserver/2", "interval": 5}\n',
+        b'{"url": "http://testserver:8001/3", "interval": 500}\n',
+        b'{"url": "http://testserver:8001/4", "interval": 5, "regex": "("}\n',
+        b'{"url": "http://testserver:8001/5", "interval": 5, "max_body_bytes": 0}\n',
+        b'{"url": "http://testserver:8001/6", "interval": true}\n',
+        b'{"url": "http://testserver:8001/7", "interval": 5, "typo": 1}\n',
+        b'not json\n',
+        b'{"url": "http://testserver:8001/9", "interval": 5, "endpoint_id": -1}\n',
+        ), "ndjson")
+
+    assert [error["line"] for error in errors] == [2, 3, 4, 5, 6, 7, 8, 9]
+    assert "invalid regex" in errors[2]["error"]
+
+@pytest.mark.asyncio
+async def test_same_url_with_different_regexes_is_imported_twice():
+    rows, errors = await read_import(body(
+        b'{"url": "http://testserver:8001/", "regex": "welcome", "interval": 5}\n',
+        b'{"url": "http://testserver:8001/", "regex": "goodbye", "interval": 5}\n',
+        ), "ndjson")
+    manager = AsyncEndpointManager()
+    conn = MagicMock(execute=AsyncMock(return_value="UPDATE 0"), copy_records_to_table=AsyncMock())
+    conn.transaction.return_value.__aenter__ = AsyncMock()
+    conn.transaction.return_value.__aexit__ = AsyncMock(return_value=False)
+    manager.connection_pool = MagicMock()
+    manager.connection_pool.acquire.return_value.__aenter__ = AsyncMock(return_value=conn)
+    manager.connection_pool.acquire.return_value.__aexit__ = AsyncMock(return_value=False)
+
+    await manager.import_endpoints(rows, replace=True)
+
+    assert not errors
+    assert conn.copy_records_to_table.call_args.kwargs["records"] == [
+        (1, None, "http://testserver:8001/", "welcome", 5, None),
+        (2, None, "http://testserver:8001/", "goodbye", 5, None),
+    ]
+    # rows are merged and deleted by endpoint, never by URL alone
+    statements = [call.args[0] for call in conn.execute.call_args_list]
+    assert not any("e.url = i.url" in statement for statement in statements)
+    assert any("DISTINCT ON (endpoint_id, key_url, key_regex)" in statement for statement in statements)
+
+@pytest.mark.asyncio
+async def test_csv_header_must_name_required_fields():
+    rows, errors = await read_import(body(b"url,regex\nhttp://testserver:8001/1,\n"), "csv")
+
+    assert not rows
+    assert "interval" in errors[0]["error"]
+
+@pytest.mark.asyncio
+async def test_import_is_capped():
+    lines = b"".join(b'{"url": "http://testserver:8001/%d", "interval": 5}\n' % i for i in range(10))
+    _, errors = await read_import(body(lines), "ndjson", max_rows=5)
+
+    assert "at most 5 rows" in errors[-1]["error"]
+
+@pytest.mark.asyncio
+async def test_export_streams_chunks_of_a_sync_manager():
+    def export(export_format, write):
+        assert export_format == "csv"
+        for i in range(100):
+            write(b"%d\n" % i)
+
+    chunks = [chunk async for chunk in stream_export(export, "csv")]
+
+    assert b"".join(chunks) == b"".join(b"%d\n" % i for i in range(100))
+
+@pytest.mark.asyncio
+async def test_export_streams_chunks_of_an_async_manager():
+    async def export(_, write):
+        await write(b"a\n")
+        await write(memoryview(b"b\n"))
+
+    assert [chunk async for chunk in stream_export(export, "ndjson")] == [b"a\n", b"b\n"]
+
+@pytest.mark.asyncio
+async def test_sync_export_stops_when_the_client_is_gone():
+    finished = threading.Event()
+
+    def export(_, write):
+        try:
+            while True:
+                write(b"x" * 1024)
+        finally:
+            finished.set()
+
+    stream = stream_export(export, "csv")
+    assert await stream.__anext__() == b"x" * 1024
+    await stream.aclose()
+
+    assert finished.is_set()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.coalescer import RequestCoalescer
+from worker.host_limiter import HostLimiter
+from worker.scheduler import Scheduler
+from worker.worker import Worker
+from endpoint import Endpoint
+
+@pytest.mark.asyncio
+async def test_requests_are_joined_within_the_window():
+    coalescer = RequestCoalescer(window=1.0)
+    first = Endpoint(1, "http://testserver:8001/a", "welcome", 5)
+    second = Endpoint(2, "http://testserver:8001/a", "goodbye", 5)
+    other_url = Endpoint(3, "http://testserver:8001/b", None, 5)
+
+    assert coalescer.join(first, 0.0) is None
+    shared = coalescer.lead(first, 0.0)
+    assert coalescer.join(second, 0.5) == (shared, 0)
+    assert coalescer.join(other_url, 0.5) is None
+    # too late to join, the check sends its own request
+    assert coalescer.join(second, 1.5) is None
+
+    assert coalescer.close(shared) == [second]
+    assert coalescer.join(second, 0.5) is None
+    assert coalescer.coalesced == 1
+
+@pytest.mark.asyncio
+async def test_checks_of_the_same_url_share_one_request(aiohttp_response):
+    def slow_get(*_, **__):
+        request_context = MagicMock()
+        async def enter():
+            await asyncio.sleep(0.01)
+            return aiohttp_response(200, "You are always welcome!", chunk_size=8)
+        request_context.__aenter__ = AsyncMock(side_effect=enter)
+        request_context.__aexit__ = AsyncMock(return_value=False)
+        return request_context
+
+    endpoints = [
+        Endpoint(1, "http://testserver:8001", "welcome", 5),
+        Endpoint(2, "http://testserver:8001", "goodbye", 5),
+        Endpoint(3, "http://testserver:8001", None, 5),
+    ]
+    worker = Worker(MagicMock(put=AsyncMock()))
+    worker.session = MagicMock(get=MagicMock(side_effect=slow_get))
+
+    await asyncio.gather(*(worker.check(endpoint) for endpoint in endpoints))
+
+    assert worker.session.get.call_count == 1
+    assert worker.coalescer.coalesced == 2
+    batch, rows = worker.batch, len(worker.batch)
+    assert sorted(batch.endpoint_id[:rows]) == [1, 2, 3]
+    # each endpoint gets its own regex result, and the status and duration of the request
+    matches = dict(zip(batch.endpoint_id[:rows], batch.regex_match[:rows]))
+    assert matches[1] == 1 and matches[2] == 0
+    assert set(batch.status_code[:rows]) == {200}
+    assert len(set(batch.duration[:rows])) == 1
+
+@pytest.mark.asyncio
+async def test_endpoints_of_the_same_url_are_due_together():
+    scheduler = Scheduler(AsyncMock())
+    now = asyncio.get_running_loop().time()
+    scheduler.add(Endpoint(1, "http://testserver:8001/a", "welcome", 30))
+    await asyncio.sleep(0.01)
+    scheduler.add(Endpoint(2, "http://testserver:8001/a", "goodbye", 30))
+
+    first, second = sorted(deadline for deadline, *_ in scheduler._heap)
+    assert first == pytest.approx(second)
+    assert now <= first < now + 30
+
+@pytest.mark.asyncio
+async def test_only_the_request_sent_takes_a_host_token():
+    worker = Worker(MagicMock(put=AsyncMock()), host_limiter=HostLimiter(rate=1, burst=1, limits={}))
+    first = Endpoint(1, "http://testserver:8001/a", "welcome", 5)
+    second = Endpoint(2, "http://testserver:8001/a", "goodbye", 5)
+    other_url = Endpoint(3, "http://testserver:8001/b", None, 5)
+
+    assert worker.scheduler.throttle(first, 10.0) == 0.0
+    # joins the request planned for its URL, without a token
+    assert worker.scheduler.throttle(second, 10.5) == 0.0
+    assert worker.scheduler.throttle(other_url, 10.5) == pytest.approx(0.5)
+    # too late to join, it sends its own request
+    assert worker.scheduler.throttle(second, 11.5) == pytest.approx(0.5)
+    assert worker.host_limiter.deferred == 2
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+from pathlib import Path
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.concurrency_limiter import ConcurrencyLimiter
+from worker.scheduler import Scheduler
+
+async def check(_):
+    pass
+
+def create_limiter(**kwargs):
+    scheduler = Scheduler(check, max_in_flight=100)
+    return scheduler, ConcurrencyLimiter(scheduler, 100, min_limit=10, accuracy_bound=0.05,
+                                         increase=10, decrease=0.5, **kwargs)
+
+def test_loop_lag_cuts_the_limit():
+    scheduler, limiter = create_limiter()
+    limiter.observe_loop_lag(0.2)
+
+    assert limiter.adjust() == 50
+    assert scheduler.max_in_flight == 50
+    # the next interval starts without lag
+    scheduler.saturated = True
+    assert limiter.adjust() == 60
+    assert limiter.stats()["decreases"] == 1
+    assert limiter.stats()["increases"] == 1
+
+def test_drifted_checks_cut_the_limit_down_to_the_minimum():
+    scheduler, limiter = create_limiter(drifted_fraction=0.1)
+    for _ in range(3):
+        # 30ms of network phases in a duration of 100ms
+        limiter.observe_check(0.1, (0, 0, 0, 30000, 0))
+        for _ in range(5):
+            limiter.observe_check(0.031, (1000, 0, 0, 30000, 0))
+        limiter.adjust()
+
+    assert scheduler.max_in_flight == 12
+    limiter.observe_check(0.1, (0, 0, 0, 30000, 0))
+    assert limiter.adjust() == 10
+
+def test_limit_grows_only_while_saturated_and_accurate():
+    scheduler, limiter = create_limiter()
+    limiter.observe_loop_lag(0.2)
+    limiter.adjust()
+    # failed checks have no phases and don't count
+    limiter.observe_check(30.0, (5, -1, -1, -1, -1))
+
+    assert limiter.adjust() == 50
+    scheduler.saturated = True
+    limiter.observe_check(0.04, (0, 0, 0, 30000, 0))
+    assert limiter.adjust() == 60
+    assert not scheduler.saturated
@@ -31,4 +31,30 @@ def test_endpoint_with_no_regex():
 def test_endpoint_with_empty_regex():
     """Test that Endpoint creation works with an empty regex string"""
     endpoint = Endpoint(1, "http://example.com", "", 60)
-    assert not hasattr(endpoint, 'regex') 
\ No newline at end of file
+    assert not hasattr(endpoint, 'regex') 
+
+
+def test_endpoints_share_compiled_pattern_and_url():
+    """Test that endpoints with the same regex and URL share one object of each"""
+    first = Endpoint(1, "http://example.com/" + "welcome", ".*" + "welcome", 60)
+    second = Endpoint(2, "http://example.com/" + "welcome", ".*" + "welcome", 60)
+    assert first.regex is second.regex
+    assert first.url is second.url
+    assert first.regex_pattern == ".*welcome"
+
+
+def test_endpoint_origin():
+    """Test that the origin of an endpoint is its lowercased host and port"""
+    assert Endpoint(1, "http://TestServer:8001/a?b=1", None, 5).origin == "testserver:8001"
+    assert Endpoint(2, "https://example.com/", None, 5).origin == "example.com:443"
+    assert Endpoint(3, "http://example.com", None, 5).origin == "example.com:80"
+    # endpoints of the same origin share the key
+    assert Endpoint(4, "http://example.com/x", None, 5).origin is Endpoint(5, "http://example.com/y", None, 5).origin
+
+
+def test_endpoint_is_slotted():
+    """Test that Endpoint carries no per-instance dict"""
+    endpoint = Endpoint(1, "http://example.com", None, 60)
+    assert not hasattr(endpoint, '__dict__')
+    assert endpoint.regex_pattern is None
+    assert endpoint.matches("anything")
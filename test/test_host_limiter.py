@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.host_limiter import HostLimiter, TokenBucket, parse_limits
+from worker.scheduler import Scheduler
+from endpoint import Endpoint
+
+def test_parse_limits():
+    assert parse_limits(" TestServer:8001=50/100, example.com=5,") == {
+        "testserver:8001": (50.0, 100.0),
+        "example.com": (5.0, 0.0),
+    }
+    with pytest.raises(ValueError):
+        parse_limits("example.com")
+
+def test_tokens_are_reserved_evenly_spaced():
+    bucket = TokenBucket(rate=10, burst=2, now=0.0)
+
+    delays = [bucket.reserve(0.0, max_delay=5) for _ in range(5)]
+
+    assert delays == pytest.approx([0.0, 0.0, 0.1, 0.2, 0.3])
+    # a token which wouldn't come within max_delay isn't taken
+    assert bucket.reserve(0.0, max_delay=0.35) is None
+    assert bucket.reserve(0.0, max_delay=5) == pytest.approx(0.4)
+
+def test_limits_per_origin():
+    limiter = HostLimiter(rate=0, burst=0, limits={"testserver:8001": (1, 1), "example.com": (2, 0)})
+    limited = Endpoint(1, "http://TestServer:8001/a", None, 5)
+    same_host = Endpoint(2, "https://example.com/b", None, 5)
+    unlimited = Endpoint(3, "http://other:8001/a", None, 5)
+
+    assert limiter.enabled
+    assert limiter.limit_of(same_host.origin) == (2, 0)
+    assert [limiter.reserve(limited, 0.0) for _ in range(2)] == [0.0, 1.0]
+    assert [limiter.reserve(same_host, 0.0) for _ in range(3)] == [0.0, 0.0, 0.5]
+    assert limiter.reserve(unlimited, 0.0) == 0.0
+    assert limiter.stats() == {"origins": 3, "limited_origins": 2, "deferred": 2, "skipped": 0}
+    assert not HostLimiter(rate=0, limits={}).enabled
+
+@pytest.mark.asyncio
+async def test_checks_of_an_origin_are_spread():
+    starts = []
+    scheduler = None
+
+    async def check(_):
+        starts.append(asyncio.get_running_loop().time())
+        if len(starts) == 4:
+            scheduler.stop()
+
+    limiter = HostLimiter(rate=20, burst=1, limits={})
+    scheduler = Scheduler(check, tick=0.005, throttle=limiter.reserve)
+    now = asyncio.get_running_loop().time()
+    for i in range(1, 5):
+        scheduler.add(Endpoint(i, f"http://testserver:8001/{i}", None, 5), first_deadline=now)
+    await scheduler.run()
+
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert gaps == pytest.approx([0.05] * 3, abs=0.02)
+    assert limiter.deferred == 3
+    # the deferral counts in the lag, and the next checks stay on the original phase
+    assert scheduler.stats.max_lag == pytest.approx(0.15, abs=0.03)
+    assert sorted(deadline for deadline, *_ in scheduler._heap) == pytest.approx([now + 5] * 4)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.instrumentation import RuntimeStats, STAGES
+from worker.metrics_buffer import MetricsBuffer
+from worker import metrics_handler
+from worker.metrics_handler import MetricsHandler
+from worker.metrics_server import render_runtime
+from worker.stat_batch import StatBatch
+from endpoint import Endpoint
+
+def test_stage_percentiles_and_gauges():
+    runtime = RuntimeStats()
+    for _ in range(99):
+        runtime.record("http", 0.01)
+    runtime.record("http", 2.0)
+    runtime.gauge("checks_in_flight", lambda: 3)
+
+    stats = runtime.as_dict()
+
+    assert stats["http"]["count"] == 100
+    assert stats["http"]["p50"] == pytest.approx(0.01, rel=0.04)
+    assert stats["http"]["p99"] == pytest.approx(0.01, rel=0.04)
+    assert stats["flush"] == {"count": 0, "p50": None, "p99": None}
+    assert stats["checks_in_flight"] == 3
+    assert set(STAGES) <= set(stats)
+
+@pytest.mark.asyncio
+async def test_loop_lag_of_a_blocking_callback():
+    runtime = RuntimeStats()
+    monitor = asyncio.create_task(runtime.monitor_loop_lag(0.01))
+    await asyncio.sleep(0.02)
+    # Holds the event loop, like a runaway regex would
+    time.sleep(0.1)
+    await asyncio.sleep(0.02)
+    monitor.cancel()
+
+    assert runtime.max_loop_lag >= 0.05
+    assert runtime.loop_lag.durations >= 2
+
+def test_render_runtime():
+    runtime = RuntimeStats()
+    runtime.record("start_delay", 0.002, window=1)
+    runtime.gauge("regex_inline_cpu_seconds_total", lambda: 1.5, "counter")
+
+    text = render_runtime(runtime, 1)
+
+    assert 'watcher_check_stage_seconds_count{stage="start_delay"} 1' in text
+    assert "# TYPE watcher_regex_inline_cpu_seconds_total counter\nwatcher_regex_inline_cpu_seconds_total 1.5" in text
+    assert 'watcher_event_loop_lag_seconds{quantile="0.5"} NaN' in text
+
+@pytest.mark.asyncio
+async def test_handler_records_handoff_and_flush(monkeypatch):
+    runtime = RuntimeStats()
+    monkeypatch.setattr(metrics_handler, "runtime_stats", runtime)
+    batch = StatBatch(2)
+    endpoint = Endpoint(1, "http://testserver:8001", None, 5)
+    batch.append(endpoint, time.time() - 2.0, 200, 0.5, None)
+    batch.append(endpoint, time.time(), 0, None, None)
+
+    await MetricsHandler(MetricsBuffer())._process([batch])
+
+    handoff = runtime.stages["handoff"]
+    assert handoff.durations == 2
+    # The first check ended 1.5s ago
+    assert 1.4 < handoff.duration_sum < 1.6
+    assert runtime.stages["flush"].durations == 1
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import random
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.latency_sketch import (EndpointSketches, LatencySketch, WindowedSketch, SKETCH_BUCKETS,
+                                   bucket_bounds, bucket_index, merged, quantiles)
+from worker.stat_batch import StatBatch
+from endpoint import Endpoint
+
+def test_every_duration_falls_within_its_bucket():
+    for duration in (0.0, 0.00005, 0.0016, 0.0123, 0.25, 1.0, 29.9):
+        lower, upper = bucket_bounds(bucket_index(duration))
+        assert lower <= duration < upper
+        # Buckets are at most 1/16 of their lower bound wide, beyond the linear ones
+        assert upper - lower <= max(lower / 16, 1e-4) + 1e-12
+
+def test_durations_beyond_the_range_go_to_the_last_bucket():
+    assert bucket_index(3600) == SKETCH_BUCKETS - 1
+    assert bucket_index(-1) == 0
+
+def test_quantiles_are_within_the_relative_error():
+    rng = random.Random(42)
+    durations = sorted(rng.lognormvariate(-3, 1) for _ in range(10000))
+    sketch = LatencySketch("I")
+    for duration in durations:
+        sketch.record(duration)
+
+    for fraction, estimate in zip((0.5, 0.95, 0.99), quantiles([sketch], (0.5, 0.95, 0.99))):
+        assert estimate == pytest.approx(durations[int(fraction * len(durations))], rel=0.04)
+    assert quantiles([LatencySketch()], (0.5,)) == [None]
+
+def test_merged_sketches_equal_one_sketch_of_every_duration():
+    first, second, both = LatencySketch(), LatencySketch(), LatencySketch()
+    for i in range(100):
+        (first if i % 2 else second).record(i / 100)
+        both.record(i / 100)
+
+    assert list(merged([first, second]).counts) == list(both.counts)
+    assert quantiles([first, second], (0.5, 0.99)) == quantiles([both], (0.5, 0.99))
+
+def test_full_bucket_saturates():
+    sketch = LatencySketch()
+    sketch.counts[bucket_index(0.1)] = 65535
+    sketch.record(0.1)
+
+    assert sketch.counts[bucket_index(0.1)] == 65535
+
+def test_durations_recorded_at_once_equal_those_recorded_one_by_one():
+    durations = [i / 1000 for i in range(500)] * 3
+    one_by_one, at_once = WindowedSketch(), WindowedSketch()
+    for duration in durations:
+        one_by_one.record(duration, 0)
+    at_once.record_many(durations, 0)
+
+    assert list(at_once.current.counts) == list(one_by_one.current.counts)
+    assert (at_once.current.low, at_once.current.high) == (one_by_one.current.low, one_by_one.current.high)
+    assert at_once.durations == len(durations)
+
+    at_once.current.counts[0] = 65534
+    at_once.record_many([0.0, 0.0], 0)
+    assert at_once.current.counts[0] == 65535
+
+def test_percentiles_cover_the_last_two_windows():
+    sketches = EndpointSketches()
+    sketches.record(1, 200, 0.1, window=10)
+    sketches.record(1, 200, 0.2, window=11)
+    sketch = sketches.endpoints[1]
+
+    assert sum(part.count for part in sketch.recent(11)) == 2
+    assert sum(part.count for part in sketch.recent(12)) == 1
+    assert not sketch.recent(13)
+
+    sketches.record(1, 200, 0.3, window=13)
+    assert sum(part.count for part in sketch.recent(13)) == 1
+    # Counters are not windowed
+    assert sketch.durations == 3
+
+def test_status_classes_are_counted():
+    sketches = EndpointSketches()
+    for status_code in (200, 204, 301, 404, 503, 0, 999):
+        sketches.record(1, status_code, 0.1, window=0)
+
+    assert list(sketches.endpoints[1].statuses) == [2, 0, 2, 1, 1, 1]
+    # Checks without a response have no duration
+    assert sketches.endpoints[1].durations == 6
+    assert list(sketches.total.statuses) == [2, 0, 2, 1, 1, 1]
+
+def test_batches_are_recorded_and_removed_endpoints_dropped():
+    batch = StatBatch(3)
+    batch.append(Endpoint(1, "http://testserver:8001/1", None, 5), 0.0, 200, 0.1, None)
+    batch.append(Endpoint(2, "http://testserver:8001/2", None, 5), 0.0, 500, None, None)
+    batch.append(Endpoint(3, "http://testserver:8001/3", None, 5), 0.0, 200, 0.3, None)
+    sketches = EndpointSketches()
+
+    sketches.record_batch(batch)
+    sketches.retain({1, 2})
+
+    assert set(sketches.endpoints) == {1, 2}
+    # An unknown duration is not recorded
+    assert sketches.endpoints[2].durations == 0
+    assert sketches.total.durations == 2
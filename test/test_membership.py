@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.membership import Membership, owner, owned
+from worker.scheduler import Scheduler
+from endpoint import Endpoint
+
+def test_only_one_nth_of_endpoints_move_when_a_worker_joins():
+    endpoint_ids = range(1, 10001)
+    workers = [f"pod-{i}" for i in range(4)]
+    before = {endpoint_id: owner(endpoint_id, workers) for endpoint_id in endpoint_ids}
+    after = {endpoint_id: owner(endpoint_id, workers + ["pod-4"]) for endpoint_id in endpoint_ids}
+
+    moved = [endpoint_id for endpoint_id in endpoint_ids if before[endpoint_id] != after[endpoint_id]]
+
+    # 1/5 of the endpoints, all of them to the new worker
+    assert 0.17 < len(moved) / len(endpoint_ids) < 0.23
+    assert all(after[endpoint_id] == "pod-4" for endpoint_id in moved)
+
+def test_every_endpoint_has_exactly_one_owner():
+    endpoints = [Endpoint(i, f"http://testserver:8001/{i}", None, 5) for i in range(1, 1001)]
+    workers = ["pod-a", "pod-b", "pod-c"]
+
+    shares = [owned(endpoints, workers, worker_id) for worker_id in workers]
+
+    assert sum(len(share) for share in shares) == len(endpoints)
+    assert {e.endpoint_id for share in shares for e in share} == {e.endpoint_id for e in endpoints}
+
+@pytest.mark.asyncio
+async def test_rebalance_moves_only_gained_and_lost_endpoints():
+    endpoints = [Endpoint(i, f"http://testserver:8001/{i}", None, 5) for i in range(1, 201)]
+    manager = MagicMock()
+    manager.renew_lease.return_value = ["pod-a"]
+    manager.fetch_all_endpoints.return_value = endpoints
+    membership = Membership(manager, "pod-a")
+    scheduler = Scheduler(check=None)
+
+    for endpoint in await membership.join():
+        scheduler.add(endpoint)
+    assert len(scheduler) == 200
+    kept = {e.endpoint_id for e in owned(endpoints, ["pod-a", "pod-b"], "pod-a")}
+    entries = {endpoint_id: scheduler._entries[endpoint_id] for endpoint_id in kept}
+
+    # pod-b joins
+    membership.workers = ["pod-a", "pod-b"]
+    await membership.rebalance(scheduler)
+
+    assert scheduler.endpoint_ids() == kept
+    # Endpoints kept are not rescheduled
+    assert all(scheduler._entries[endpoint_id] is entry for endpoint_id, entry in entries.items())
+
+@pytest.mark.asyncio
+async def test_blocking_manager_is_queried_off_the_event_loop():
+    threads = []
+    manager = MagicMock()
+    manager.renew_lease.side_effect = lambda *_: threads.append(threading.current_thread()) or ["pod-a"]
+    manager.fetch_all_endpoints.side_effect = lambda: threads.append(threading.current_thread()) or []
+
+    await Membership(manager, "pod-a").join()
+
+    assert len(threads) == 2 and threading.current_thread() not in threads
@@ -6,7 +6,6 @@ import sys
 import time
 from pathlib import Path
 import pytest
-from unittest.mock import MagicMock
 
 # To import the src code, we need to add the src directory to the path
 src_directory = Path(__file__).resolve().parent.parent / "src"
@@ -14,19 +13,8 @@ sys.path.append(str(src_directory))
 from worker.metrics import Stat
 from endpoint import Endpoint
 
-class aiohttp_response:
-    def __init__(self, status=200, resp_data=None):
-        self.status = status
-        self.resp_data = resp_data
-        self.elapsed = MagicMock()
-        self.elapsed.total_seconds = lambda: 0.1
-
-    async def text(self):
-        return self.resp_data
-
-
 @pytest.mark.asyncio
-async def test_build_from_successful_http_req_match_with_simple_regex():
+async def test_build_from_successful_http_req_match_with_simple_regex(aiohttp_response):
     endpoint_with_simple_regex = Endpoint(1, "http://testserver:8001", ".*welcome", 5)
     stat = Stat(endpoint_with_simple_regex, time.time()-1)
     resp = aiohttp_response(200, "You are always welcome!")
@@ -39,7 +27,7 @@ async def test_build_from_successful_http_req_match_with_simple_regex():
 endpoint = Endpoint(1, "http://testserver:8001", r"you.*welcome at\s[0-9]{2}:[0-9]{2}$", 5)
 
 @pytest.mark.asyncio
-async def test_build_from_successful_http_req_match():
+async def test_build_from_successful_http_req_match(aiohttp_response):
     stat = Stat(endpoint, time.time()-1)
     resp = aiohttp_response(200, "you are welcome at 12:00")
 
@@ -49,7 +37,7 @@ async def test_build_from_successful_http_req_match():
     assert stat.regex_match is True
 
 @pytest.mark.asyncio
-async def test_build_from_successful_http_req_not_match():
+async def test_build_from_successful_http_req_not_match(aiohttp_response):
     stat = Stat(endpoint, time.time()-1)
     resp = aiohttp_response(200, "Hello World")
 
@@ -59,7 +47,7 @@ async def test_build_from_successful_http_req_not_match():
     assert stat.regex_match is False
 
 @pytest.mark.asyncio
-async def test_build_from_successful_http_req_200():
+async def test_build_from_successful_http_req_200(aiohttp_response):
     stat = Stat(endpoint, time.time()-1)
     resp = aiohttp_response(500, "you are welcome at 12:00")
 
@@ -74,3 +62,30 @@ def test_build_from_failed_http_req():
     assert stat.duration > 0
     assert stat.status_code == 0
     assert stat.regex_match is False
+
+@pytest.mark.asyncio
+async def test_build_from_successful_http_req_stops_at_byte_cap(aiohttp_response):
+    capped_endpoint = Endpoint(1, "http://testserver:8001", "welcome", 5, max_body_bytes=8)
+    stat = Stat(capped_endpoint, time.time()-1)
+    resp = aiohttp_response(200, "You are always welcome!")
+
+    await stat.build_from_successful_http_req(resp)
+    assert stat.regex_match is False
+    assert stat.truncated is True
+    assert stat.bytes_read == 8
+    assert resp.content.bytes_served < len(resp.resp_data)
+
+@pytest.mark.asyncio
+async def test_endpoint_without_regex_has_no_regex_match(aiohttp_response):
+    endpoint_without_regex = Endpoint(1, "http://testserver:8001", None, 5)
+    stat = Stat(endpoint_without_regex, time.time()-1)
+    resp = aiohttp_response(200, "You are always welcome!")
+
+    await stat.build_from_successful_http_req(resp)
+    # stored as NULL, so the check counts as up
+    assert stat.regex_match is None
+    assert resp.content.bytes_served == 0
+
+    stat = Stat(endpoint_without_regex, time.time()-1)
+    stat.build_from_failed_http_req()
+    assert stat.regex_match is None
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.metrics_buffer import MetricsBuffer
+from worker.spool import Spool
+
+@pytest.mark.asyncio
+async def test_drain_returns_once_enough_rows_are_buffered(create_batch):
+    buffer = MetricsBuffer(maxsize=10)
+    drain = asyncio.create_task(buffer.drain(3, timeout=10))
+
+    await buffer.put(create_batch(2))
+    await asyncio.sleep(0)
+    assert not drain.done()
+    await buffer.put(create_batch(2))
+    batches = await asyncio.wait_for(drain, 1)
+
+    assert [len(batch) for batch in batches] == [2, 2]
+    assert buffer.rows() == 0
+
+@pytest.mark.asyncio
+async def test_drain_returns_partial_batches_on_timeout(create_batch):
+    buffer = MetricsBuffer(maxsize=10)
+    await buffer.put(create_batch(1))
+
+    started = time.monotonic()
+    batches = await buffer.drain(1000, timeout=0.05)
+
+    assert len(batches) == 1
+    assert time.monotonic() - started < 1
+
+@pytest.mark.asyncio
+async def test_block_policy_waits_for_room(create_batch):
+    buffer = MetricsBuffer(maxsize=1, overflow="block")
+    await buffer.put(create_batch())
+    put = asyncio.create_task(buffer.put(create_batch(status_code=500)))
+    await asyncio.sleep(0)
+    assert not put.done()
+
+    await buffer.drain(0, 0)
+    await asyncio.wait_for(put, 1)
+
+    assert buffer.qsize() == 1
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy(create_batch):
+    buffer = MetricsBuffer(maxsize=2, overflow="drop-oldest")
+    for status_code in (200, 404, 500):
+        await buffer.put(create_batch(status_code=status_code))
+
+    batches = await buffer.drain(0, 0)
+
+    assert [batch.status_code[0] for batch in batches] == [404, 500]
+    assert buffer.stats()["dropped_rows"] == 1
+
+@pytest.mark.asyncio
+async def test_spill_policy_appends_to_the_spool(tmp_path, create_batch):
+    spool = Spool(str(tmp_path), segment_bytes=4096)
+    buffer = MetricsBuffer(maxsize=1, overflow="spill", spool=spool)
+    for status_code in (200, 404, 500):
+        await buffer.put(create_batch(status_code=status_code))
+
+    assert [batch.status_code[0] for batch in await buffer.drain(0, 0)] == [200]
+    assert buffer.stats()["spilled_rows"] == 2
+    spilled, _ = spool.read(10)
+    assert list(spilled.status_code[:len(spilled)]) == [404, 500]
+    spool.close()
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        MetricsBuffer(overflow="ignore")
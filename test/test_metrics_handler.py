@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.metrics_handler import MetricsHandler
+from worker.metrics_buffer import MetricsBuffer
+from worker.spool import Spool
+
+@pytest.mark.asyncio
+async def test_run_stores_drained_batches(create_batch):
+    buffer = MetricsBuffer(maxsize=10)
+    store = MagicMock(add=AsyncMock(), flush=AsyncMock(), flush_if_due=AsyncMock())
+    exporter = MagicMock(start=AsyncMock(), submit=AsyncMock(), close=AsyncMock())
+    handler = MetricsHandler(buffer, store, exporter, batch_rows=3, batch_timeout_ms=100)
+    task = asyncio.create_task(handler.run())
+
+    await buffer.put(create_batch(2))
+    await buffer.put(create_batch(1))
+    for _ in range(100):
+        if handler.stats.drains:
+            break
+        await asyncio.sleep(0.01)
+    handler.stop()
+    await asyncio.wait_for(task, 1)
+
+    assert store.add.call_count == 2
+    assert handler.stats.rows == 3
+    assert handler.stats.max_drain_rows == 3
+    store.flush.assert_called_once()
+    exporter.submit.assert_called_once()
+    exporter.close.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_run_replays_the_spool(tmp_path, monkeypatch, create_batch):
+    monkeypatch.setattr("worker.metrics_handler.METRICS_REPLAY_INTERVAL", 0.01)
+    spool = Spool(str(tmp_path))
+    spool.append([create_batch(3)])
+    store = MagicMock(replay=AsyncMock(side_effect=[Exception("DB is down"), 3]),
+                      flush=AsyncMock(), flush_if_due=AsyncMock())
+    handler = MetricsHandler(MetricsBuffer(), store, batch_timeout_ms=10, spool=spool)
+    task = asyncio.create_task(handler.run())
+
+    for _ in range(100):
+        if not len(spool):
+            break
+        await asyncio.sleep(0.01)
+    handler.stop()
+    await asyncio.wait_for(task, 1)
+
+    assert store.replay.call_count == 2
+    assert len(spool) == 0
+    spool.close()
+
+@pytest.mark.asyncio
+async def test_run_exports_the_rows_the_buffer_spilled(tmp_path, monkeypatch, create_batch):
+    monkeypatch.setattr("worker.metrics_handler.METRICS_REPLAY_INTERVAL", 0.01)
+    spool, overflow = Spool(str(tmp_path / "store")), Spool(str(tmp_path / "overflow"))
+    spool.append([create_batch(2)])
+    overflow.append([create_batch(3)])
+    store = MagicMock(replay=AsyncMock(return_value=3), flush=AsyncMock(), flush_if_due=AsyncMock())
+    exporter = MagicMock(start=AsyncMock(), submit=AsyncMock(), close=AsyncMock())
+    handler = MetricsHandler(MetricsBuffer(spool=overflow), store, exporter, batch_timeout_ms=10, spool=spool)
+    task = asyncio.create_task(handler.run())
+
+    for _ in range(100):
+        if not len(spool) and not len(overflow):
+            break
+        await asyncio.sleep(0.01)
+    handler.stop()
+    await asyncio.wait_for(task, 1)
+
+    assert store.replay.call_count == 2
+    # Rows of a failed flush were sent when drained, only the spilled ones are sent on replay
+    exporter.submit.assert_called_once()
+    assert len(exporter.submit.call_args.args[0][0]) == 3
+    spool.close()
+    overflow.close()
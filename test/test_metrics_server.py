@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import socket
+import sys
+from pathlib import Path
+import aiohttp
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.latency_sketch import EndpointSketches
+from worker.metrics_server import MetricsServer, metrics_port, render
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_supervised_processes_listen_on_their_own_port():
+    assert metrics_port(5, None, base=9100) == 9100
+    assert metrics_port(5, 4, base=9100) == 9101
+    assert metrics_port(5, 4, base=0) == 0
+
+def test_render_prometheus_text():
+    sketches = EndpointSketches()
+    sketches.record(7, 200, 0.05, window=1)
+    sketches.record(7, 503, 0.05, window=1)
+
+    text = render(sketches.total, sketches.snapshot(), 1)
+
+    assert '# TYPE watcher_endpoint_check_duration_seconds summary' in text
+    assert 'watcher_endpoint_check_duration_seconds{endpoint_id="7",quantile="0.99"} 0.0504' in text
+    assert 'watcher_endpoint_check_duration_seconds_count{endpoint_id="7"} 2' in text
+    assert 'watcher_endpoint_checks_total{endpoint_id="7",status="5xx"} 1' in text
+    assert 'watcher_checks_total{status="2xx"} 1' in text
+    # Percentiles of an endpoint without recent checks are unknown
+    assert 'watcher_check_duration_seconds{quantile="0.5"} NaN' in render(sketches.total, [], 5)
+
+@pytest.mark.asyncio
+async def test_metrics_are_served():
+    sketches = EndpointSketches()
+    sketches.record(1, 200, 0.1)
+    sketches.record(2, 200, 0.1)
+    server = MetricsServer(sketches, lambda: {1}, port=free_port(), host="127.0.0.1")
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{server.port}/metrics") as response:
+                text = await response.text()
+                assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    finally:
+        await server.close()
+
+    assert 'endpoint_id="1"' in text
+    # Endpoints no longer checked are dropped
+    assert 'endpoint_id="2"' not in text
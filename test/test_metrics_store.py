@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import struct
+import sys
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker import metrics_store
+from worker.metrics_store import MetricsStore, to_copy_binary
+from src.async_endpoint_manager import AsyncEndpointManager
+from worker.stat_batch import StatBatch
+from endpoint import Endpoint
+
+endpoint = Endpoint(7, "http://testserver:8001", ".*welcome", 5)
+
+@pytest.fixture
+def create_batch(create_batch):
+    """Batches of checks of the endpoint, at a timestamp whose microseconds are exact."""
+    return lambda size=1, **columns: create_batch(size, endpoint, timestamp=946684800.25, **columns)
+
+def decode_copy_binary(payload):
+    """Decode the binary COPY payload into rows of raw field values, None for NULL."""
+    assert payload.startswith(b"PGCOPY\n\xff\r\n\x00")
+    assert payload.endswith(struct.pack("!h", -1))
+    offset, rows = 19, []
+    while True:
+        (field_count,) = struct.unpack_from("!h", payload, offset)
+        offset += 2
+        if field_count == -1:
+            return rows
+        row = []
+        for _ in range(field_count):
+            (length,) = struct.unpack_from("!i", payload, offset)
+            offset += 4
+            row.append(None if length == -1 else payload[offset:offset + length])
+            offset += max(length, 0)
+        rows.append(row)
+
+def test_to_copy_binary():
+    batch = StatBatch(2)
+    batch.append(endpoint, 946684800.25, 200, 0.5, True)
+    batch.append(endpoint, 946684800.25, 0, None, None, phases=(1200, 800, 0, -1, -1), late=True)
+
+    rows = decode_copy_binary(to_copy_binary([batch]))
+
+    assert rows[0] == [
+        struct.pack("!q", 250000), struct.pack("!i", 7), struct.pack("!h", 200),
+        struct.pack("!d", 0.5), b"\x01", struct.pack("!i", 0), b"\x00", b"\x00",
+        None, None, None, None, None, b"\x00",
+    ]
+    # Unknown duration, regex match and phases are NULL
+    assert rows[1][3] is None
+    assert rows[1][4] is None
+    assert rows[1][8:] == [struct.pack("!i", 1200), struct.pack("!i", 800), struct.pack("!i", 0), None, None, b"\x01"]
+
+def create_mocked_manager():
+    """Create a mocked EndpointManager whose COPY payloads are recorded."""
+    copied = []
+    cursor = MagicMock()
+    cursor.copy_expert.side_effect = lambda sql, buffer: copied.append((sql, buffer.read()))
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = conn
+    return manager, conn, copied
+
+@pytest.mark.asyncio
+async def test_flush_on_batch_size(create_batch):
+    manager, conn, copied = create_mocked_manager()
+    store = MetricsStore(manager, flush_size=2, flush_interval=3600)
+
+    await store.add(create_batch())
+    assert not copied
+    await store.add(create_batch(status_code=0, duration=None, regex_match=False))
+
+    assert len(copied) == 1
+    sql, payload = copied[0]
+    assert sql == "COPY metrics (time, endpoint_id, status_code, duration, regex_match, bytes_read, truncated, regex_timed_out, dns_us, connect_us, tls_us, ttfb_us, transfer_us, late) FROM STDIN WITH (FORMAT binary)"
+    rows = decode_copy_binary(payload)
+    assert [row[2] for row in rows] == [struct.pack("!h", 200), struct.pack("!h", 0)]
+    conn.commit.assert_called_once()
+    manager.release_connection.assert_called_once_with(conn)
+    assert store.rows_written == 2
+    assert len(store) == 0
+
+@pytest.mark.asyncio
+async def test_rows_are_encoded_off_the_event_loop(monkeypatch, create_batch):
+    encoded_in = []
+    def encode(batches):
+        encoded_in.append(threading.current_thread())
+        return to_copy_binary(batches)
+    monkeypatch.setattr(metrics_store, "to_copy_binary", encode)
+    manager = MagicMock(spec=AsyncEndpointManager, copy_metrics=AsyncMock(), replay_metrics=AsyncMock(return_value=1))
+    store = MetricsStore(manager, flush_size=1, flush_interval=3600)
+
+    await store.add(create_batch())
+    await store.replay(create_batch())
+
+    assert manager.copy_metrics.await_count == 1
+    assert manager.replay_metrics.await_count == 1
+    assert len(encoded_in) == 2
+    assert threading.main_thread() not in encoded_in
+
+@pytest.mark.asyncio
+async def test_flush_on_time_budget(create_batch):
+    manager, _, copied = create_mocked_manager()
+    store = MetricsStore(manager, flush_size=1000, flush_interval=0)
+
+    await store.add(create_batch())
+
+    assert len(copied) == 1
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_rows_within_limit(create_batch):
+    manager, conn, _ = create_mocked_manager()
+    conn.cursor.return_value.__enter__.return_value.copy_expert.side_effect = Exception("DB is down")
+    store = MetricsStore(manager, flush_size=2, flush_interval=3600, max_pending=3)
+
+    await store.add(create_batch(2))
+    assert len(store) == 2
+    conn.rollback.assert_called_once()
+
+    # Whole batches are dropped, oldest first
+    await store.add(create_batch(2, status_code=500))
+    assert len(store) == 2
+    assert store._pending[0].status_code[0] == 500
+    assert store.rows_written == 0
+
+@pytest.mark.asyncio
+async def test_failed_flush_appends_to_the_spool(create_batch):
+    manager, conn, _ = create_mocked_manager()
+    conn.cursor.return_value.__enter__.return_value.copy_expert.side_effect = Exception("DB is down")
+    spool = MagicMock()
+    store = MetricsStore(manager, flush_size=2, flush_interval=3600, spool=spool)
+
+    batch = create_batch(2)
+    await store.add(batch)
+
+    spool.append.assert_called_once_with([batch])
+    assert len(store) == 0
+
+@pytest.mark.asyncio
+async def test_replay_skips_stored_rows(create_batch):
+    manager, conn, copied = create_mocked_manager()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.rowcount = 1
+    store = MetricsStore(manager)
+
+    inserted = await store.replay(create_batch(2))
+
+    assert inserted == 1
+    sql, _ = copied[0]
+    assert sql.startswith("COPY metrics_replay (time, endpoint_id")
+    insert = cursor.execute.call_args.args[0]
+    assert "WHERE m.endpoint_id = r.endpoint_id AND m.time = r.time" in insert
+    conn.commit.assert_called_once()
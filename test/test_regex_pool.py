@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.regex_pool import RegexEvaluator, RegexTimeout, backtracking_risk
+from endpoint import Endpoint
+
+endpoint = Endpoint(1, "http://testserver:8001", "welcome", 5)
+# Catastrophic backtracking: the runtime doubles with every extra "a"
+pathological_endpoint = Endpoint(2, "http://testserver:8001", r"(a+)+$", 5)
+
+@pytest.mark.asyncio
+async def test_small_texts_are_matched_inline():
+    evaluator = RegexEvaluator(mode="process", offload_threshold=100)
+    assert await evaluator.search_end(endpoint, "You are welcome") == 15
+    assert evaluator.stats() == {"inline": 1, "offloaded": 0, "timed_out": 0, "crashed": 0}
+    evaluator.close()
+
+@pytest.mark.asyncio
+async def test_large_texts_are_offloaded():
+    evaluator = RegexEvaluator(mode="process", offload_threshold=10, pool_size=1)
+    try:
+        assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+        assert await evaluator.search_end(endpoint, "x" * 20) is None
+    finally:
+        evaluator.close()
+    assert evaluator.stats() == {"inline": 0, "offloaded": 2, "timed_out": 0, "crashed": 0}
+
+def test_backtracking_risk():
+    for risky in (r"(a+)+$", r"(?:\w+\s?)*x", r"(a|aa)+", r"((ab)*c)+", r"(\d+)-\1"):
+        assert backtracking_risk(risky), risky
+    for safe in ("welcome", r"you.*welcome at\s[0-9]{2}:[0-9]{2}$", r"(ab)+", r"[(]a+[)]+", r"(a+)?b"):
+        assert not backtracking_risk(safe), safe
+
+@pytest.mark.asyncio
+async def test_risky_patterns_are_offloaded_whatever_the_text():
+    evaluator = RegexEvaluator(mode="process", offload_threshold=1000, pool_size=1)
+    try:
+        assert await evaluator.search_end(pathological_endpoint, "aaa") == 3
+        assert await evaluator.search_end(endpoint, "You are welcome") == 15
+    finally:
+        evaluator.close()
+    assert evaluator.stats() == {"inline": 1, "offloaded": 1, "timed_out": 0, "crashed": 0}
+
+@pytest.mark.asyncio
+async def test_runaway_pattern_is_cancelled():
+    evaluator = RegexEvaluator(mode="process", offload_threshold=10, pool_size=1, time_budget=0.5)
+    try:
+        with pytest.raises(RegexTimeout):
+            await evaluator.search_end(pathological_endpoint, "a" * 40 + "b")
+        # the killed matcher process is replaced
+        assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+    finally:
+        evaluator.close()
+    assert evaluator.stats() == {"inline": 0, "offloaded": 2, "timed_out": 1, "crashed": 0}
+
+@pytest.mark.asyncio
+async def test_dead_matcher_process_is_replaced():
+    evaluator = RegexEvaluator(mode="process", offload_threshold=10, pool_size=1)
+    try:
+        assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+        evaluator._processes[0].process.kill()
+        # the pattern is safe, so the match falls back inline
+        assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+        evaluator._processes[0].process.kill()
+        # a risky pattern isn't matched on the event loop, it is flagged as not evaluated
+        with pytest.raises(RegexTimeout):
+            await evaluator.search_end(pathological_endpoint, "a" * 20 + "b")
+        assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+    finally:
+        evaluator.close()
+    assert evaluator.stats() == {"inline": 1, "offloaded": 4, "timed_out": 0, "crashed": 2}
+
+@pytest.mark.asyncio
+async def test_inline_mode_never_offloads():
+    evaluator = RegexEvaluator(mode="inline", offload_threshold=10)
+    assert await evaluator.search_end(endpoint, "x" * 20 + "welcome") == 27
+    assert evaluator.stats()["offloaded"] == 0
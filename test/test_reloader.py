@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.reloader import EndpointReloader, partition_owner
+from worker.scheduler import Scheduler
+from endpoint import Endpoint
+
+def create_endpoint(endpoint_id, interval=5, url=None):
+    return Endpoint(endpoint_id, url or f"http://testserver:8001/{endpoint_id}", None, interval)
+
+def create_manager(changes, version=0):
+    """A manager serving a fixed change log."""
+    manager = MagicMock(spec=["latest_change_version", "fetch_endpoint_changes"])
+    manager.latest_change_version.return_value = version
+    manager.fetch_endpoint_changes.side_effect = \
+        lambda after, limit: [change for change in changes if change[0] > after][:limit]
+    return manager
+
+@pytest.mark.asyncio
+async def test_changes_are_applied_as_diffs():
+    scheduler = Scheduler(check=None)
+    for endpoint_id in (1, 2, 3):
+        scheduler.add(create_endpoint(endpoint_id))
+    untouched = scheduler._entries[1]
+    renamed = scheduler._entries[2]
+    changes = [
+        (11, 2, create_endpoint(2, url="http://testserver:8001/renamed")),
+        (12, 3, None),
+        (13, 4, create_endpoint(4)),
+    ]
+    reloader = await EndpointReloader(create_manager(changes, version=10), lambda _: True).start()
+
+    assert await reloader.reload(scheduler) == 3
+
+    assert scheduler.endpoint_ids() == {1, 2, 4}
+    assert scheduler._entries[1] is untouched
+    # Same interval: the deadline is kept, only the endpoint is swapped
+    assert scheduler._entries[2] is renamed
+    assert renamed.endpoint.url == "http://testserver:8001/renamed"
+    assert reloader.version == 13
+
+@pytest.mark.asyncio
+async def test_interval_change_reschedules():
+    scheduler = Scheduler(check=None)
+    scheduler.add(create_endpoint(1))
+    entry = scheduler._entries[1]
+    reloader = EndpointReloader(create_manager([(1, 1, create_endpoint(1, interval=60))]), lambda _: True)
+
+    await reloader.reload(scheduler)
+
+    assert entry.cancelled
+    assert scheduler._entries[1].endpoint.interval == 60
+
+@pytest.mark.asyncio
+async def test_endpoints_of_other_partitions_are_skipped():
+    scheduler = Scheduler(check=None)
+    changes = [(1, 1, create_endpoint(1)), (2, 2, create_endpoint(2))]
+    reloader = EndpointReloader(create_manager(changes), partition_owner(2, 0))
+
+    await reloader.reload(scheduler)
+
+    assert scheduler.endpoint_ids() == {2}
+
+@pytest.mark.asyncio
+async def test_latest_change_of_an_endpoint_wins():
+    scheduler = Scheduler(check=None)
+    changes = [(1, 1, create_endpoint(1)), (2, 1, None), (3, 2, create_endpoint(2))]
+    reloader = EndpointReloader(create_manager(changes), lambda _: True, batch=2)
+
+    await reloader.reload(scheduler)
+
+    assert scheduler.endpoint_ids() == {2}
+    assert reloader.version == 3
+
+@pytest.mark.asyncio
+async def test_cursor_waits_for_a_missing_version():
+    scheduler = Scheduler(check=None)
+    changes = [(1, 1, create_endpoint(1)), (3, 3, create_endpoint(3))]
+    reloader = EndpointReloader(create_manager(changes), lambda _: True, gap_timeout=3600)
+
+    await reloader.reload(scheduler)
+    assert reloader.version == 1
+
+    # Version 2 commits late, version 3 is not applied twice
+    scheduler.remove(3)
+    changes.insert(1, (2, 2, create_endpoint(2)))
+    await reloader.reload(scheduler)
+
+    assert reloader.version == 3
+    assert scheduler.endpoint_ids() == {1, 2}
+
+@pytest.mark.asyncio
+async def test_cursor_skips_a_version_missing_too_long():
+    changes = [(1, 1, create_endpoint(1)), (3, 3, create_endpoint(3))]
+    reloader = EndpointReloader(create_manager(changes), lambda _: True, gap_timeout=0)
+
+    await reloader.reload(Scheduler(check=None))
+    await reloader.reload(Scheduler(check=None))
+
+    assert reloader.version == 3
+
+@pytest.mark.asyncio
+async def test_blocking_manager_is_queried_off_the_event_loop():
+    threads = set()
+    manager = create_manager([(1, 1, create_endpoint(1))])
+    fetch = manager.fetch_endpoint_changes.side_effect
+    manager.fetch_endpoint_changes.side_effect = \
+        lambda *args: threads.add(threading.current_thread()) or fetch(*args)
+    reloader = await EndpointReloader(manager, lambda _: True).start()
+
+    await reloader.reload(Scheduler(check=None))
+
+    assert threads and threading.current_thread() not in threads
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+import asyncio
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.scheduler import Scheduler, check_start_delay
+from endpoint import Endpoint
+
+def now():
+    return asyncio.get_running_loop().time()
+
+@pytest.mark.asyncio
+async def test_deadlines_are_fixed_rate():
+    """A slow check must not shift the deadline of the next one."""
+    starts = []
+    scheduler = None
+
+    async def slow_check(_):
+        starts.append(now())
+        if len(starts) == 3:
+            scheduler.stop()
+        await asyncio.sleep(0.03)
+
+    scheduler = Scheduler(slow_check, tick=0.01)
+    endpoint = Endpoint(1, "http://testserver:8001", None, 5)
+    endpoint.interval = 0.05  # bypass validation to keep the test fast
+    scheduler.add(endpoint, first_deadline=now())
+    await scheduler.run()
+
+    assert len(starts) == 3
+    assert starts[2] - starts[0] == pytest.approx(0.1, abs=0.03)
+
+@pytest.mark.asyncio
+async def test_in_flight_checks_are_bounded():
+    running = 0
+    peak = 0
+    done = 0
+    scheduler = None
+
+    async def check(_):
+        nonlocal running, peak, done
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        done += 1
+        if done == 10:
+            scheduler.stop()
+
+    scheduler = Scheduler(check, max_in_flight=2, tick=0.01)
+    for i in range(1, 11):
+        scheduler.add(Endpoint(i, f"http://testserver:8001/{i}", None, 300), first_deadline=now())
+    await scheduler.run()
+
+    assert peak == 2
+    assert done == 10
+    # checks waiting for a free slot are reported as lag
+    assert scheduler.stats.max_lag >= 0.03
+    assert scheduler.stats.deferred > 0
+    assert scheduler.saturated
+
+@pytest.mark.asyncio
+async def test_resized_limit_and_late_checks():
+    running = 0
+    peak = 0
+    delays = []
+    scheduler = None
+
+    async def check(_):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        delays.append(check_start_delay.get())
+        await asyncio.sleep(0.02)
+        running -= 1
+        if len(delays) == 6:
+            scheduler.stop()
+
+    scheduler = Scheduler(check, max_in_flight=1, tick=0.01, late_after=0.015)
+    for i in range(1, 7):
+        scheduler.add(Endpoint(i, f"http://testserver:8001/{i}", None, 300), first_deadline=now())
+    asyncio.get_running_loop().call_later(0.01, scheduler.resize, 3)
+    await scheduler.run()
+
+    assert peak == 3
+    # each check reads the delay of its own start
+    assert delays == sorted(delays)
+    assert scheduler.stats.late == sum(delay > 0.015 for delay in delays) > 0
+
+@pytest.mark.asyncio
+async def test_removed_endpoint_is_not_checked():
+    checked = []
+    scheduler = None
+
+    async def check(endpoint):
+        checked.append(endpoint.endpoint_id)
+        scheduler.stop()
+
+    scheduler = Scheduler(check, tick=0.01)
+    scheduler.add(Endpoint(1, "http://testserver:8001/1", None, 5), first_deadline=now())
+    scheduler.add(Endpoint(2, "http://testserver:8001/2", None, 5), first_deadline=now() + 0.01)
+    scheduler.remove(1)
+    await scheduler.run()
+
+    assert checked == [2]
+    assert len(scheduler) == 1
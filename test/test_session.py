@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.session import SessionManager
+
+@pytest.mark.asyncio
+async def test_session_uses_configured_connector():
+    manager = SessionManager(limit=50, limit_per_host=5, keepalive_timeout=10, dns_cache_ttl=60, timeout=3)
+    async with manager as session:
+        assert session.connector is manager.connector
+        assert manager.connector.limit == 50
+        assert manager.connector.limit_per_host == 5
+        assert manager.connector.use_dns_cache is True
+        assert session.timeout.total == 3
+        # the session is created once per process
+        assert await manager.open() is session
+    assert manager.session is None
+
+@pytest.mark.asyncio
+async def test_stats_of_an_empty_pool():
+    manager = SessionManager(limit=50, limit_per_host=5)
+    async with manager:
+        stats = manager.stats()
+    assert stats["open"] == 0
+    assert stats["idle"] == 0
+    assert stats["acquired"] == 0
+    assert stats["limit"] == 50
+    assert stats["limit_per_host"] == 5
+    assert stats["connections_created"] == 0
+
+def test_ssl_context_is_shared():
+    manager = SessionManager()
+    assert SessionManager(ssl_context=manager.ssl_context).ssl_context is manager.ssl_context
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import math
+import struct
+import sys
+import zlib
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.spool import Spool, RECORD, LEGACY_RECORD, SEGMENT_SUFFIX
+from worker.stat_batch import StatBatch, MATCH_UNKNOWN
+from endpoint import Endpoint
+
+endpoint = Endpoint(7, "http://testserver:8001", ".*welcome", 5)
+# 4 records per segment
+SEGMENT_BYTES = RECORD.size * 4
+
+@pytest.fixture
+def create_batch(create_batch):
+    """Batches of checks of the endpoint, one second apart."""
+    return lambda size, first_timestamp=0.0: create_batch(size, endpoint, timestamp=first_timestamp, interval=1.0)
+
+def test_append_and_read_round_trip(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES)
+    batch = StatBatch(2)
+    batch.append(endpoint, 0.0, 200, 0.5, True, phases=(1, 2, 3, 4, 5))
+    batch.append(endpoint, 1.0, 0, None, None, truncated=True, regex_timed_out=True, late=True)
+    spool.append([batch])
+
+    read, _ = spool.read(10)
+
+    assert len(read) == 2
+    assert list(read.endpoint_id[:len(read)]) == [7, 7]
+    assert list(read.timestamp[:len(read)]) == [0.0, 1.0]
+    assert list(read.status_code[:len(read)]) == [200, 0]
+    assert read.duration[0] == 0.5
+    assert math.isnan(read.duration[1])
+    assert list(read.regex_match[:len(read)]) == [1, MATCH_UNKNOWN]
+    assert list(read.truncated[:len(read)]) == [0, 1]
+    assert list(read.regex_timed_out[:len(read)]) == [0, 1]
+    assert list(read.late[:len(read)]) == [0, 1]
+    assert [column[0] for column in read.phases.values()] == [1, 2, 3, 4, 5]
+    assert [column[1] for column in read.phases.values()] == [-1] * 5
+    spool.close()
+
+def test_append_flushes_only_the_records_written(tmp_path, create_batch):
+    spool = Spool(str(tmp_path), segment_bytes=1024 * 1024)
+    spool.append([create_batch(2)])
+    mapped = spool._map(0)
+    flushed = []
+
+    class Segment:
+        def __setitem__(self, key, value):
+            mapped[key] = value
+
+        def flush(self, offset, size):
+            flushed.append((offset, size))
+
+    spool._map = lambda seq: Segment()
+    spool.append([create_batch(2)])
+
+    # From the page of the first record to the end of the last one
+    assert flushed == [(0, 4 * RECORD.size)]
+
+def test_read_across_segments_and_commit(tmp_path, create_batch):
+    spool = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES)
+    spool.append([create_batch(10)])
+    assert len(spool) == 10
+    assert len(list(tmp_path.glob(f"*{SEGMENT_SUFFIX}"))) == 3
+
+    read, cursor = spool.read(6)
+    assert list(read.timestamp[:len(read)]) == [0, 1, 2, 3, 4, 5]
+    # Reading doesn't commit
+    assert len(spool) == 10
+    spool.commit(cursor)
+
+    assert len(spool) == 4
+    # The fully read segment is deleted
+    assert len(list(tmp_path.glob(f"*{SEGMENT_SUFFIX}"))) == 2
+    read, _ = spool.read(10)
+    assert list(read.timestamp[:len(read)]) == [6, 7, 8, 9]
+    spool.close()
+
+def test_restart_replays_uncommitted_records(tmp_path, create_batch):
+    spool = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES)
+    spool.append([create_batch(6)])
+    _, cursor = spool.read(2)
+    spool.commit(cursor)
+    spool.read(2)
+    spool.close()
+
+    restarted = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES)
+    assert len(restarted) == 4
+    restarted.append([create_batch(1, first_timestamp=100)])
+    read, _ = restarted.read(10)
+
+    assert list(read.timestamp[:len(read)]) == [2, 3, 4, 5, 100]
+    restarted.close()
+
+def test_oldest_segments_are_dropped_when_full(tmp_path, create_batch):
+    spool = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES, max_segments=2)
+    spool.append([create_batch(10)])
+
+    assert spool.stats()["dropped"] == 4
+    read, _ = spool.read(10)
+    assert list(read.timestamp[:len(read)]) == [4, 5, 6, 7, 8, 9]
+    spool.close()
+
+def test_legacy_segments_are_converted(tmp_path):
+    records = b""
+    for timestamp in range(3):
+        body = LEGACY_RECORD.pack(0, 7, float(timestamp), 0.5, 10, 200, 1, 0, 0, 0)[4:]
+        records += struct.pack("<I", zlib.crc32(body)) + body
+    (tmp_path / "000000000004.seg").write_bytes(records + bytes(LEGACY_RECORD.size))
+    # the first record was committed before the upgrade
+    (tmp_path / "checkpoint").write_bytes(struct.pack("<qq", 4, LEGACY_RECORD.size))
+
+    spool = Spool(str(tmp_path), segment_bytes=SEGMENT_BYTES)
+    read, _ = spool.read(10)
+
+    assert list(read.timestamp[:len(read)]) == [1.0, 2.0]
+    assert list(read.bytes_read[:len(read)]) == [10, 10]
+    # records without phases have unknown phases
+    assert read.phases["ttfb"][0] == -1
+    assert not list(tmp_path.glob("*.seg"))
+    spool.close()
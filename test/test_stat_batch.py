@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import math
+import sys
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.stat_batch import StatBatch, MATCH_UNKNOWN
+from worker.metrics import Stat
+from endpoint import Endpoint
+
+endpoint = Endpoint(3, "http://testserver:8001", ".*welcome", 5)
+
+def test_append_writes_columns():
+    batch = StatBatch(2)
+    batch.append(endpoint, 10.0, 200, 0.25, True, bytes_read=512, truncated=True)
+    batch.append_stat(Stat(endpoint, 11.0, 0, None, None))
+
+    assert len(batch) == 2
+    assert batch.is_full()
+    assert list(batch.endpoint_id) == [3, 3]
+    assert list(batch.timestamp) == [10.0, 11.0]
+    assert list(batch.status_code) == [200, 0]
+    assert batch.duration[0] == 0.25
+    assert math.isnan(batch.duration[1])
+    assert list(batch.regex_match) == [1, MATCH_UNKNOWN]
+    assert list(batch.bytes_read) == [512, 0]
+    assert list(batch.truncated) == [1, 0]
+    # The batch references the interned URL of the endpoint, it doesn't copy it
+    assert batch.url[0] is endpoint.url
+
+def test_append_to_full_batch():
+    batch = StatBatch(1)
+    batch.append(endpoint, 10.0, 200, 0.25, True)
+
+    with pytest.raises(IndexError):
+        batch.append(endpoint, 11.0, 200, 0.25, True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from api.stats import StatsCache, merge, parse_bucket, percentile, summarize, time_range
+from endpoint_manager import LATENCY_BUCKETS_MS, LATENCY_COLUMNS
+
+def create_row(durations_ms, statuses, duration_max=None):
+    """An aggregated row of the given durations and status codes."""
+    row = {
+        "checks": len(statuses),
+        "up": sum(1 for status in statuses if status == 200),
+        "regex_matched": 0,
+        "no_response": sum(1 for status in statuses if status == 0),
+        "status_2xx": sum(1 for status in statuses if 200 <= status < 300),
+        "status_3xx": sum(1 for status in statuses if 300 <= status < 400),
+        "status_4xx": sum(1 for status in statuses if 400 <= status < 500),
+        "status_5xx": sum(1 for status in statuses if 500 <= status < 600),
+        "durations": len(durations_ms),
+        "duration_sum": sum(durations_ms) / 1000,
+        "duration_max": duration_max if duration_max is not None else max(durations_ms, default=0) / 1000,
+    }
+    for bound, column in zip(LATENCY_BUCKETS_MS, LATENCY_COLUMNS):
+        row[column] = sum(1 for duration in durations_ms if duration <= bound)
+    return row
+
+def test_parse_bucket():
+    assert parse_bucket("1h") == timedelta(hours=1)
+    assert parse_bucket("2d") == timedelta(days=2)
+    for bucket in ("0h", "30m", "1.5h", "h"):
+        with pytest.raises(ValueError):
+            parse_bucket(bucket)
+
+def test_time_range_rounds_now_up_to_the_ttl():
+    start, end = time_range(None, None, ttl=60)
+
+    assert end.second == 0 and end.microsecond == 0
+    assert end - start == timedelta(days=1)
+
+def test_time_range_is_in_utc_and_ordered():
+    start, end = time_range(datetime(2024, 1, 1), datetime(2024, 1, 2))
+    assert start.tzinfo is timezone.utc and end.tzinfo is timezone.utc
+
+    with pytest.raises(ValueError):
+        time_range(datetime(2024, 1, 2), datetime(2024, 1, 1))
+
+def test_percentile_interpolates_within_a_bucket():
+    # 100 checks, evenly spread between 100ms and 250ms
+    row = create_row([100 + 1.5 * i for i in range(1, 101)], [200] * 100)
+
+    assert percentile(row, 0.5) == pytest.approx(0.175)
+    assert percentile(row, 0.99) == pytest.approx(0.2485)
+    assert percentile(create_row([], [0]), 0.5) is None
+
+def test_percentile_is_capped_by_the_maximum():
+    row = create_row([60] * 10, [200] * 10)
+
+    assert percentile(row, 0.99) == pytest.approx(0.06)
+
+def test_summarize_uptime_and_status_codes():
+    summary = summarize(create_row([10, 20, 30], [200, 301, 503, 0]))
+
+    assert summary["checks"] == 4
+    assert summary["uptime_percent"] == 25
+    assert summary["mean_duration"] == pytest.approx(0.02)
+    assert summary["status"] == {"no_response": 1, "status_2xx": 1, "status_3xx": 1,
+                                 "status_4xx": 0, "status_5xx": 1}
+
+def test_merge_adds_buckets_up():
+    merged = merge([create_row([10], [200]), create_row([2000], [500])])
+
+    assert merged == create_row([10, 2000], [200, 500])
+    assert merge([])["checks"] == 0
+
+@pytest.mark.asyncio
+async def test_cache_hits_within_the_ttl():
+    cache = StatsCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert await cache.get("key", compute) == 1
+    assert await cache.get("key", compute) == 1
+    assert await cache.get("other", compute) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+@pytest.mark.asyncio
+async def test_cache_computes_once_for_concurrent_misses():
+    cache = StatsCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "stats"
+
+    results = await asyncio.gather(*(cache.get("key", compute) for _ in range(10)))
+
+    assert results == ["stats"] * 10
+    assert len(calls) == 1
+
+@pytest.mark.asyncio
+async def test_cache_does_not_keep_errors():
+    cache = StatsCache(ttl=60)
+
+    async def fail():
+        raise RuntimeError("db is down")
+
+    async def succeed():
+        return "stats"
+
+    with pytest.raises(RuntimeError):
+        await cache.get("key", fail)
+    assert await cache.get("key", succeed) == "stats"
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded():
+    cache = StatsCache(ttl=60, size=2)
+
+    async def compute():
+        return 1
+
+    for key in range(5):
+        await cache.get(key, compute)
+
+    assert len(cache._entries) == 2
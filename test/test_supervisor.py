@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import sys
+import time
+from pathlib import Path
+from unittest.mock import patch
+import pytest
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.supervisor import Supervisor, cgroup_cpu_quota, usable_cores
+
+def test_cgroup_v2_quota(tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    assert cgroup_cpu_quota(str(tmp_path)) == 1.5
+
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert cgroup_cpu_quota(str(tmp_path)) is None
+
+def test_cgroup_v1_quota(tmp_path):
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("200000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert cgroup_cpu_quota(str(tmp_path)) == 2
+
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    assert cgroup_cpu_quota(str(tmp_path)) is None
+
+def test_usable_cores_is_capped_by_the_quota(tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    with patch('os.sched_getaffinity', return_value={0, 1, 2, 3}):
+        assert usable_cores(str(tmp_path)) == 2
+        assert usable_cores(str(tmp_path / "missing")) == 4
+
+def test_partitions_are_split_across_nodes():
+    supervisor = Supervisor(processes=2, target=print, node_count=3, node_index=1)
+
+    assert supervisor.partition_count == 6
+    assert [child.partition_id for child in supervisor.children] == [2, 3]
+
+def crash(partition_id, partition_count, heartbeats):
+    heartbeats.put({"partition_id": partition_id, "pid": __import__("os").getpid(), "checks": 10})
+    sys.exit(1)
+
+def test_crashed_children_are_restarted():
+    supervisor = Supervisor(processes=1, target=crash)
+    child = supervisor.children[0]
+    with patch('worker.supervisor.SUPERVISOR_RESTART_BACKOFF', 0):
+        supervisor._start(child)
+        deadline = time.monotonic() + 30
+        while child.restarts < 2 and time.monotonic() < deadline:
+            supervisor._collect_heartbeats(timeout=0.1)
+            supervisor._watch_children()
+    supervisor._stop_children()
+
+    assert child.restarts >= 2
+    assert supervisor.stats()["restarts"] >= 2
+
+def test_throughput_counts_a_restarted_child_from_zero():
+    supervisor = Supervisor(processes=2, target=crash)
+    first, second = supervisor.children
+    first.heartbeat, second.heartbeat = {"checks": 100}, {"checks": 100}
+    supervisor.stats()
+    # the second child restarted, and did 30 checks since
+    first.heartbeat, second.heartbeat = {"checks": 150}, {"checks": 30}
+    supervisor._last_stats -= 1
+
+    assert supervisor.stats()["checks_per_second"] == pytest.approx(80, rel=0.01)
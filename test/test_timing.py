@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import socket
+import ssl
+import sys
+import time
+from pathlib import Path
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.timing import PhaseTimer, UNKNOWN
+from worker.metrics import Stat
+from worker.session import SessionManager
+from endpoint import Endpoint
+
+def test_phases_of_a_tls_connection():
+    timer = PhaseTimer()
+    timer.started = 1_000_000
+    timer.connect_started = 1_000_000
+    timer.dns_started, timer.dns_ended = 1_000_000, 3_000_000
+    timer.tcp_connected = 4_000_000
+    timer.connected = 9_000_000
+    timer.request_sent = 9_500_000
+    timer.response_started = 59_500_000
+    timer.ended = 61_000_000
+
+    assert timer.phases() == (2000, 1000, 5000, 50000, 1500)
+    assert timer.duration == pytest.approx(0.06)
+
+def test_phases_never_reached_are_unknown():
+    timer = PhaseTimer()
+    timer.dns_started, timer.dns_ended = 1_000_000, 3_000_000
+    timer.finish()
+
+    assert timer.phases() == (2000, UNKNOWN, UNKNOWN, UNKNOWN, UNKNOWN)
+
+# A self-signed certificate of 127.0.0.1
+CERTIFICATE = Path(__file__).resolve().parent / "test_data" / "localhost.crt"
+
+async def start_server(tls=False):
+    async def slow(_):
+        await asyncio.sleep(0.05)
+        return web.Response(text="You are always welcome!")
+
+    app = web.Application()
+    app.router.add_get("/", slow)
+    server = TestServer(app, host="127.0.0.1", scheme="https" if tls else "http")
+    server_context = None
+    if tls:
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(CERTIFICATE, CERTIFICATE.with_suffix(".key"))
+    await server.start_server(ssl=server_context)
+    return server
+
+async def check(session, endpoint):
+    stat = Stat(endpoint, time.time())
+    async with session.get(endpoint.url, trace_request_ctx=stat.timer) as response:
+        await stat.build_from_successful_http_req(response)
+    return stat
+
+@pytest.mark.asyncio
+async def test_checks_are_timed_by_the_session():
+    server = await start_server()
+    endpoint = Endpoint(1, str(server.make_url("/")), ".*welcome", 5)
+    try:
+        async with SessionManager() as session:
+            first = await check(session, endpoint)
+            second = await check(session, endpoint)
+    finally:
+        await server.close()
+
+    assert first.regex_match is True
+    dns, connect, tls, ttfb, transfer = first.phases
+    # An IP address isn't resolved, and plain HTTP has no handshake
+    assert (dns, tls) == (0, 0)
+    assert connect > 0
+    assert ttfb >= 50000
+    assert transfer >= 0
+    assert first.duration >= (connect + ttfb + transfer) / 1e6
+    # The second check reuses the connection
+    assert second.phases[:3] == (0, 0, 0)
+    assert second.phases[3] >= 50000
+
+@pytest.mark.asyncio
+async def test_tls_handshake_is_timed_apart_from_connect():
+    server = await start_server(tls=True)
+    endpoint = Endpoint(1, str(server.make_url("/")), ".*welcome", 5)
+    manager = SessionManager()
+    manager.ssl_context.load_verify_locations(CERTIFICATE)
+    try:
+        async with manager as session:
+            stat = await check(session, endpoint)
+    finally:
+        await server.close()
+
+    assert stat.regex_match is True
+    # Fails if asyncio stops wrapping the socket between connect and the handshake
+    _, connect, tls, ttfb, _ = stat.phases
+    assert connect > 0 and tls > 0
+    assert ttfb >= 50000
+
+@pytest.mark.asyncio
+async def test_failed_connection_has_no_phases():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    endpoint = Endpoint(1, f"http://127.0.0.1:{port}/", None, 5)
+    stat = Stat(endpoint, time.time())
+    async with SessionManager() as session:
+        with pytest.raises(Exception):
+            async with session.get(endpoint.url, trace_request_ctx=stat.timer):
+                pass
+    stat.build_from_failed_http_req()
+
+    assert stat.status_code == 0
+    assert stat.phases[1:] == (UNKNOWN,) * 4
+    assert stat.duration > 0
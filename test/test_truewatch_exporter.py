@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring
+
+import asyncio
+import sys
+from pathlib import Path
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# To import the src code, we need to add the src directory to the path
+src_directory = Path(__file__).resolve().parent.parent / "src"
+sys.path.append(str(src_directory))
+from worker.truewatch_exporter import TrueWatchExporter, create_truewatch_exporter, encode, to_line_protocol
+from endpoint import Endpoint
+
+endpoint = Endpoint(7, "http://testserver:8001/a b,c", ".*welcome", 5)
+
+@pytest.fixture
+def create_batch(create_batch):
+    """A factory of batches of a successful check with its phases, and of a failed one."""
+    def create():
+        batch = create_batch(endpoint=endpoint, timestamp=1.5, duration=0.25, capacity=2,
+                             bytes_read=100, phases=(0, 0, 0, 240000, 10000))
+        batch.append(endpoint, 2.0, 0, None, None)
+        return batch
+    return create
+
+def test_to_line_protocol(create_batch):
+    lines = to_line_protocol([create_batch()]).decode().splitlines()
+
+    assert lines == [
+        "site_uptime_watcher,endpoint=http://testserver:8001/a\\ b\\,c,status_code=200,regex_match=true "
+        "response_time=0.25,status_code=200i,regex_match=1i,bytes_read=100i,truncated=0i,regex_timed_out=0i,late=0i,"
+        "dns_us=0i,connect_us=0i,tls_us=0i,ttfb_us=240000i,transfer_us=10000i 1500000000",
+        "site_uptime_watcher,endpoint=http://testserver:8001/a\\ b\\,c,status_code=0,regex_match=none "
+        "status_code=0i,regex_match=0i,bytes_read=0i,truncated=0i,regex_timed_out=0i,late=0i "
+        "2000000000",
+    ]
+
+async def start_truewatch(statuses):
+    """Start a fake DataKit answering with the given statuses, then 200, and recording bodies."""
+    received = []
+    statuses = list(statuses)
+
+    async def write(request):
+        assert request.headers["Content-Encoding"] == "gzip"
+        status = statuses.pop(0) if statuses else 200
+        if status == 200:
+            # aiohttp decompresses the body, as DataKit does
+            received.append(await request.read())
+        return web.Response(status=status)
+
+    app = web.Application()
+    app.router.add_post("/v1/write/metrics", write)
+    server = TestServer(app)
+    await server.start_server()
+    return server, received
+
+async def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+@pytest.mark.asyncio
+async def test_retries_with_backoff(tmp_path, create_batch):
+    server, received = await start_truewatch([503, 503])
+    exporter = await TrueWatchExporter(str(server.make_url("")).rstrip("/"), backoff_base=0.01,
+                                       spool_dir=str(tmp_path)).start()
+
+    await exporter.submit([create_batch()])
+    await wait_for(lambda: received)
+    await exporter.close()
+    await server.close()
+
+    assert len(received) == 1
+    assert received[0] == to_line_protocol([create_batch()])
+    assert exporter.stats()["retried"] == 2
+    assert not list(tmp_path.iterdir())
+
+@pytest.mark.asyncio
+async def test_spools_and_replays_after_an_outage(tmp_path, monkeypatch, create_batch):
+    monkeypatch.setattr("worker.truewatch_exporter.TRUEWATCH_REPLAY_INTERVAL", 0.01)
+    server, received = await start_truewatch([503, 503])
+    exporter = await TrueWatchExporter(str(server.make_url("")).rstrip("/"), max_attempts=1,
+                                       spool_dir=str(tmp_path)).start()
+
+    await exporter.submit([create_batch()])
+    await exporter.submit([create_batch()])
+    await wait_for(lambda: len(received) == 2)
+    await exporter.close()
+    await server.close()
+
+    stats = exporter.stats()
+    assert stats["spooled"] == 2
+    assert stats["replayed"] == 2
+    assert len(received) == 2
+    assert not list(tmp_path.iterdir())
+
+@pytest.mark.asyncio
+async def test_rejected_payloads_are_dropped(tmp_path, create_batch):
+    server, received = await start_truewatch([400])
+    exporter = await TrueWatchExporter(str(server.make_url("")).rstrip("/"), spool_dir=str(tmp_path)).start()
+
+    await exporter.submit([create_batch()])
+    await wait_for(lambda: exporter.dropped)
+    await exporter.close()
+    await server.close()
+
+    assert not received
+    assert exporter.stats()["sent"] == 0
+    assert exporter.stats()["dropped"] == 1
+    assert exporter.stats()["retried"] == 0
+
+@pytest.mark.asyncio
+async def test_replay_skips_payloads_deleted_meanwhile(tmp_path, monkeypatch, create_batch):
+    monkeypatch.setattr("worker.truewatch_exporter.TRUEWATCH_REPLAY_INTERVAL", 0.01)
+    server, received = await start_truewatch([])
+    exporter = TrueWatchExporter(str(server.make_url("")).rstrip("/"), spool_dir=str(tmp_path))
+    exporter._spool(encode([create_batch()]))
+    spooled = exporter._spool_files()
+    # the first file is gone by the time it is read
+    monkeypatch.setattr(exporter, "_spool_files", lambda: [tmp_path / "0-gone.lp.gz", *spooled])
+    await exporter.start()
+
+    await wait_for(lambda: exporter.replayed)
+    await exporter.close()
+    await server.close()
+
+    assert exporter.replayed >= 1
+    assert received
+
+def test_each_partition_has_its_own_spool():
+    first, second = create_truewatch_exporter(0), create_truewatch_exporter(1)
+
+    assert first.spool_dir.name == "partition-0"
+    assert second.spool_dir.name == "partition-1"
+    assert first.spool_dir.parent == second.spool_dir.parent
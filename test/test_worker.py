@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=missing-docstring, too-few-public-methods
 
+import asyncio
 import sys
 from pathlib import Path
 from unittest.mock import patch, MagicMock, AsyncMock, ANY
@@ -19,84 +20,90 @@ def reset_worker():
     # This fixture is no longer needed as we're using instance variables
     pass
 
-def create_mocked_sleep(worker):
-    """Create a mocked sleep function that stops the worker after one iteration."""
-    # Use a closure to avoid global variable
-    num_of_monitor_iterations = 0
-    # pylint: disable=unused-argument
-    async def mocked_sleep(interval):
-        nonlocal num_of_monitor_iterations
-        num_of_monitor_iterations += 1
-        if num_of_monitor_iterations > 1:
-            worker.stop()
-    return mocked_sleep
+def create_mocked_session(get_side_effect=None):
+    """Create a mocked aiohttp session whose get() is used as an async context manager."""
+    response = MagicMock()
+    request_context = MagicMock()
+    request_context.__aenter__ = AsyncMock(side_effect=get_side_effect, return_value=response)
+    request_context.__aexit__ = AsyncMock(return_value=False)
+    return MagicMock(get=MagicMock(return_value=request_context)), response
 
 
 @pytest.mark.asyncio
-@patch('aiohttp.ClientSession')
-@patch('asyncio.sleep')
-@patch('src.worker.metrics.Stat')
-@patch('asyncio.Queue', return_value=MagicMock(put=AsyncMock()))
-async def test_monitor_with_failed_request(mock_queue, mock_stat, mock_sleep, mock_client_session):
+async def test_check_with_failed_request():
     # here we mock a failed get request
-    mock_session_instance = MagicMock(get=AsyncMock(side_effect=Exception("TCP Connection exception")))
-    # __aenter__ is a magic method for with statement
-    mock_client_session.return_value.__aenter__.return_value = mock_session_instance
-
-    # mock the Stat objects used in the function under test
-    mocked_stat_object = mock_stat.return_value
-    mocked_stat_object.build_from_successful_http_req = AsyncMock()
-    mocked_stat_object.build_from_failed_http_req = MagicMock()
-
+    mock_session, _ = create_mocked_session(Exception("TCP Connection exception"))
     endpoint = Endpoint(1, "http://testserver:8001", r'.*', 5)
-    worker = Worker()
-    
-    # Set up the mocked sleep to stop the worker after one iteration
-    mock_sleep.side_effect = create_mocked_sleep(worker)
-    
-    await worker.monitor(endpoint)
-
-    assert mock_queue.return_value.put.call_count == 2
-    mock_queue.return_value.put.assert_called_with(ANY)
+    worker = Worker(MagicMock(put=AsyncMock()))
+    worker.session = mock_session
 
-    assert mocked_stat_object.build_from_successful_http_req.call_count == 0
-    assert mocked_stat_object.build_from_failed_http_req.call_count == 2
+    await worker.check(endpoint)
 
-    mock_sleep.assert_called_with(endpoint.interval)
-    assert mock_sleep.call_count == 2
-    assert worker._running is False
+    mock_session.get.assert_called_with(endpoint.url, trace_request_ctx=ANY)
+    batch = worker.batch
+    assert len(batch) == 1
+    assert (batch.endpoint_id[0], batch.status_code[0], batch.regex_match[0]) == (1, 0, 0)
+    assert batch.duration[0] > 0
+    # the request never reached the server
+    assert batch.phases["ttfb"][0] == -1
 
 @pytest.mark.asyncio
-@patch('aiohttp.ClientSession')
-@patch('asyncio.sleep')
-@patch('src.worker.metrics.Stat')
-@patch('asyncio.Queue', return_value=MagicMock(put = AsyncMock()))
-async def test_monitor_with_successful_request(mock_queue, mock_stat, mock_sleep, mock_client_session):
+async def test_check_with_successful_request(aiohttp_response):
     # here we mock a successful get request
-    mock_session_instance = MagicMock(get = AsyncMock())
-    # __aenter__ is a magic method for with statement
-    mock_client_session.return_value.__aenter__.return_value = mock_session_instance
+    mock_session, _ = create_mocked_session()
+    mock_session.get.return_value.__aenter__.return_value = aiohttp_response(200, "You are always welcome!")
+    endpoint = Endpoint(1, "http://testserver:8001", r'welcome', 5)
+    worker = Worker(MagicMock(put=AsyncMock()))
+    worker.session = mock_session
 
-    # mock the Stat objects used in the function under test
-    mocked_stat_object = mock_stat.return_value
-    mocked_stat_object.build_from_successful_http_req = AsyncMock()
-    mocked_stat_object.build_from_failed_http_req = MagicMock()
+    await worker.check(endpoint)
 
-    endpoint = Endpoint(1, "http://testserver:8001", r'.*', 5)
-    worker = Worker()
-    
-    # Set up the mocked sleep to stop the worker after one iteration
-    mock_sleep.side_effect = create_mocked_sleep(worker)
-    
-    await worker.monitor(endpoint)
+    batch = worker.batch
+    assert len(batch) == 1
+    assert (batch.endpoint_id[0], batch.url[0], batch.status_code[0]) == (1, endpoint.url, 200)
+    assert (batch.regex_match[0], batch.bytes_read[0], batch.truncated[0]) == (1, 23, 0)
+    assert worker.checks == 1
+
+@pytest.mark.asyncio
+async def test_check_hands_off_full_batches():
+    mock_session, _ = create_mocked_session(Exception("TCP Connection exception"))
+    endpoint = Endpoint(1, "http://testserver:8001", None, 5)
+    worker = Worker(MagicMock(put=AsyncMock()), batch_size=2)
+    worker.session = mock_session
+
+    await worker.check(endpoint)
+    assert worker.statsBuffer.put.call_count == 0
+    await worker.check(endpoint)
+
+    batch = worker.statsBuffer.put.call_args.args[0]
+    assert len(batch) == 2
+    assert list(batch.endpoint_id) == [1, 1]
+    assert list(batch.status_code) == [0, 0]
+    assert len(worker.batch) == 0
+
+    await worker.check(endpoint)
+    await worker.hand_off()
+    assert worker.statsBuffer.put.call_count == 2
+    await worker.hand_off()
+    # An empty batch is never handed off
+    assert worker.statsBuffer.put.call_count == 2
 
-    assert mock_queue.return_value.put.call_count == 2
-    mock_queue.return_value.put.assert_called_with(ANY)
+@pytest.mark.asyncio
+@patch('aiohttp.ClientSession')
+async def test_run_dispatches_checks_through_scheduler(mock_client_session):
+    mock_client_session.return_value.close = AsyncMock()
+    endpoints = [Endpoint(i, f"http://testserver:8001/{i}", None, 5) for i in range(1, 4)]
+    worker = Worker()
+    checked = []
 
-    mocked_stat_object.build_from_successful_http_req.assert_called_with(mock_session_instance.get.return_value)
-    assert mocked_stat_object.build_from_successful_http_req.call_count == 2
-    assert mocked_stat_object.build_from_failed_http_req.call_count == 0
+    async def mocked_check(endpoint):
+        checked.append(endpoint.endpoint_id)
+        if len(checked) == len(endpoints):
+            worker.stop()
+    worker.scheduler.check = mocked_check
+    # make every endpoint due immediately
+    with patch('src.worker.scheduler.phase_of', side_effect=lambda _: asyncio.get_running_loop().time() % 5):
+        await worker.run(endpoints)
 
-    mock_sleep.assert_called_with(endpoint.interval)
-    assert mock_sleep.call_count == 2
+    assert sorted(checked) == [1, 2, 3]
     assert worker._running is False